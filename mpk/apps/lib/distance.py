@@ -12,8 +12,10 @@ def distance(p1, p2):
     if isinstance(p2, Stop):
         p2 = (p2.latitude, p2.longitude)
 
-    return math.sqrt(
-            math.pow(math.fabs(p2[0] - p1[0]) * settings.ONE_DEG_Y_KM, 2) +
-            math.pow(math.fabs(p2[1] - p1[1]) * settings.ONE_DEG_X_KM, 2)
-    ) * 1000.
+    # Squares are calculated by multiplication, which, unlike math.pow, is correctly rounded;
+    # this keeps the results identical to the vectorized version in vehicle_locations.engine
+    dist_y = (p2[0] - p1[0]) * settings.ONE_DEG_Y_KM
+    dist_x = (p2[1] - p1[1]) * settings.ONE_DEG_X_KM
+
+    return math.sqrt(dist_y * dist_y + dist_x * dist_x) * 1000.
 
@@ -0,0 +1,18 @@
+import re
+from datetime import datetime
+
+
+def parse_timestamptz(val):
+    """ Parses PostgreSQL's text output of timestamptz, e.g. '2020-01-02 03:04:05.67+00' """
+    # datetime.fromisoformat (before Python 3.11) needs 3 or 6 digits of fractional seconds and minutes of the offset
+    match = re.fullmatch(r'([^.]+?)(?:\.(\d+))?([+-]\d\d)(:\d\d)?', val)
+    if match is None:
+        raise ValueError(f'Invalid timestamptz: {val}')
+    date_str, fraction, offset_h, offset_m = match.groups()
+
+    return datetime.fromisoformat('{}{}{}{}'.format(
+        date_str,
+        '' if fraction is None else '.' + fraction.ljust(6, '0'),
+        offset_h,
+        offset_m or ':00',
+    ))
@@ -0,0 +1,68 @@
+"""
+Locations of a line collected after a given date, for extending open plots ending now in browsers (see
+create_plot.get_plot_data and js.js).
+Browsers poll LiveView every COLLECT_LOCATIONS_INTERVAL_S; each request is answered at once with processed locations
+since the previous watermark, i.e. the date of the latest location of the line, and the new watermark.
+collect_locations saves each poll in a single transaction, and locations of a poll are dated later than the ones
+of previous polls, so locations up to the watermark are all visible when it's read.
+"""
+import math
+import time
+from datetime import datetime, timedelta
+
+import pytz
+from django.conf import settings
+
+
+def get_latest_date(route):
+    return route.vehiclelocation_set.order_by('-date').values_list('date', flat=True).first()
+
+
+def get_new_points(route, date_from, date_to, position_scale):
+    """ Returns [vehicle-id, epoch, position] of processed locations of route in (date_from, date_to], sorted by vehicle
+    id and date; epochs are rounded to seconds and positions to 1/position_scale of a stop
+    """
+    locations = (
+        route
+        .vehiclelocation_set
+        .filter(date__gt=date_from, date__lte=date_to, route_position__isnull=False)
+        .order_by('vehicle_id', 'date')
+        .values_list('vehicle_id', 'date', 'route_position')
+    )
+
+    return [
+        [vehicle_id, round(date_.timestamp()), round(position * position_scale)]
+        for vehicle_id, date_, position in locations.iterator()
+    ]
+
+
+def get_window(duration_s):
+    """ Returns (date-from, date-to) of a plot of duration_s ending now, the same way as ProcessForm """
+    date_to = datetime.fromtimestamp((math.floor(time.time() / 60) + 1) * 60, settings.LOCAL_TIMEZONE)
+    return date_to - timedelta(seconds=duration_s), date_to
+
+
+def get_update(route, since, duration_s):
+    """ Returns locations of route collected after epoch since
+
+    The update is {'watermark_s', 'date_from_s', 'xticks', 'points', 'interval_s'} with the date of the latest location
+    (since, if there's no new one), the window and x ticks of the plot of duration_s ending now, new points
+    (see get_new_points) and the interval of polls.
+    """
+    from mpk.script.create_plot.create_plot import DATA_POSITION_SCALE, get_xticks
+
+    date_from = datetime.fromtimestamp(since, pytz.utc)
+    latest_date = get_latest_date(route)
+    if latest_date is None or latest_date <= date_from:
+        latest_date, points = date_from, []
+    else:
+        points = get_new_points(route, date_from, latest_date, DATA_POSITION_SCALE)
+
+    window_from, window_to = get_window(duration_s)
+    return {
+        'watermark_s': latest_date.timestamp(),
+        'date_from_s': window_from.timestamp(),
+        'xticks': get_xticks(window_from, window_to),
+        'points': points,
+        'interval_s': settings.COLLECT_LOCATIONS_INTERVAL_S,
+    }
@@ -0,0 +1,46 @@
+"""
+Renders plots and creates plot data for web workers in a pool of worker processes (see mpk.apps.mpk.render_service).
+Listens at RENDER_SERVICE_ADDRESS; SIGTERM and SIGINT stop the server and its workers.
+"""
+import logging
+import os
+import signal
+
+from django.conf import settings
+from django.core.management import BaseCommand
+
+from mpk.apps.mpk import render_service
+
+
+logger = logging.getLogger('default')
+
+
+class Command(BaseCommand):
+
+    def add_arguments(self, parser):
+        parser.add_argument('-j', '--num-workers', dest='num_workers', type=int, default=os.cpu_count(), help='Number of worker processes')
+        parser.add_argument('-q', '--max-queued', dest='max_queued', type=int, help='Number of jobs waiting for a worker (default: number of workers)')
+
+    def handle(self, *args, **kwargs):
+        # Parse arguments
+        num_workers = kwargs['num_workers']
+        max_queued = num_workers if kwargs['max_queued'] is None else kwargs['max_queued']
+
+        if settings.RENDER_SERVICE_ADDRESS is None:
+            raise ValueError('RENDER_SERVICE_ADDRESS isn\'t set')
+        if num_workers <= 0 or max_queued < 0:
+            raise ValueError('num_workers must be positive and max_queued must not be negative')
+
+        # Signals
+        def stop(signum, frame):
+            logger.info(f'Received signal {signum}, stopping..')
+
+            # Workers are stopped while exiting
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            raise SystemExit(0)
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        render_service.serve(settings.RENDER_SERVICE_ADDRESS, num_workers, max_queued)
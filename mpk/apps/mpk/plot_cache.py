@@ -0,0 +1,127 @@
+"""
+Cache of rendered plots.
+Plots are stored in MEDIA_ROOT/PLOT_CACHE_DIR under a hash of the line, the window, the version of the plot
+parameters, the modification date and the segment cache generation of the route (see lib.segment_cache), and the data
+watermark, i.e. the date of the latest location of the route within the window. A plot is re-rendered only if new
+locations have been collected since it was rendered, or the route or its past locations have changed (e.g. by
+reprocess_locations).
+Files are evicted in order of last use when the cache is larger than PLOT_CACHE_MAX_SIZE_MB, and when they haven't
+been used for PLOT_CACHE_MAX_AGE_S.
+"""
+import hashlib
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from mpk.script.create_plot.lib import segment_cache
+from mpk.script.create_plot.lib.settings import Params
+from routes.models import Route
+from vehicle_locations.models import VehicleLocation
+
+
+def get_cache_dir():
+    return f'{settings.MEDIA_ROOT}/{settings.PLOT_CACHE_DIR}'
+
+
+def get_watermark(line_no, date_to):
+    """ Returns the date of the latest location of line line_no before date_to, or None if there's none """
+    return (
+        VehicleLocation
+        .objects
+        .filter(route__line=line_no, date__lt=date_to)
+        .order_by('-date')
+        .values_list('date', flat=True)
+        .first()
+    )
+
+
+def get_plot_key(line_no, date_from, date_to):
+    route = Route.objects.filter(line=line_no).first()
+    watermark = get_watermark(line_no, date_to)
+    key = '{}|{}|{}|{}|{}|{}|{}'.format(
+        line_no,
+        date_from.isoformat(),
+        date_to.isoformat(),
+        Params.VERSION,
+        None if route is None else route.date_modified.isoformat(),
+        None if route is None else segment_cache.get_generation(route.id),
+        None if watermark is None else watermark.isoformat(),
+    )
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+def get_plot_filename(key):
+    return f'{get_cache_dir()}/{key}.png'
+
+
+def get_plot_url(key):
+    return f'{settings.MEDIA_URL}{settings.PLOT_CACHE_DIR}/{key}.png'
+
+
+def get_cached_plot(key):
+    """ Returns True if the plot is in the cache; its last use time is updated """
+    filename = get_plot_filename(key)
+    try:
+        os.utime(filename)
+    except FileNotFoundError:
+        return False
+
+    return True
+
+
+def add_plot(key, render):
+    """ Renders the plot with render(filename) and adds it to the cache
+
+    The plot is rendered to a temporary file of this thread and renamed, so that concurrent requests never see a partial plot.
+    """
+    os.makedirs(get_cache_dir(), exist_ok=True)
+
+    filename = get_plot_filename(key)
+    tmp_filename = '{}.{}-{}.tmp.png'.format(filename[:-len('.png')], os.getpid(), threading.get_ident())
+    try:
+        render(tmp_filename)
+        os.replace(tmp_filename, filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+    evict()
+
+
+def evict():
+    """ Removes plots not used for PLOT_CACHE_MAX_AGE_S, and the least recently used ones above PLOT_CACHE_MAX_SIZE_MB """
+    min_mtime = time.time() - settings.PLOT_CACHE_MAX_AGE_S
+    max_size = settings.PLOT_CACHE_MAX_SIZE_MB << 20
+
+    files = []
+    with os.scandir(get_cache_dir()) as it:
+        for entry in it:
+            if not entry.name.endswith('.png'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+
+            # Temporary files are being rendered, unless they've been left by a killed process
+            if entry.name.endswith('.tmp.png'):
+                if stat.st_mtime < min_mtime:
+                    os.remove(entry.path)
+                continue
+
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+
+    # The most recently used first
+    files.sort(reverse=True)
+    total_size = 0
+    for mtime, size, path in files:
+        if mtime >= min_mtime and total_size + size <= max_size:
+            total_size += size
+            continue
+
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
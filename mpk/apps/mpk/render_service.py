@@ -0,0 +1,191 @@
+"""
+Renders plots, and creates data of plots drawn by browsers, in a pool of worker processes of the render_server
+command, so that web workers only wait for them.
+Workers load matplotlib, fonts and plot parameters when they start. Web workers send jobs over the Unix socket
+RENDER_SERVICE_ADDRESS; as many jobs as there are workers are run at once and a limited number of them wait,
+further jobs are rejected with RenderServiceBusy. Jobs not finished within RENDER_SERVICE_TIMEOUT_S of being
+received are aborted.
+If RENDER_SERVICE_ADDRESS is None, jobs are run in web workers, without these limits.
+"""
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from multiprocessing.connection import Client, Listener, answer_challenge, deliver_challenge
+
+from django.conf import settings
+from django.db import close_old_connections, connections
+
+
+logger = logging.getLogger('default')
+
+
+class RenderServiceBusy(Exception):
+    pass
+
+
+def render_plot(line_no, date_from, date_to, plot_filename):
+    """ Creates the plot in this process """
+    from mpk.script.create_plot.create_plot import create_plot
+
+    create_plot(line_no, date_from, date_to, plot_filename)
+
+
+def create_plot_data(line_no, date_from, date_to):
+    """ Returns data of the plot drawn by browsers (see create_plot.get_plot_data), created in this process """
+    from mpk.script.create_plot.create_plot import get_plot_data
+
+    return get_plot_data(line_no, date_from, date_to)
+
+
+# Functions run by jobs of each kind
+JOB_FUNCTIONS = {
+    'plot': render_plot,
+    'data': create_plot_data,
+}
+
+
+def _get_authkey():
+    return settings.SECRET_KEY.encode()
+
+
+def _run(kind, *args):
+    """ Runs a job of kind kind with render_server, or in this process if RENDER_SERVICE_ADDRESS is None; returns
+    its result
+
+    Raises RenderServiceBusy if the server can't accept more jobs.
+    """
+    if settings.RENDER_SERVICE_ADDRESS is None:
+        return JOB_FUNCTIONS[kind](*args)
+
+    try:
+        with Client(settings.RENDER_SERVICE_ADDRESS, family='AF_UNIX', authkey=_get_authkey()) as conn:
+            conn.send((kind, *args))
+
+            # The server replies when the job is aborted; the margin covers the communication
+            if not conn.poll(settings.RENDER_SERVICE_TIMEOUT_S + 5):
+                raise TimeoutError('The plot server didn\'t reply')
+            status, result = conn.recv()
+    except (ConnectionRefusedError, FileNotFoundError) as exc:
+        raise RuntimeError('The plot server isn\'t running') from exc
+
+    if status == 'busy':
+        raise RenderServiceBusy('Too many plots are being created, please try again in a moment')
+    if status == 'error':
+        raise RuntimeError(result)
+
+    return result
+
+
+def render(line_no, date_from, date_to, plot_filename):
+    """ Renders the plot with render_server, or in this process if RENDER_SERVICE_ADDRESS is None """
+    _run('plot', line_no, date_from, date_to, plot_filename)
+
+
+def get_plot_data(line_no, date_from, date_to):
+    """ Returns data of the plot drawn by browsers, created by render_server like plots rendered with render """
+    return _run('data', line_no, date_from, date_to)
+
+
+## Server
+def _abort_job(signum, frame):
+    raise TimeoutError('Creating the plot took too long')
+
+
+def _init_worker():
+    """ Loads matplotlib, fonts and plot parameters """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    from mpk.script.create_plot import create_plot  # noqa: F401; sets matplotlib settings
+
+    # The server stops workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGALRM, _abort_job)
+
+    figure_h = Figure()
+    FigureCanvasAgg(figure_h)
+    figure_h.text(.5, .5, 'MPK')
+    figure_h.canvas.draw()
+
+
+def _run_job(job, deadline):
+    """ Runs job (kind, *args) in a worker, unless the job waited until its deadline; the job is aborted at the deadline """
+    timeout_s = deadline - time.time()
+    if timeout_s <= 0:
+        raise TimeoutError('Too many plots are being created, please try again in a moment')
+
+    kind, *args = job
+    close_old_connections()
+    signal.setitimer(signal.ITIMER_REAL, timeout_s)
+    try:
+        return JOB_FUNCTIONS[kind](*args)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def _handle_connection(conn, pool, slots):
+    with conn:
+        # Authenticate the client here, so that a stalled client only holds its own thread
+        try:
+            deliver_challenge(conn, _get_authkey())
+            answer_challenge(conn, _get_authkey())
+            job = conn.recv()
+        except (multiprocessing.AuthenticationError, EOFError, OSError) as exc:
+            logger.warning(f'Render server: rejected connection: {exc}')
+            return
+
+        if not slots.acquire(blocking=False):
+            logger.warning('Render server busy; rejected {} {} {} -- {}'.format(*job[:4]))
+            conn.send(('busy', None))
+            return
+
+        try:
+            deadline = time.time() + settings.RENDER_SERVICE_TIMEOUT_S
+            result = pool.apply_async(_run_job, (job, deadline))
+
+            # Jobs of workers that died never finish
+            reply = ('ok', result.get(settings.RENDER_SERVICE_TIMEOUT_S + 1))
+
+        except multiprocessing.TimeoutError:
+            logger.error('Render job {} {} {} -- {} lost'.format(*job[:4]))
+            reply = ('error', 'Creating the plot took too long')
+
+        except Exception as exc:
+            reply = ('error', str(exc))
+
+        finally:
+            slots.release()
+
+        try:
+            conn.send(reply)
+        except OSError:
+            # The client has gone
+            pass
+
+
+def serve(address, num_workers, max_queued):
+    """ Accepts jobs at Unix socket address and renders them in num_workers processes; at most max_queued jobs wait """
+    # Workers open their own db connections
+    connections.close_all()
+
+    # Socket left by a killed server
+    if os.path.exists(address):
+        os.remove(address)
+
+    slots = threading.BoundedSemaphore(num_workers + max_queued)
+    with multiprocessing.Pool(num_workers, initializer=_init_worker) as pool, \
+            Listener(address, family='AF_UNIX') as listener:
+        logger.info(f'Render server started at {address}; {num_workers} workers')
+
+        while True:
+            try:
+                conn = listener.accept()
+            except OSError as exc:
+                logger.warning(f'Render server: accepting a connection failed: {exc}')
+                continue
+
+            threading.Thread(target=_handle_connection, args=(conn, pool, slots), daemon=True).start()
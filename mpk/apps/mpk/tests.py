@@ -0,0 +1,454 @@
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from multiprocessing.connection import Pipe, answer_challenge, deliver_challenge
+from unittest import mock
+
+import numpy as np
+import pytz
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from PIL import Image
+
+from mpk.apps.mpk import live, plot_cache, render_service
+from mpk.script.create_plot import create_plot
+from mpk.script.create_plot.lib import segment_cache
+from routes.models import Route
+from stops.models import Stop
+from vehicle_locations.models import VehicleLocation
+
+
+def process_vehicle_locations_reference(points, num_stops, params, max_diff_continuous_data_s=None):
+    """ Python implementation of create_plot._process_vehicle_locations, one point at a time """
+    if max_diff_continuous_data_s is None:
+        max_diff_continuous_data_s = params.max_diff_continuous_data_s
+    max_diff_continuous_data = max_diff_continuous_data_s / 24 / 3600
+
+    data, gap_data, invalid_data = {}, {}, {}
+    dest_data = {'gap-data': gap_data, 'invalid-data': invalid_data}
+    prev_vehicle_id, prev_point, num_unprocessed_in_a_row = None, None, 0
+    for vehicle_id, date_, stop_ind in points:
+        if stop_ind is not None:
+            point = (date_, stop_ind)
+
+            if prev_vehicle_id != vehicle_id:
+                # First data point
+                data[vehicle_id] = [[]]
+                num_unprocessed_in_a_row = 0
+
+            else:
+                # Not the first data point
+                data_type = create_plot._get_data_type(prev_point, point, num_unprocessed_in_a_row, num_stops, params, max_diff_continuous_data)
+                if data_type is None:
+                    # Break this vehicle data in two and don't plot line between the two parts
+                    create_plot._split_vehicle_data(data, vehicle_id)
+
+                elif data_type != 'data':
+                    # Plot gap/invalid data line
+                    diff = date_ - prev_point[0]
+                    dest_data[data_type].setdefault(vehicle_id, []).append([prev_point, point])
+                    data[vehicle_id][0].append((date_ - diff / 2, None))
+
+            # Add this point
+            data[vehicle_id][0].append(point)
+
+            # Set last processed point
+            prev_vehicle_id, prev_point, num_unprocessed_in_a_row = vehicle_id, point, 0
+
+        else:
+            # Unprocessed location
+            if prev_vehicle_id != vehicle_id:
+                # New vehicle id; ignore all unprocessed locations before the first processed
+                continue
+
+            num_unprocessed_in_a_row += 1
+
+    return {
+        'data': data,
+        'gap-data': gap_data,
+        'invalid-data': invalid_data,
+    }
+
+
+def generate_points(rng, num_vehicles, num_points):
+    """ Returns points (see create_plot._get_location_points) with data gaps, invalid data and reused vehicle ids """
+    points = []
+    for vehicle_id in range(num_vehicles):
+        date_, position, direction = 730000. + rng.uniform(0, .1), rng.uniform(0, 20), 1
+        for _ in range(num_points):
+            r = rng.uniform()
+            if r < .01:
+                date_ += rng.choice([120, 900, 5 * 3600]) / 86400.
+            elif r < .02:
+                position = rng.uniform(0, 20)
+
+            is_unprocessed = rng.uniform() < (.9 if int(date_ * 100) % 7 == 0 else .05)
+            points.append((vehicle_id, date_, None if is_unprocessed else position))
+
+            date_ += 20 / 86400.
+            position += direction * .02
+            if not 0 <= position <= 20:
+                direction, position = -direction, min(max(position, 0), 20)
+
+    return points
+
+
+class ProcessVehicleLocationsTests(SimpleTestCase):
+
+    def assertSameData(self, data, expected, is_ordered=True):
+        """ Data lines are arrays of the expected lines, with NaN for None """
+        self.assertEqual(data.keys(), expected.keys())
+        for data_type in expected:
+            self.assertEqual(data[data_type].keys(), expected[data_type].keys())
+            if is_ordered:
+                # Lines are plotted in the same order
+                self.assertEqual(list(data[data_type]), list(expected[data_type]))
+            for vehicle_id, lines in expected[data_type].items():
+                self.assertEqual(len(data[data_type][vehicle_id]), len(lines))
+                for line, expected_line in zip(data[data_type][vehicle_id], lines):
+                    np.testing.assert_array_equal(np.array(line, dtype=float), np.array(expected_line, dtype=float))
+
+    def test_same_as_reference(self):
+        rng = np.random.default_rng(1)
+        points = generate_points(rng, 8, 2000)
+
+        # Vehicles without processed locations, and with unprocessed locations before the first processed one
+        points = [(100, 730000., None), (100, 730000.1, None)] + points + [(200, 730000., None), (200, 730000.01, 3.), (300, 730000., 2)]
+        points.sort(key=lambda point: point[:2])
+
+        for num_stops in [5, 21, 40]:
+            for max_diff_continuous_data_s in [None, 30, 240]:
+                data = create_plot._process_vehicle_locations(*create_plot._points_to_arrays(points), num_stops, create_plot.params, max_diff_continuous_data_s)
+                expected = process_vehicle_locations_reference(points, num_stops, create_plot.params, max_diff_continuous_data_s)
+                self.assertSameData(data, expected)
+        self.assertEqual(
+            create_plot._process_vehicle_locations(*create_plot._points_to_arrays([]), 5, create_plot.params),
+            {'data': {}, 'gap-data': {}, 'invalid-data': {}},
+        )
+
+    def test_stitched_buckets(self):
+        rng = np.random.default_rng(0)
+        points = generate_points(rng, 5, 3000)
+        params = create_plot.params
+
+        for num_stops in [21, 40]:
+            for bucket_d in [1 / 24, 7 / 1440]:
+                for max_diff_continuous_data_s in [None, 240]:
+                    expected = process_vehicle_locations_reference(points, num_stops, params, max_diff_continuous_data_s)
+                    self.assertTrue(expected['gap-data'] and expected['invalid-data'])
+                    self.assertTrue(any(isinstance(vehicle_id, str) for vehicle_id in expected['data']))
+
+                    # Buckets of points of all vehicles, as read from the db
+                    buckets = {}
+                    for point in points:
+                        buckets.setdefault(int(point[1] // bucket_d), []).append(point)
+                    processed = [
+                        create_plot._process_bucket(
+                            *create_plot._points_to_arrays(sorted(bucket_points, key=lambda point: point[:2])), num_stops, params, max_diff_continuous_data_s,
+                        )
+                        for _, bucket_points in sorted(buckets.items())
+                    ]
+
+                    self.assertSameData(create_plot._stitch_buckets(processed, num_stops, params, max_diff_continuous_data_s), expected, is_ordered=False)
+
+
+class WritePalettePngTests(SimpleTestCase):
+
+    def write_and_read(self, rgb):
+        rgba = np.dstack([rgb, np.full(rgb.shape[:2], 255, dtype=np.uint8)])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir, 'plot.png')
+            num_colours = create_plot._write_palette_png(filename, rgba, create_plot.params.dpi)
+            with Image.open(filename) as image:
+                self.assertEqual(image.mode, 'P')
+                return num_colours, np.asarray(image.convert('RGB'))
+
+    def test_exact_palette(self):
+        rng = np.random.default_rng(0)
+        colours = rng.integers(0, 256, (200, 3), dtype=np.uint8)
+        rgb = colours[rng.integers(0, len(colours), (50, 80))]
+
+        num_colours, written = self.write_and_read(rgb)
+        self.assertEqual(num_colours, len(np.unique(colours, axis=0)))
+        np.testing.assert_array_equal(written, rgb)
+
+    def test_quantized(self):
+        # Anti-aliased grey and blue gradients
+        rgb = np.zeros((50, 600, 3), dtype=np.uint8)
+        rgb[:25] = np.linspace(0, 255, 600)[:, None].astype(np.uint8)
+        rgb[25:] = np.stack([np.linspace(31, 255, 600), np.linspace(119, 255, 600), np.full(600, 180)], axis=-1).astype(np.uint8)
+
+        num_colours, written = self.write_and_read(rgb)
+        self.assertIsNone(num_colours)
+        self.assertLessEqual(np.abs(written.astype(int) - rgb).max(), 16)
+
+
+class EncodeLineTests(SimpleTestCase):
+
+    def test_encode_line(self):
+        date_from = 730000.
+        line = np.array([
+            [date_from + 20 / 86400, 1.234],
+            [date_from + 40 / 86400, 1.236],
+            [date_from + 40.2 / 86400, 1.2361],  # The same point after quantization
+            [date_from + 60 / 86400, 1.5],
+            [date_from + 90 / 86400, np.nan],
+            [date_from + 120 / 86400, 2.],
+            [date_from + 140 / 86400, 1.99],
+        ])
+
+        parts = create_plot._encode_line(line, date_from)
+        self.assertEqual(parts, [[20, 123, 20, 1, 20, 26], [120, 200, 20, -1]])
+
+
+@override_settings(LOCATIONS_ARCHIVE_DIR=None)
+class RenderBackgroundTests(TestCase):
+
+    def setUp(self):
+        route = Route.objects.create(line='1')
+        for ind in range(3):
+            Stop.objects.create(route=route, route_index=ind, name=f'S{ind}', display_name=f'S{ind}', latitude=51., longitude=17. + ind / 1000, radius_m=20)
+
+        date_ = datetime(2001, 2, 3, 10, 0, tzinfo=pytz.utc)
+        for ind in range(20):
+            VehicleLocation.objects.create(
+                route=route, vehicle_id=7, date=date_ + timedelta(minutes=ind), latitude=51., longitude=17., is_processed=True,
+                is_at_stop=False, current_stop=route.stop_set.get(route_index=ind // 10), to_next_stop_ratio=ind % 10 / 10,
+                route_position=ind / 10,
+            )
+
+        create_plot._render_background.cache_clear()
+        self.addCleanup(create_plot._render_background.cache_clear)
+
+    def render(self, date_from, date_to):
+        """ Returns the RGB pixels of the plot of line 1 """
+        date_from, date_to = (settings.LOCAL_TIMEZONE.localize(d) for d in (date_from, date_to))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = os.path.join(tmp_dir, 'plot.png')
+            create_plot.create_plot('1', date_from, date_to, filename)
+            with Image.open(filename) as image:
+                return np.asarray(image.convert('RGB'))
+
+    def test_cached_background(self):
+        period = (datetime(2001, 2, 3, 10, 30), datetime(2001, 2, 3, 11, 30))
+
+        # Rendered with a new background
+        expected = self.render(*period)
+        self.assertEqual(create_plot._render_background.cache_info().misses, 1)
+
+        # Rendered on the background cached by a plot of another period
+        create_plot._render_background.cache_clear()
+        self.render(datetime(2001, 2, 3, 10, 0), datetime(2001, 2, 3, 12, 0))
+        pixels = self.render(*period)
+        self.assertEqual(create_plot._render_background.cache_info().hits, 1)
+        np.testing.assert_array_equal(pixels, expected)
+
+        # The stop names of the background show through the transparent figure
+        height, width, _ = pixels.shape
+        bottom_edge = int((1. - create_plot.params.canvas_bottom_edge_n) * height)
+        left_edge = int(create_plot.params.canvas_left_edge_n * width)
+        self.assertTrue((pixels[:bottom_edge, :left_edge] < 128).any())
+
+
+@override_settings(RENDER_SERVICE_ADDRESS=None, LOCATIONS_ARCHIVE_DIR=None)
+class PlotDataViewTests(TestCase):
+
+    def setUp(self):
+        route = Route.objects.create(line='1')
+        for ind in range(3):
+            Stop.objects.create(route=route, route_index=ind, name=f'S{ind}', display_name=f'S{ind}', latitude=51., longitude=17. + ind / 1000, radius_m=20)
+
+    def test_invalid_params(self):
+        for params in [{}, {'line': '2', 'date_from': '-2hours', 'date_to': 'now'}, {'line': '1', 'date_from': 'x', 'date_to': 'now'}]:
+            response = self.client.get(reverse('mpk:data'), params)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('error', response.json())
+
+    def test_data(self):
+        response = self.client.get(reverse('mpk:data'), {'line': '1', 'date_from': '2001-02-03 10:00', 'date_to': '2001-02-03 12:00'})
+        self.assertEqual(response.status_code, 200)
+
+        data = response.json()
+        self.assertEqual(data['duration_s'], 7200)
+        self.assertEqual(data['stops'], ['S0', 'S1', 'S2'])
+        self.assertEqual(data['lines'], {'data': [], 'gap-data': [], 'invalid-data': []})
+        self.assertIsNone(data['watermark_s'])
+        self.assertTrue(data['no_data_msg'])
+
+
+class LiveTests(TestCase):
+
+    def setUp(self):
+        self.route = Route.objects.create(line='1')
+        self.date = datetime(2001, 2, 3, 10, 0, tzinfo=pytz.utc)
+
+    def add_locations(self, seconds, vehicle_id=7, route_position=1.5):
+        VehicleLocation.objects.bulk_create([
+            VehicleLocation(
+                route=self.route, vehicle_id=vehicle_id, date=self.date + timedelta(seconds=s), latitude=51., longitude=17.,
+                is_processed=route_position is not None, route_position=route_position,
+            )
+            for s in seconds
+        ])
+
+    def test_get_update(self):
+        since = self.date.timestamp()
+
+        # No locations
+        update = live.get_update(self.route, since, 3600)
+        self.assertEqual((update['watermark_s'], update['points']), (since, []))
+
+        # Processed locations after since; unprocessed ones advance the watermark only
+        self.add_locations([0, 20, 40])
+        self.add_locations([40], vehicle_id=8, route_position=None)
+        update = live.get_update(self.route, since, 3600)
+        self.assertEqual(update['watermark_s'], since + 40)
+        self.assertEqual(update['points'], [[7, round(since) + 20, 150], [7, round(since) + 40, 150]])
+        self.assertEqual(update['interval_s'], settings.COLLECT_LOCATIONS_INTERVAL_S)
+
+        # Nothing new
+        update = live.get_update(self.route, since + 40, 3600)
+        self.assertEqual((update['watermark_s'], update['points']), (since + 40, []))
+
+    def test_view(self):
+        self.add_locations([0, 20])
+        response = self.client.get(reverse('mpk:live'), {'line': '1', 'since': self.date.timestamp(), 'duration_s': 3600})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['points'], [[7, round(self.date.timestamp()) + 20, 150]])
+
+        for params in [{'line': '1', 'duration_s': 3600}, {'line': '2', 'since': 0, 'duration_s': 3600}, {'line': '1', 'since': 'x', 'duration_s': 3600}]:
+            response = self.client.get(reverse('mpk:live'), params)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('error', response.json())
+
+
+class PlotCacheTests(TestCase):
+
+    def setUp(self):
+        self.route = Route.objects.create(line='1')
+        self.date = datetime(2001, 2, 3, 10, 0, tzinfo=pytz.utc)
+
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=tmp_dir.name, RENDER_SERVICE_ADDRESS=None, PLOT_CLIENT_RENDERING=False)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def get_key(self):
+        return plot_cache.get_plot_key('1', self.date - timedelta(hours=1), self.date)
+
+    def test_plot_key(self):
+        keys = [self.get_key()]
+
+        # New location
+        VehicleLocation.objects.create(route=self.route, vehicle_id=7, date=self.date - timedelta(minutes=1), latitude=51., longitude=17., is_processed=False)
+        keys.append(self.get_key())
+
+        # Plot parameters
+        with mock.patch.object(plot_cache.Params, 'VERSION', plot_cache.Params.VERSION + 1):
+            keys.append(self.get_key())
+
+        # Modified route
+        Route.objects.filter(id=self.route.id).update(date_modified=self.route.date_modified + timedelta(seconds=1))
+        keys.append(self.get_key())
+
+        # Past locations changed
+        segment_cache.invalidate_routes([self.route.id])
+        keys.append(self.get_key())
+
+        self.assertEqual(len(set(keys)), len(keys))
+        self.assertEqual(self.get_key(), keys[-1])
+
+    def test_cached_plot_not_rendered(self):
+        def render(line_no, date_from, date_to, filename):
+            with open(filename, 'wb') as f:
+                f.write(b'png')
+
+        params = {'line': '1', 'date_from': '2001-02-03 10:00', 'date_to': '2001-02-03 11:00'}
+        with mock.patch('mpk.apps.mpk.render_service.render', side_effect=render) as render_mock:
+            for _ in range(2):
+                response = self.client.post(reverse('mpk:home'), params)
+                self.assertTrue(response.context['success'])
+        self.assertEqual(render_mock.call_count, 1)
+        self.assertEqual(len(os.listdir(plot_cache.get_cache_dir())), 1)
+
+    def test_evict(self):
+        os.makedirs(plot_cache.get_cache_dir())
+        now = time.time()
+
+        # The least recently used plot is above the size limit, and another one is too old
+        ages_s = {'a': 10, 'b': 20, 'c': 30, 'd': settings.PLOT_CACHE_MAX_AGE_S + 10}
+        for key, age_s in ages_s.items():
+            filename = plot_cache.get_plot_filename(key)
+            with open(filename, 'wb') as f:
+                f.write(bytes(400 << 10))
+            os.utime(filename, (now - age_s, now - age_s))
+
+        with self.settings(PLOT_CACHE_MAX_SIZE_MB=1):
+            plot_cache.evict()
+        self.assertEqual(sorted(os.listdir(plot_cache.get_cache_dir())), ['a.png', 'b.png'])
+
+
+class FakePool:
+    """ Runs jobs at once, or raises error when their result is requested """
+
+    def __init__(self, error=None):
+        self.error = error
+
+    def apply_async(self, func, args):
+        job, deadline = args
+        return mock.Mock(get=mock.Mock(return_value=job[1:], side_effect=self.error))
+
+
+class RenderServiceTests(SimpleTestCase):
+
+    def _send_job(self, pool, slots, job=('plot', '1', 'from', 'to')):
+        """ Sends job to _handle_connection, as render_service.Client does, and returns the reply """
+        server_conn, conn = Pipe()
+        thread = threading.Thread(target=render_service._handle_connection, args=(server_conn, pool, slots))
+        thread.start()
+
+        with conn:
+            answer_challenge(conn, render_service._get_authkey())
+            deliver_challenge(conn, render_service._get_authkey())
+            conn.send(job)
+            reply = conn.recv()
+        thread.join()
+        return reply
+
+    def test_ok(self):
+        slots = threading.BoundedSemaphore(1)
+        self.assertEqual(self._send_job(FakePool(), slots), ('ok', ('1', 'from', 'to')))
+
+        # The slot is released
+        self.assertTrue(slots.acquire(blocking=False))
+
+    def test_busy(self):
+        slots = threading.BoundedSemaphore(1)
+        slots.acquire()
+        self.assertEqual(self._send_job(FakePool(), slots), ('busy', None))
+
+    def test_error(self):
+        slots = threading.BoundedSemaphore(1)
+        self.assertEqual(self._send_job(FakePool(ValueError('Invalid line')), slots), ('error', 'Invalid line'))
+        self.assertTrue(slots.acquire(blocking=False))
+
+    def test_timeout(self):
+        slots = threading.BoundedSemaphore(1)
+        with self.assertLogs('default', 'ERROR'):
+            reply = self._send_job(FakePool(multiprocessing.TimeoutError()), slots)
+        self.assertEqual(reply, ('error', 'Creating the plot took too long'))
+        self.assertTrue(slots.acquire(blocking=False))
+
+    def test_unauthenticated(self):
+        server_conn, conn = Pipe()
+        thread = threading.Thread(target=render_service._handle_connection, args=(server_conn, FakePool(), threading.BoundedSemaphore(1)))
+        thread.start()
+
+        with conn, self.assertLogs('default', 'WARNING'):
+            self.assertRaises(multiprocessing.AuthenticationError, answer_challenge, conn, b'invalid')
+            thread.join()
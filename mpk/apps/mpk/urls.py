@@ -5,6 +5,8 @@ from . import views
 
 app_name = 'mpk'
 urlpatterns = [
+    url(r'^live/$', views.LiveView.as_view(), name='live'),
+    url(r'^data/$', views.PlotDataView.as_view(), name='data'),
     url(r'$', views.HomeView.as_view(), name='home'),
 ]
 
@@ -1,19 +1,17 @@
 import logging
-import os
-import random
-import shlex
-import string
-import subprocess
 import time
-from datetime import datetime
+from urllib.parse import urlencode
 
 from django.conf import settings
+from django.http import JsonResponse
 from django.shortcuts import render
-from django.views.generic import FormView
+from django.urls import reverse
+from django.views.generic import FormView, View
 
-from mpk.script.create_plot.create_plot import create_plot
+from routes.models import Route
 
-from .forms import ProcessForm
+from mpk.apps.mpk import live, plot_cache, render_service
+from mpk.apps.mpk.forms import ProcessForm
 
 
 logger = logging.getLogger('default')
@@ -43,20 +41,10 @@ class HomeView(FormView):
         return context
 
     def form_valid(self, form):
-        current_time = datetime.now()
-
         # Processing arguments
         line_no = form.cleaned_data['line']
         date_from, date_to = form.cleaned_data['date_from'], form.cleaned_data['date_to']
 
-        # Directory and filename
-        location = ''.join(random.choices(string.ascii_letters, k=6))
-        location_ext = '{}-{}'.format(current_time.strftime('%y%m%d-%H%M'), location)
-        out_dir = f'{settings.MEDIA_ROOT}/{location_ext}'
-        plot_fn = '{:0>3s}--{}--{}.png'.format(line_no, date_from.strftime('%y%m%d-%H%M'), date_to.strftime('%y%m%d-%H%M'))
-        plot_filename = f'{out_dir}/{plot_fn}'
-        django_plot_location = f'{settings.MEDIA_URL}/{location_ext}/{plot_fn}'
-
         # Process
         context = self.get_std_context_data()
         context.update({
@@ -66,12 +54,28 @@ class HomeView(FormView):
         })
 
         try:
-            logger.info(f'Running {line_no} {date_from} -- {date_to} {out_dir}')
-            logger.debug(f'Creating out-dir {out_dir}')
-            os.makedirs(out_dir)
-
-            # Create plot
-            create_plot(line_no, date_from, date_to, plot_filename)
+            if settings.PLOT_CLIENT_RENDERING:
+                # The plot is drawn by the browser
+                plot_key = None
+                logger.info(f'Running {line_no} {date_from} -- {date_to} (client)')
+                context['data_url'] = '{}?{}'.format(reverse('mpk:data'), urlencode({
+                    'line': line_no,
+                    'date_from': date_from.strftime('%Y-%m-%d %H:%M'),
+                    'date_to': date_to.strftime('%Y-%m-%d %H:%M'),
+                }))
+                if form.date_to_is_now:
+                    context['live_url'] = '{}?{}'.format(reverse('mpk:live'), urlencode({
+                        'line': line_no,
+                        'duration_s': int((date_to - date_from).total_seconds()),
+                    }))
+            else:
+                # Cached plot, or a new one
+                plot_key = plot_cache.get_plot_key(line_no, date_from, date_to)
+                is_cached = plot_cache.get_cached_plot(plot_key)
+                logger.info('Running {} {} -- {} {}{}'.format(line_no, date_from, date_to, plot_key, ' (cached)' if is_cached else ''))
+                if not is_cached:
+                    plot_cache.add_plot(plot_key, lambda filename: render_service.render(line_no, date_from, date_to, filename))
+                context['plot_path'] = plot_cache.get_plot_url(plot_key)
 
             # Calculate previous/next plot time ranges
             plot_length = date_to - date_from if form.date_from_timedelta is None else form.date_from_timedelta[1]
@@ -82,7 +86,6 @@ class HomeView(FormView):
 
             context.update({
                 'success': True,
-                'plot_path': django_plot_location,
                 'line': line_no,
                 'prev_plot_from': prev_plot_from,
                 'prev_plot_to': prev_plot_to,
@@ -90,19 +93,16 @@ class HomeView(FormView):
                 'next_plot_to': next_plot_to,
             })
 
-            # Mogrify
-            if settings.RUN_MOGRIFY:
-                cmd = f'mogrify -alpha off -colors 256 {plot_filename}'
-
-                logger.debug(f'Running mogrify {cmd}')
-                cmd_args = shlex.split(cmd)
-                ret = subprocess.call(cmd_args, close_fds=False)
-                if ret:
-                    raise RuntimeError(f'{cmd} returned {ret}')
-
             # Log processing time
             total_time = time.time() - self.start_time
-            logger.info(f'Processing finished   {location_ext}; Total time {total_time:.2f}s.')
+            logger.info(f'Processing finished   {plot_key}; Total time {total_time:.2f}s.')
+
+        except render_service.RenderServiceBusy as exc:
+            context.update({
+                'success': False,
+                'error': str(exc),
+            })
+            logger.warning(str(exc))
 
         except Exception as exc:
             context.update({
@@ -113,3 +113,50 @@ class HomeView(FormView):
 
         return render(self.request, self.template_name, context=context)
 
+
+class PlotDataView(View):
+    """ Data of the plot of a line, drawn by browsers (see create_plot.get_plot_data); takes ProcessForm fields as GET parameters
+
+    Data are created by render_service, with the same limits of concurrent jobs and of their duration as rendered plots.
+    """
+
+    def get(self, request, *args, **kwargs):
+        start_time = time.time()
+
+        form = ProcessForm(request.GET)
+        if not form.is_valid():
+            return JsonResponse({'error': ' '.join(error for errors in form.errors.values() for error in errors)}, status=400)
+
+        line_no = form.cleaned_data['line']
+        date_from, date_to = form.cleaned_data['date_from'], form.cleaned_data['date_to']
+
+        try:
+            data = render_service.get_plot_data(line_no, date_from, date_to)
+        except render_service.RenderServiceBusy as exc:
+            logger.warning(str(exc))
+            return JsonResponse({'error': str(exc)}, status=503)
+        except Exception as exc:
+            logger.exception(exc)
+            return JsonResponse({'error': str(exc)}, status=500)
+
+        total_time = time.time() - start_time
+        logger.info(f'Data of {line_no} {date_from} -- {date_to}; Total time {total_time:.2f}s.')
+
+        return JsonResponse(data)
+
+
+class LiveView(View):
+    """ New locations of a line, for plots ending now (see mpk.live); answered at once, browsers poll it
+
+    GET parameters are line, duration_s of the plot and since, the watermark of the plot or of the previous update.
+    """
+
+    def get(self, request, *args, **kwargs):
+        try:
+            route = Route.objects.get(line=request.GET['line'])
+            since = float(request.GET['since'])
+            duration_s = min(float(request.GET['duration_s']), settings.MAX_PLOT_INTERVAL.total_seconds())
+        except (KeyError, ValueError, Route.DoesNotExist) as exc:
+            return JsonResponse({'error': f'Invalid parameters: {exc}'}, status=400)
+
+        return JsonResponse(live.get_update(route, since, duration_s))
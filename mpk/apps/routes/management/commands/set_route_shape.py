@@ -0,0 +1,76 @@
+"""
+Sets the shape of a route from a GTFS shapes.txt file; the shape is used by the shape position engine.
+The shape has to go in the direction of the route's stops (the outward route).
+"""
+import csv
+import json
+import warnings
+
+from django.conf import settings
+from django.core.management import BaseCommand
+
+from lib import warn
+from routes.models import Route
+from vehicle_locations.geometry import RouteShape
+
+from .add_route import DATA_DIR
+
+
+warnings.formatwarning = warn.format_warning
+
+
+def read_shape_file(filename, shape_id):
+    """ Returns a list of (lat, lng) points of shape shape_id """
+    points = []
+
+    with open(filename) as f:
+        reader = csv.DictReader(f)
+        for point in reader:
+            if point['shape_id'] == shape_id:
+                points.append((int(point['shape_pt_sequence']), float(point['shape_pt_lat']), float(point['shape_pt_lon'])))
+
+    if not points:
+        raise ValueError(f'Shape "{shape_id}" not found')
+
+    return [(lat, lng) for _, lat, lng in sorted(points)]
+
+
+def check_if_stops_on_shape(route):
+    stops = list(route.stop_set.all().order_by('route_index'))
+    shape = RouteShape(stops, route.get_shape_points())
+
+    for stop, stop_dist in zip(stops, shape.stop_shape_dist):
+        if stop_dist > settings.SHAPE_MAX_DIST_M:
+            warnings.warn('Stop ({}) is {:.2f}m from the shape'.format(stop, stop_dist))
+
+
+class Command(BaseCommand):
+
+    def add_arguments(self, parser):
+        parser.add_argument('line_no')
+        parser.add_argument('shape_id', nargs='?')
+        parser.add_argument('-f', '--shapes-file', dest='shapes_file', default=f'{DATA_DIR}/shapes.txt', help='GTFS shapes file')
+        parser.add_argument('-c', '--clear', dest='clear', action='store_true', help='Clear the shape; stops are used instead')
+
+    def handle(self, *args, **kwargs):
+        # Parse arguments
+        line_no = kwargs['line_no']
+        shape_id = kwargs['shape_id']
+        shapes_file = kwargs['shapes_file']
+        clear = kwargs['clear']
+
+        if clear == (shape_id is not None):
+            raise ValueError('Exactly one of shape_id and -c has to be given')
+
+        route = Route.objects.get(line=line_no)
+
+        # Save; modifying the route makes the collector reload it
+        if clear:
+            route.shape = None
+        else:
+            points = read_shape_file(shapes_file, shape_id)
+            route.shape = json.dumps([[round(lat, 6), round(lng, 6)] for lat, lng in points])
+        route.save()
+        print('{} shape of {}'.format('Cleared' if clear else f'Set {len(points)}-point', route))
+
+        check_if_stops_on_shape(route)
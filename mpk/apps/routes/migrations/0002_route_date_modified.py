@@ -0,0 +1,18 @@
+# Generated by Django 2.2.17 on 2026-10-18 05:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('routes', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='route',
+            name='date_modified',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
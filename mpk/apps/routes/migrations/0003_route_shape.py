@@ -0,0 +1,18 @@
+# Generated by Django 2.2.17 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('routes', '0002_route_date_modified'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='route',
+            name='shape',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
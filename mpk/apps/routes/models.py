@@ -1,11 +1,21 @@
+import json
+
 from django.db import models
 
 
 class Route(models.Model):
     line = models.CharField(max_length=5, unique=True)
+    shape = models.TextField(null=True, blank=True)  # JSON list of [lat, lng] points; see set_route_shape
+    date_modified = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return 'Route {}'.format(
             self.line,
         )
 
+    def get_shape_points(self):
+        """ Returns a list of (lat, lng) points of the route shape, or None if it isn't set """
+        if self.shape is None:
+            return None
+
+        return [tuple(point) for point in json.loads(self.shape)]
@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 
 from routes.models import Route
 
@@ -21,6 +22,21 @@ class Stop(models.Model):
             'route_index',
         ]
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.touch_route()
+
+    def delete(self, *args, **kwargs):
+        ret = super().delete(*args, **kwargs)
+        self.touch_route()
+        return ret
+
+    def touch_route(self):
+        """ Updates the modification date of the route, so that routes with changed stops are reloaded by collect_locations
+        (bulk changes of stops have to do it themselves)
+        """
+        Route.objects.filter(id=self.route_id).update(date_modified=timezone.now())
+
     def __str__(self):
         return 'Stop {:>2} {:02d}: {}: {:.6f} {:.6f} {}'.format(
             self.route.line,
@@ -0,0 +1,370 @@
+"""
+Archives of vehicle locations (PostgreSQL only).
+Locations of local day d are dumped with COPY to OUT_DIR/loc-YYYYMMDD.dump.gz (or .dump.zst). The dump is split into chunks
+of whole rows, compressed in parallel; each chunk is a separate gzip member or zstd frame, so the file is a valid
+gzip/zstd stream. Files are written to a temporary file and renamed; the manifest OUT_DIR/loc-YYYYMMDD.manifest.json,
+written last, records the number of rows, the checksum of the file and its chunks.
+A day is deleted from the db only if the manifest matches the file and the db, so interrupted runs can be resumed.
+Archived locations are read through a sidecar index OUT_DIR/loc-YYYYMMDD.index.json, listing for each route and hour
+the chunks containing its locations, so that only these chunks are decompressed. Dumps of the previous archiver
+(without a manifest) are a single chunk; their indexes are built by convert_archives.
+"""
+import gzip
+import hashlib
+import json
+import math
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytz
+from django.conf import settings
+from django.db import connection, transaction
+
+from lib.pg import parse_timestamptz
+
+from .models import VehicleLocation
+
+
+LOCATION_TABLE = VehicleLocation._meta.db_table
+
+# Columns of dumps without a manifest
+LEGACY_COLUMNS = [
+    'id', 'vehicle_id', 'date', 'date_added', 'latitude', 'longitude', 'is_processed', 'unprocessed_reason',
+    'is_at_stop', 'to_next_stop_ratio', 'current_stop_id', 'route_id',
+]
+INDEX_VERSION = 1
+
+COMPRESSIONS = {
+    'gzip': {'extension': 'gz', 'default_level': 6},
+    'zstd': {'extension': 'zst', 'default_level': 3},
+}
+
+
+def get_day_range(day):
+    """ Returns (start, end) of local day day in UTC """
+    start, end = (
+        settings.LOCAL_TIMEZONE.localize(datetime.combine(d, datetime.min.time())).astimezone(pytz.utc)
+        for d in (day, day + timedelta(days=1))
+    )
+    return start, end
+
+
+def get_archive_filenames(out_dir, day, compression):
+    """ Returns names of the dump and the manifest of local day day """
+    day_str = day.strftime('%Y%m%d')
+    return (
+        '{}/loc-{}.dump.{}'.format(out_dir, day_str, COMPRESSIONS[compression]['extension']),
+        f'{out_dir}/loc-{day_str}.manifest.json',
+    )
+
+
+def compress(data, compression, level):
+    if compression == 'gzip':
+        return gzip.compress(data, compresslevel=level, mtime=0)
+
+    import zstandard
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def decompress_chunk(data, compression):
+    if compression == 'gzip':
+        return gzip.decompress(data)
+
+    import zstandard
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+class ChunkedCompressedWriter:
+    """ File-like object compressing written data in chunks of whole lines, in parallel, and writing them in order to f
+
+    At most 2 * num_threads chunks are kept in memory.
+    """
+
+    def __init__(self, f, compression, level, num_threads, chunk_size):
+        self.f = f
+        self.compression, self.level = compression, level
+        self.chunk_size = chunk_size
+        self.executor = ThreadPoolExecutor(max_workers=num_threads)
+        self.max_pending = 2 * num_threads
+
+        self.buffer = bytearray()
+        self.pending = deque()  # (future, num-rows, raw-size)
+        self.sha256 = hashlib.sha256()
+        self.offset = 0
+        self.chunks = []
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.chunk_size:
+            end = self.buffer.rfind(b'\n') + 1
+            if end:
+                self._submit(bytes(self.buffer[:end]))
+                del self.buffer[:end]
+
+    def _submit(self, data):
+        while len(self.pending) >= self.max_pending:
+            self._write_next()
+
+        self.pending.append((self.executor.submit(compress, data, self.compression, self.level), data.count(b'\n'), len(data)))
+
+    def _write_next(self):
+        future, num_rows, raw_size = self.pending.popleft()
+        compressed = future.result()
+
+        self.f.write(compressed)
+        self.sha256.update(compressed)
+        self.chunks.append({'offset': self.offset, 'size': len(compressed), 'raw_size': raw_size, 'rows': num_rows})
+        self.offset += len(compressed)
+
+    def close(self):
+        """ Writes the remaining data; returns the list of chunks """
+        try:
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.pending:
+                self._write_next()
+        finally:
+            self.executor.shutdown()
+
+        return self.chunks
+
+
+def dump_day(day, out_dir, compression, level, num_threads, chunk_size):
+    """ Dumps locations of local day day; returns the manifest """
+    filename, manifest_filename = get_archive_filenames(out_dir, day, compression)
+    start, end = get_day_range(day)
+
+    # Remove the manifest first, so that a failed dump isn't taken for a complete one
+    if os.path.exists(manifest_filename):
+        os.remove(manifest_filename)
+
+    # Dump
+    query = 'copy (select * from {} where date >= \'{}\' and date < \'{}\' order by date) to stdout'.format(
+        LOCATION_TABLE, start.isoformat(), end.isoformat(),
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(f'select * from {LOCATION_TABLE} limit 0')
+        columns = [col[0] for col in cursor.description]
+
+    tmp_filename = f'{filename}.tmp'
+    with open(tmp_filename, 'wb') as f:
+        writer = ChunkedCompressedWriter(f, compression, level, num_threads, chunk_size)
+        try:
+            with connection.cursor() as cursor:
+                cursor.copy_expert(query, writer)
+        finally:
+            chunks = writer.close()
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+    manifest = {
+        'day': day.isoformat(),
+        'date_from': start.isoformat(),
+        'date_to': end.isoformat(),
+        'filename': os.path.basename(filename),
+        'compression': compression,
+        'level': level,
+        'columns': columns,
+        'rows': sum(chunk['rows'] for chunk in chunks),
+        'size': sum(chunk['size'] for chunk in chunks),
+        'sha256': writer.sha256.hexdigest(),
+        'chunks': chunks,
+    }
+    write_manifest(manifest_filename, manifest)
+
+    return manifest
+
+
+def write_manifest(manifest_filename, manifest):
+    # Processes writing the same file don't share the temporary file
+    tmp_filename = f'{manifest_filename}.{os.getpid()}.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(manifest, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, manifest_filename)
+
+
+def read_manifest(manifest_filename):
+    """ Returns the manifest, or None if it doesn't exist """
+    if not os.path.exists(manifest_filename):
+        return None
+
+    with open(manifest_filename) as f:
+        return json.load(f)
+
+
+def get_file_sha256(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+
+    return sha256.hexdigest()
+
+
+def is_dump_valid(manifest, out_dir):
+    """ Checks if the dump file exists and matches the manifest """
+    filename = '{}/{}'.format(out_dir, manifest['filename'])
+    return os.path.isfile(filename) and os.path.getsize(filename) == manifest['size'] and get_file_sha256(filename) == manifest['sha256']
+
+
+def count_day_rows(day):
+    start, end = get_day_range(day)
+    return VehicleLocation.objects.filter(date__gte=start, date__lt=end).count()
+
+
+def delete_day(day, batch_size, pause_s):
+    """ Deletes locations of local day day in batches, each in its own transaction; returns the number of deleted rows
+
+    Batches are deleted in order of date, so that the db keeps the end of the day until the day is deleted.
+    """
+    start, end = get_day_range(day)
+    query = (
+        'delete from {0} where (route_id, vehicle_id, date) in '
+        '(select route_id, vehicle_id, date from {0} where date >= %s and date < %s order by date limit %s)'
+    ).format(LOCATION_TABLE)
+
+    num_deleted = 0
+    while True:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(query, [start, end, batch_size])
+            num_batch = cursor.rowcount
+        num_deleted += num_batch
+        if num_batch < batch_size:
+            return num_deleted
+
+        # Let ingestion and autovacuum keep up
+        time.sleep(pause_s)
+
+
+## Reading
+def get_index_filename(out_dir, day):
+    return '{}/loc-{}.index.json'.format(out_dir, day.strftime('%Y%m%d'))
+
+
+def find_dump(out_dir, day):
+    """ Returns (dump-filename, manifest) of local day day; manifest is None for dumps of the previous archiver
+
+    Returns (None, None) if there's no dump.
+    """
+    _, manifest_filename = get_archive_filenames(out_dir, day, 'gzip')
+    manifest = read_manifest(manifest_filename)
+    if manifest is not None:
+        return '{}/{}'.format(out_dir, manifest['filename']), manifest
+
+    filename, _ = get_archive_filenames(out_dir, day, 'gzip')
+    if os.path.isfile(filename):
+        return filename, None
+
+    return None, None
+
+
+def iter_chunk_rows(f, chunk, compression, columns):
+    """ Yields rows (dicts of column: text-value, None for nulls) of chunk of open dump f """
+    f.seek(chunk['offset'])
+    data = decompress_chunk(f.read(chunk['size']), compression)
+
+    for line in data.decode().splitlines():
+        yield {col: (None if val == '\\N' else val) for col, val in zip(columns, line.split('\t'))}
+
+
+def get_row_position(row, stop_inds):
+    """ Returns the route position of row, or None if it's unknown
+
+    Positions of dumps from before route_position was stored are calculated from the current stop, with stop_inds
+    a dict of stop-id: route-index; they're unknown if the stop has been deleted since.
+    """
+    if row.get('route_position') is not None:
+        return float(row['route_position'])
+    if row['is_processed'] != 't' or row['current_stop_id'] is None or int(row['current_stop_id']) not in stop_inds:
+        return None
+    return stop_inds[int(row['current_stop_id'])] + (0. if row['is_at_stop'] == 't' else float(row['to_next_stop_ratio']))
+
+
+def build_index(out_dir, day):
+    """ Builds and saves the index of the dump of local day day; returns the index, or None if there's no dump """
+    filename, manifest = find_dump(out_dir, day)
+    if filename is None:
+        return None
+
+    if manifest is None:
+        compression, columns, chunks = 'gzip', LEGACY_COLUMNS, [{'offset': 0, 'size': os.path.getsize(filename)}]
+    else:
+        compression, columns, chunks = manifest['compression'], manifest['columns'], manifest['chunks']
+
+    index_chunks, routes = [], {}
+    with open(filename, 'rb') as f:
+        for chunk_ind, chunk in enumerate(chunks):
+            for row in iter_chunk_rows(f, chunk, compression, columns):
+                hour = int(parse_timestamptz(row['date']).timestamp()) // 3600
+                chunk_inds = routes.setdefault(row['route_id'], {}).setdefault(str(hour), [])
+                if not chunk_inds or chunk_inds[-1] != chunk_ind:
+                    chunk_inds.append(chunk_ind)
+            index_chunks.append({'offset': chunk['offset'], 'size': chunk['size']})
+
+    index = {
+        'version': INDEX_VERSION,
+        'filename': os.path.basename(filename),
+        'size': os.path.getsize(filename),
+        'compression': compression,
+        'columns': columns,
+        'chunks': index_chunks,
+        'routes': routes,
+    }
+    write_manifest(get_index_filename(out_dir, day), index)
+
+    return index
+
+
+def get_index(out_dir, day):
+    """ Returns the index of the dump of local day day, or None if there's no dump or its index doesn't exist or is
+    out of date
+
+    Indexes are built only by archive_old_locations and convert_archives, before records of the day are deleted from
+    the db; days without an index aren't read from archives.
+    """
+    index = read_manifest(get_index_filename(out_dir, day))
+    filename, _ = find_dump(out_dir, day)
+    if index is None or filename is None:
+        return None
+
+    if index['version'] != INDEX_VERSION or index['filename'] != os.path.basename(filename) or index['size'] != os.path.getsize(filename):
+        return None
+
+    return index
+
+
+def read_archived_locations(out_dir, route_id, date_from, date_to, indexes=None):
+    """ Yields archived locations (dicts of column: text-value) of route route_id between date_from and date_to
+
+    indexes is an optional dict of local-day: index of days to read; other days are skipped.
+    """
+    day = date_from.astimezone(settings.LOCAL_TIMEZONE).date()
+    while get_day_range(day)[0] < date_to:
+        index = get_index(out_dir, day) if indexes is None else indexes.get(day)
+        day += timedelta(days=1)
+        if index is None or str(route_id) not in index['routes']:
+            continue
+
+        # Chunks of the requested hours
+        route_hours = index['routes'][str(route_id)]
+        chunk_inds = sorted({
+            chunk_ind
+            for hour in range(int(date_from.timestamp()) // 3600, math.ceil(date_to.timestamp() / 3600))
+            for chunk_ind in route_hours.get(str(hour), [])
+        })
+
+        with open('{}/{}'.format(out_dir, index['filename']), 'rb') as f:
+            for chunk_ind in chunk_inds:
+                for row in iter_chunk_rows(f, index['chunks'][chunk_ind], index['compression'], index['columns']):
+                    if row['route_id'] != str(route_id):
+                        continue
+                    row['date'] = parse_timestamptz(row['date'])
+                    if date_from <= row['date'] < date_to:
+                        yield row
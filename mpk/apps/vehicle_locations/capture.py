@@ -0,0 +1,109 @@
+"""
+Capture log of raw responses of the locations feed.
+Responses are appended to daily files (days in local timezone) FEED_CAPTURE_DIR/feed-YYYYMMDD.log.gz;
+each response is a separate gzip member containing a single line: epoch-of-the-Date-header<TAB>response-json.
+Members are read one by one, so responses cut off by a killed process are skipped.
+Capturing is disabled if FEED_CAPTURE_DIR is None.
+"""
+import gzip
+import json
+import logging
+import os
+import threading
+import zlib
+from datetime import datetime
+
+import pytz
+from django.conf import settings
+
+
+logger = logging.getLogger('get-locations')
+
+
+GZIP_MAGIC = b'\x1f\x8b\x08'
+READ_SIZE = 1 << 16
+
+_write_lock = threading.Lock()
+
+
+def get_capture_filename(date_, capture_dir=None):
+    """ Returns name of the capture file for local date date_ """
+    capture_dir = settings.FEED_CAPTURE_DIR if capture_dir is None else capture_dir
+    return '{}/feed-{}.log.gz'.format(capture_dir, date_.strftime('%Y%m%d'))
+
+
+def append_capture(date_created, content):
+    """ Appends response content received at date_created to the capture log """
+    if settings.FEED_CAPTURE_DIR is None:
+        return
+
+    # JSON can't contain raw newlines other than whitespace
+    line = '{}\t'.format(int(date_created.timestamp())).encode() + content.replace(b'\n', b' ') + b'\n'
+    filename = get_capture_filename(date_created.astimezone(settings.LOCAL_TIMEZONE).date())
+
+    with _write_lock:
+        os.makedirs(settings.FEED_CAPTURE_DIR, exist_ok=True)
+        with open(filename, 'ab') as f:
+            f.write(gzip.compress(line))
+
+
+def _find_member_start(f, pos):
+    """ Returns the position of the first gzip header in open file f at or after pos, or None """
+    while True:
+        f.seek(pos)
+        block = f.read(READ_SIZE + len(GZIP_MAGIC) - 1)
+        ind = block.find(GZIP_MAGIC)
+        if ind != -1:
+            return pos + ind
+        if len(block) < READ_SIZE + len(GZIP_MAGIC) - 1:
+            return None
+        pos += READ_SIZE
+
+
+def _iter_members(f, filename):
+    """ Yields decompressed gzip members of open file f; corrupt members are skipped with a warning """
+    start = 0
+    while True:
+        f.seek(start)
+        pos = start
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        parts = []
+        try:
+            while not decompressor.eof:
+                block = f.read(READ_SIZE)
+                if not block:
+                    break
+                parts.append(decompressor.decompress(block))
+                pos += len(block)
+
+        except zlib.error as exc:
+            error = exc
+        else:
+            if decompressor.eof:
+                yield b''.join(parts)
+                start = pos - len(decompressor.unused_data)
+                continue
+            if pos == start:
+                return
+            error = 'truncated'
+
+        # E.g. a response was being written when the capturing process was killed; appending might have resumed later
+        logger.warning(f'Capture file {filename}: skipping corrupt response at byte {start}: {error}')
+        start = _find_member_start(f, start + 1)
+        if start is None:
+            return
+
+
+def read_capture_file(filename):
+    """ Yields (date-created, data) of responses in capture file filename """
+    with open(filename, 'rb') as f:
+        for member in _iter_members(f, filename):
+            for line in member.splitlines():
+                try:
+                    epoch_str, content = line.split(b'\t', 1)
+                    ret = datetime.fromtimestamp(int(epoch_str), tz=pytz.utc), json.loads(content)
+                except ValueError as exc:
+                    logger.warning(f'Capture file {filename}: skipping invalid response: {exc}')
+                    continue
+
+                yield ret
@@ -0,0 +1,101 @@
+"""
+Columnar archives of vehicle locations.
+Locations of local day d are stored in OUT_DIR/loc-YYYYMMDD.npz as typed arrays (see COLUMNS), sorted by route,
+vehicle id and date; rows of route routes[i] are rows route_offsets[i]:route_offsets[i+1]. Unlike the COPY dumps
+(see vehicle_locations.archive), columns can be read without parsing the text of the whole day.
+Files are created from the dumps by archive_old_locations and convert_archives.
+"""
+import os
+
+import numpy as np
+
+from lib.pg import parse_timestamptz
+from stops.models import Stop
+
+from . import archive
+
+
+COLUMNS = {
+    'route_id': np.dtype('<i4'),
+    'vehicle_id': np.dtype('<i4'),
+    'epoch': np.dtype('<i4'),
+    'latitude': np.dtype('<f8'),
+    'longitude': np.dtype('<f8'),
+    'is_processed': np.dtype('?'),
+    'unprocessed_reason': np.dtype('i1'),  # -1 if processed
+    'route_position': np.dtype('<f4'),  # NaN if unprocessed
+}
+
+
+def get_columnar_filename(out_dir, day):
+    return '{}/loc-{}.npz'.format(out_dir, day.strftime('%Y%m%d'))
+
+
+def get_stop_inds():
+    """ Returns a dict of stop-id: route-index of all stops (see archive.get_row_position) """
+    return dict(Stop.objects.values_list('id', 'route_index'))
+
+
+def convert_day(out_dir, day, stop_inds):
+    """ Converts the dump of local day day to the columnar format; returns the number of rows, or None if there's no dump """
+    filename, manifest = archive.find_dump(out_dir, day)
+    if filename is None:
+        return None
+
+    if manifest is None:
+        compression, columns, chunks = 'gzip', archive.LEGACY_COLUMNS, [{'offset': 0, 'size': os.path.getsize(filename)}]
+    else:
+        compression, columns, chunks = manifest['compression'], manifest['columns'], manifest['chunks']
+
+    data = {col: [] for col in COLUMNS}
+    with open(filename, 'rb') as f:
+        for chunk in chunks:
+            for row in archive.iter_chunk_rows(f, chunk, compression, columns):
+                data['route_id'].append(int(row['route_id']))
+                data['vehicle_id'].append(int(row['vehicle_id']))
+                data['epoch'].append(int(parse_timestamptz(row['date']).timestamp()))
+                data['latitude'].append(float(row['latitude']))
+                data['longitude'].append(float(row['longitude']))
+                data['is_processed'].append(row['is_processed'] == 't')
+                data['unprocessed_reason'].append(-1 if row['unprocessed_reason'] is None else int(row['unprocessed_reason']))
+                position = archive.get_row_position(row, stop_inds)
+                data['route_position'].append(np.nan if position is None else position)
+
+    data = {col: np.array(vals, dtype=COLUMNS[col]) for col, vals in data.items()}
+    order = np.lexsort((data['epoch'], data['vehicle_id'], data['route_id']))
+    data = {col: vals[order] for col, vals in data.items()}
+
+    routes, route_starts = np.unique(data['route_id'], return_index=True)
+    route_offsets = np.append(route_starts, len(order))
+
+    # Written to a temporary file and renamed, so that a partial file is never read
+    out_filename = get_columnar_filename(out_dir, day)
+    tmp_filename = f'{out_filename}.tmp'
+    with open(tmp_filename, 'wb') as f:
+        np.savez_compressed(f, routes=routes, route_offsets=route_offsets, **data)
+    os.replace(tmp_filename, out_filename)
+
+    return len(order)
+
+
+def read_columns(out_dir, day, route_id=None, columns=None):
+    """ Returns a dict of column: array of local day day (of route route_id or all routes), or None if there's no file
+
+    Only columns columns (default: all) are decompressed.
+    """
+    filename = get_columnar_filename(out_dir, day)
+    if not os.path.isfile(filename):
+        return None
+
+    with np.load(filename) as f:
+        if route_id is None:
+            rows = slice(None)
+        else:
+            routes, route_offsets = f['routes'], f['route_offsets']
+            ind = np.searchsorted(routes, route_id)
+            if ind == len(routes) or routes[ind] != route_id:
+                rows = slice(0, 0)
+            else:
+                rows = slice(route_offsets[ind], route_offsets[ind + 1])
+
+        return {col: f[col][rows] for col in (columns or COLUMNS)}
@@ -0,0 +1,179 @@
+"""
+Vectorized calculation of vehicle positions along a route.
+All vehicles of a route are processed at once. Only stops near each vehicle, found with the route's spatial index,
+are checked; all stops are checked only if none of them is near enough. For vehicles without a last known position,
+the results are the same as when processing vehicles one by one with lib.distance.distance.
+If last positions of vehicles are known (see vehicle_locations.state.VehicleStates), stops around these positions are
+checked first, and a vehicle found there keeps that position even if it's at some other stop too (e.g. at both ends of
+a loop route), so results can differ from processing vehicles one by one. Vehicles not found around their last
+positions, and vehicles whose states have expired, are processed as if their last positions were unknown.
+"""
+import numpy as np
+from django.conf import settings
+
+from . import const
+from .geometry import distance
+
+
+def _calculate_positions(geometry, lat, lng, candidates, candidates_dist):
+    """ Calculates positions of vehicles at (lat, lng), checking only candidate stops
+
+    candidates is an array of candidate stop indices for each vehicle, padded with -1; all stops within candidates_dist
+    of the vehicle have to be candidates. If none of the candidates is within candidates_dist, all stops are checked.
+    Returns the same dict as calculate_positions, with additional 'min_ind', the nearest stop found.
+    """
+    num_locs, num_stops = len(lat), geometry.num_stops
+    stops_radius, stops_dist = geometry.radius_m, geometry.stops_dist
+
+    def stop_dist(stop_ind):
+        """ Distances between vehicles and stops stop_ind (one stop per vehicle) """
+        return distance(lat, lng, geometry.latitude[stop_ind], geometry.longitude[stop_ind])
+
+    # Distances between vehicles and candidate stops
+    is_candidate = candidates >= 0
+    safe_candidates = np.where(is_candidate, candidates, 0)
+    cand_dist = distance(lat[:, np.newaxis], lng[:, np.newaxis], geometry.latitude[safe_candidates], geometry.longitude[safe_candidates])
+    cand_dist[~is_candidate] = np.inf
+
+    # At stop; if vehicle at multiple stops, choose the nearest one
+    # (candidates are sorted, so in case of a tie the first stop is chosen)
+    is_at_stop_m = cand_dist <= geometry.effective_radius_m[safe_candidates]
+    num_at_stop = is_at_stop_m.sum(axis=1)
+    is_at_stop = num_at_stop > 0
+    at_stop_ind = candidates[np.arange(num_locs), np.where(is_at_stop_m, cand_dist, np.inf).argmin(axis=1)]
+
+    ## Not at stop
+    # Nearest stop; if it's not certain that the nearest candidate is the nearest stop, check all stops
+    nearest_cand_ind = cand_dist.argmin(axis=1)
+    min_ind = candidates[np.arange(num_locs), nearest_cand_ind]
+    is_nearest_unknown = ~is_at_stop & ~(cand_dist[np.arange(num_locs), nearest_cand_ind] <= candidates_dist - 1.)
+    if is_nearest_unknown.any():
+        all_stop_dist = distance(
+            lat[is_nearest_unknown, np.newaxis], lng[is_nearest_unknown, np.newaxis],
+            geometry.latitude[np.newaxis, :], geometry.longitude[np.newaxis, :],
+        )
+        min_ind[is_nearest_unknown] = all_stop_dist.argmin(axis=1)
+
+    # (a) We are between final and next to final stop or beyond final stop
+    is_first, is_last = min_ind == 0, min_ind == num_stops - 1
+    is_final = is_first | is_last
+    ind_other = np.where(is_first, 1, num_stops - 2)
+    dist_stop_next = np.where(is_first, stops_dist[0], stops_dist[-1])
+    is_beyond_final_stop = is_final & (dist_stop_next < stop_dist(ind_other))
+    final_segment_ind = np.where(is_first, 0, num_stops - 2)
+
+    # (b) We are between stops (min_ind-1 and min_ind) or (min_ind and min_ind+1)
+    ind_a, ind_b = np.clip(min_ind - 1, 0, num_stops - 1), np.clip(min_ind + 1, 0, num_stops - 1)
+    diff_a = stop_dist(ind_a) - stops_dist[np.clip(min_ind - 1, 0, num_stops - 2)]
+    diff_b = stop_dist(ind_b) - stops_dist[np.clip(min_ind, 0, num_stops - 2)]
+    middle_segment_ind = np.where(diff_a < diff_b, min_ind - 1, min_ind)
+
+    # Position between stops segment_ind and segment_ind+1
+    segment_ind = np.where(is_final, final_segment_ind, middle_segment_ind)
+    dist_a, dist_b = stop_dist(segment_ind), stop_dist(segment_ind + 1)
+    radius_a, radius_b = stops_radius[segment_ind], stops_radius[segment_ind + 1]
+    is_too_far = dist_a + dist_b > stops_dist[segment_ind] * settings.MAX_ALLOWED_DETOUR_RATIO
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dist_limited = dist_a - radius_a - settings.STOP_ADD_RADIUS_M
+        total_dist_limited = dist_a + dist_b - radius_a - radius_b - 2 * settings.STOP_ADD_RADIUS_M
+        to_next_stop_ratio = dist_limited / total_dist_limited
+
+    ## Combine
+    is_beyond_final_stop &= ~is_at_stop
+    is_too_far &= ~is_at_stop & ~is_beyond_final_stop
+    is_processed = ~is_beyond_final_stop & ~is_too_far
+
+    unprocessed_reason = np.zeros(num_locs, dtype=int)
+    unprocessed_reason[is_too_far] = const.UNPROC_REASON_TOO_FAR
+    unprocessed_reason[is_beyond_final_stop] = const.UNPROC_REASON_BEYOND_FINAL_STOP
+
+    stop_ind = np.where(is_at_stop, at_stop_ind, segment_ind)
+    stop_ind[~is_processed] = -1
+    to_next_stop_ratio[is_at_stop | ~is_processed] = np.nan
+
+    return {
+        'is_processed': is_processed,
+        'unprocessed_reason': unprocessed_reason,
+        'is_at_stop': is_at_stop,
+        'stop_ind': stop_ind,
+        'to_next_stop_ratio': to_next_stop_ratio,
+        'route_position': np.where(is_at_stop, stop_ind, stop_ind + to_next_stop_ratio),
+        'num_at_stop': num_at_stop,
+        'at_stop_inds': {ind: candidates[ind, is_at_stop_m[ind]] for ind in np.flatnonzero(num_at_stop > 1)},
+        'min_ind': min_ind,
+    }
+
+
+def _select(positions, mask):
+    """ Returns positions of vehicles selected by mask """
+    new_inds = np.cumsum(mask) - 1
+    ret = {key: val[mask] for key, val in positions.items() if key != 'at_stop_inds'}
+    ret['at_stop_inds'] = {new_inds[ind]: val for ind, val in positions['at_stop_inds'].items() if mask[ind]}
+
+    return ret
+
+
+def _combine(results, num_locs):
+    """ Combines a list of (location-indices, positions) into positions of num_locs vehicles """
+    ret = {'at_stop_inds': {}}
+    for inds, positions in results:
+        for key, val in positions.items():
+            if key == 'at_stop_inds':
+                ret[key].update({inds[ind]: v for ind, v in val.items()})
+                continue
+
+            if key not in ret:
+                ret[key] = np.empty(num_locs, dtype=val.dtype)
+            ret[key][inds] = val
+
+    return ret
+
+
+def calculate_positions(geometry, locs, last_positions=None, directions=None):
+    """ Calculates positions along the route of vehicles at locations locs
+
+    geometry is a RouteGeometry of the route, locs is an array-like of (latitude, longitude) pairs.
+    last_positions and directions are optional arrays of last known route positions (nan if unknown) and directions
+    (1, -1 or 0 if unknown) of the vehicles; if given, stops around the last position are checked first. A vehicle found
+    at one of these stops or between them is assigned there, even if it's also at some other stop of the route;
+    otherwise, it's processed as if its last position was unknown.
+
+    Returns a dict of arrays, one element per location:
+     * 'is_processed'
+     * 'unprocessed_reason' (0 if processed)
+     * 'is_at_stop'
+     * 'stop_ind': index of the current stop (-1 if not processed)
+     * 'to_next_stop_ratio' (nan if not processed or at stop)
+     * 'route_position': stop_ind + to_next_stop_ratio (nan if not processed)
+     * 'num_at_stop': number of stops the vehicle is at
+    and 'at_stop_inds', a dict of location-index: array-of-stop-indices for locations at more than one stop.
+    """
+    locs = np.asarray(locs, dtype=float).reshape(-1, 2)
+    lat, lng = locs[:, 0], locs[:, 1]
+
+    # Vehicles with known last positions; only stops around these positions are candidates
+    results = []
+    is_done = np.zeros(len(locs), dtype=bool)
+    if last_positions is not None:
+        inds = np.flatnonzero(~np.isnan(last_positions))
+        candidates, first_ind, last_ind = geometry.get_window_candidates(last_positions[inds], directions[inds])
+        positions = _calculate_positions(geometry, lat[inds], lng[inds], candidates, np.inf)
+
+        # Nearest stop at the window edge might mean that the vehicle is already outside the window
+        min_ind = positions['min_ind']
+        is_inside_window = ((min_ind > first_ind) | (first_ind == 0)) & ((min_ind < last_ind) | (last_ind == geometry.num_stops - 1))
+        is_valid = positions['is_at_stop'] | (positions['is_processed'] & is_inside_window)
+
+        results.append((inds[is_valid], _select(positions, is_valid)))
+        is_done[inds[is_valid]] = True
+
+    # Other vehicles
+    inds = np.flatnonzero(~is_done)
+    candidates, candidates_dist = geometry.get_candidates(lat[inds], lng[inds])
+    results.append((inds, _calculate_positions(geometry, lat[inds], lng[inds], candidates, candidates_dist)))
+
+    # Combine
+    if len(results) == 1:
+        return results[0][1]
+
+    return _combine(results, len(locs))
@@ -0,0 +1,223 @@
+"""
+Route geometry used by the position engine.
+Geometry is calculated once per route and cached; a route is identified by its id and modification date,
+so routes changed by add_route/delete_route are recalculated.
+"""
+import numpy as np
+from django.conf import settings
+
+
+_geometry_cache = {}
+
+
+def distance(lat1, lng1, lat2, lng2):
+    """ Distance in meters; element-wise version of lib.distance.distance """
+    dist_y = (lat2 - lat1) * settings.ONE_DEG_Y_KM
+    dist_x = (lng2 - lng1) * settings.ONE_DEG_X_KM
+
+    return np.sqrt(dist_y * dist_y + dist_x * dist_x) * 1000.
+
+
+def to_local_m(lat, lng):
+    """ Converts latitude and longitude to (x, y) in meters from (MIN_LAT, MIN_LONG) """
+    return (lng - settings.MIN_LONG) * settings.ONE_DEG_X_KM * 1000., (lat - settings.MIN_LAT) * settings.ONE_DEG_Y_KM * 1000.
+
+
+def get_window(num_stops, last_positions, directions):
+    """ Returns the first and the last stop index of windows around last_positions (see RouteGeometry.get_window_candidates) """
+    window_stops = settings.VEHICLE_STATE_WINDOW_STOPS
+    segment_ind = np.clip(np.floor(last_positions).astype(int), 0, num_stops - 2)
+    num_before = np.where(directions > 0, 1, window_stops)
+    num_after = np.where(directions < 0, 1, window_stops)
+
+    return np.maximum(segment_ind - num_before, 0), np.minimum(segment_ind + 1 + num_after, num_stops - 1)
+
+
+class StopGrid:
+    """ Uniform grid over stops
+
+    For each cell, stores indices of stops in this cell and the eight neighbouring ones. Therefore, candidates of a point
+    include all stops within cell_size_m of the point.
+    """
+
+    def __init__(self, x, y, cell_size_m):
+        self.cell_size_m = cell_size_m
+        self.x0, self.y0 = x.min() - cell_size_m, y.min() - cell_size_m
+        self.num_x = int((x.max() - self.x0) // cell_size_m) + 2
+        self.num_y = int((y.max() - self.y0) // cell_size_m) + 2
+
+        # Stops in each cell and its neighbours
+        cells = [[] for _ in range(self.num_x * self.num_y)]
+        stops_ix, stops_iy = ((x - self.x0) // cell_size_m).astype(int), ((y - self.y0) // cell_size_m).astype(int)
+        for stop_ind, (ix, iy) in enumerate(zip(stops_ix, stops_iy)):
+            for cell_ix in range(ix - 1, ix + 2):
+                for cell_iy in range(iy - 1, iy + 2):
+                    cells[cell_ix * self.num_y + cell_iy].append(stop_ind)
+
+        # Candidates array; rows are padded with -1
+        self.candidates = np.full((len(cells), max(len(c) for c in cells)), -1)
+        for cell_ind, cell in enumerate(cells):
+            self.candidates[cell_ind, :len(cell)] = cell
+
+    def get_candidates(self, x, y):
+        """ Returns an array of candidate stop indices for each point, padded with -1; points outside the grid have no candidates """
+        ix, iy = np.floor((x - self.x0) / self.cell_size_m), np.floor((y - self.y0) / self.cell_size_m)
+        is_inside = (ix >= 0) & (ix < self.num_x) & (iy >= 0) & (iy < self.num_y)
+
+        candidates = self.candidates[np.where(is_inside, ix * self.num_y + iy, 0).astype(int)]
+        candidates[~is_inside] = -1
+
+        return candidates
+
+
+class RouteGeometry:
+
+    def __init__(self, stops, use_grid=True):
+        if len(stops) < 2:
+            raise ValueError(f'Route has to have at least two stops; got {len(stops)}')
+
+        latitude = np.array([stop.latitude for stop in stops])
+        longitude = np.array([stop.longitude for stop in stops])
+        radius_m = np.array([stop.radius_m for stop in stops])
+        stops_dist = distance(latitude[:-1], longitude[:-1], latitude[1:], longitude[1:])
+
+        # Stops
+        self.stops = stops
+        self.num_stops = len(stops)
+        self.latitude, self.longitude = latitude, longitude
+        self.x, self.y = to_local_m(latitude, longitude)
+        self.radius_m = radius_m
+        self.effective_radius_m = radius_m + settings.STOP_ADD_RADIUS_M
+
+        # Distances between consecutive stops and from the first stop
+        self.stops_dist = stops_dist
+        self.cumulative_dist = np.concatenate([[0.], np.cumsum(stops_dist)])
+        self.route_length = self.cumulative_dist[-1]
+
+        # Spatial index; cells can't be smaller than stops
+        self.grid = None
+        if use_grid:
+            self.grid = StopGrid(self.x, self.y, max(settings.STOP_GRID_CELL_M, self.effective_radius_m.max() + 1))
+
+    def get_candidates(self, lat, lng):
+        """ Returns an array of candidate stop indices for each location, padded with -1, and the candidate distance
+
+        Candidates include all stops within the candidate distance of the location.
+        Without the spatial index, all stops are candidates.
+        """
+        if self.grid is None:
+            return np.broadcast_to(np.arange(self.num_stops), (len(lat), self.num_stops)), np.inf
+
+        return self.grid.get_candidates(*to_local_m(lat, lng)), self.grid.cell_size_m
+
+    def get_window_candidates(self, last_positions, directions):
+        """ Returns an array of stop indices around each of last_positions, padded with -1, and the first and last index
+
+        Windows extend VEHICLE_STATE_WINDOW_STOPS stops beyond the last segment in the direction of travel
+        (or in both directions if it's unknown) and one stop in the other direction.
+        """
+        first_ind, last_ind = get_window(self.num_stops, last_positions, directions)
+
+        candidates = first_ind[:, np.newaxis] + np.arange(2 * settings.VEHICLE_STATE_WINDOW_STOPS + 2)
+        candidates[candidates > last_ind[:, np.newaxis]] = -1
+
+        return candidates, first_ind, last_ind
+
+
+class RouteShape:
+    """ Route polyline used by the shape engine
+
+    The polyline is the route's shape (see set_route_shape) or, if it isn't set, the sequence of stops. Stops are projected
+    onto the polyline in order, so their positions along it (stop_arc) never decrease, even on loop routes.
+    """
+
+    def __init__(self, stops, shape_points=None):
+        if len(stops) < 2:
+            raise ValueError(f'Route has to have at least two stops; got {len(stops)}')
+
+        # Stops
+        self.stops = stops
+        self.num_stops = len(stops)
+        self.latitude = np.array([stop.latitude for stop in stops])
+        self.longitude = np.array([stop.longitude for stop in stops])
+        self.effective_radius_m = np.array([stop.radius_m for stop in stops]) + settings.STOP_ADD_RADIUS_M
+
+        # Polyline in local coordinates, without repeated points
+        if shape_points is None:
+            shape_points = list(zip(self.latitude, self.longitude))
+        x, y = to_local_m(*np.array(shape_points, dtype=float).T)
+        is_new = np.concatenate([[True], (np.diff(x) != 0) | (np.diff(y) != 0)])
+        self.x, self.y = x[is_new], y[is_new]
+        if len(self.x) < 2:
+            raise ValueError('Route shape has to have at least two distinct points')
+
+        # Segments and distances along the polyline
+        self.segment_dx, self.segment_dy = np.diff(self.x), np.diff(self.y)
+        self.segment_len2 = self.segment_dx * self.segment_dx + self.segment_dy * self.segment_dy
+        self.cumulative_dist = np.concatenate([[0.], np.cumsum(np.sqrt(self.segment_len2))])
+        self.route_length = self.cumulative_dist[-1]
+
+        # Stops along the polyline; each stop is projected onto the part of the polyline after the previous stop
+        stops_x, stops_y = to_local_m(self.latitude, self.longitude)
+        self.stop_arc, self.stop_shape_dist = np.empty(self.num_stops), np.empty(self.num_stops)
+        first_segment, min_t = 0, 0.
+        for ind in range(self.num_stops):
+            arc, dist, segment, t = self.project(stops_x[ind:ind+1], stops_y[ind:ind+1], first_segment, min_t)
+            self.stop_arc[ind], self.stop_shape_dist[ind] = arc[0], dist[0]
+            first_segment, min_t = segment[0], t[0]
+
+    def project(self, x, y, first_segment=0, min_t=0., arc_range=None):
+        """ Projects points (x, y) onto the polyline, from point min_t of segment first_segment onwards
+
+        If arc_range (arrays of first and last distance along the polyline, one element per point) is given,
+        points are projected only onto segments overlapping this range.
+        Returns arrays of distances along the polyline, distances from it, segment indices and positions within the segments.
+        """
+        dx, dy = self.segment_dx[first_segment:], self.segment_dy[first_segment:]
+        rel_x, rel_y = x[:, np.newaxis] - self.x[first_segment:-1], y[:, np.newaxis] - self.y[first_segment:-1]
+
+        t = np.clip((rel_x * dx + rel_y * dy) / self.segment_len2[first_segment:], 0., 1.)
+        t[:, 0] = np.maximum(t[:, 0], min_t)
+        dist2 = (rel_x - t * dx) ** 2 + (rel_y - t * dy) ** 2
+        if arc_range is not None:
+            segment_start, segment_end = self.cumulative_dist[first_segment:-1], self.cumulative_dist[first_segment+1:]
+            dist2[(segment_end < arc_range[0][:, np.newaxis]) | (segment_start > arc_range[1][:, np.newaxis])] = np.inf
+
+        inds = np.arange(len(x))
+        segment = dist2.argmin(axis=1)
+        segment_t = t[inds, segment]
+        segment += first_segment
+
+        arc = self.cumulative_dist[segment] + segment_t * (self.cumulative_dist[segment + 1] - self.cumulative_dist[segment])
+        return arc, np.sqrt(dist2[inds, segment - first_segment]), segment, segment_t
+
+
+def get_route_geometry(route, stops=None):
+    """ Returns cached geometry of route; stops are read from the db if not given and geometry isn't cached
+
+    Geometry is a RouteShape if POSITION_ENGINE is 'shape', RouteGeometry otherwise.
+    """
+    key = (route.id, route.date_modified)
+
+    geometry = _geometry_cache.get(key)
+    if geometry is None:
+        if stops is None:
+            stops = list(route.stop_set.all())
+        if settings.POSITION_ENGINE == 'shape':
+            geometry = RouteShape(stops, route.get_shape_points())
+        else:
+            geometry = RouteGeometry(stops)
+
+        # Remove the previous version of this route
+        for old_key in [k for k in _geometry_cache if k[0] == route.id]:
+            del _geometry_cache[old_key]
+        _geometry_cache[key] = geometry
+
+    return geometry
+
+
+def clear_route_geometry_cache(route_ids=None):
+    """ Removes routes route_ids (all routes if None) from the cache """
+    for key in list(_geometry_cache):
+        if route_ids is None or key[0] in route_ids:
+            del _geometry_cache[key]
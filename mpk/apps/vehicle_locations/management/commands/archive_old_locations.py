@@ -1,39 +1,60 @@
 """
-Dumps records older than keep-days to a file and deletes these records from the database.
-The data are dumped to daily files. The file for date d contains records from [d, d+1day) in *local* timezone.
+Dumps records older than keep-days to files and deletes these records from the database.
+The data are dumped to daily files. The file for date d contains records from [d, d+1day) in *local* timezone;
+see vehicle_locations.archive for the file format and the manifest.
+Records of a day are deleted only after the dump has been verified against the manifest and the database, in small batches,
+so that ingestion isn't blocked. If the table is partitioned (see vehicle_locations.partitions), whole partitions are
+dropped instead, so keep-days is rounded up to the partition boundary; records of the legacy partition are deleted in batches.
+Interrupted runs can be resumed: verified dumps aren't repeated.
+Dumps are indexed for reading by create_plot (see LOCATIONS_ARCHIVE_DIR) and converted to the columnar format
+(see vehicle_locations.columnar). Trajectories and rollups of indexed days are deleted, as plots read these days from the dump.
 """
-import gzip
 import os
 from datetime import datetime, timedelta
 
-import pytz
 from django.conf import settings
 from django.core.management import BaseCommand
-from django.db import connection
 
+from vehicle_locations import archive, columnar, partitions, rollups, trajectories
 from vehicle_locations.models import VehicleLocation
 
-LOCATION_TABLE = VehicleLocation._meta.db_table
-
 
 class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('-d', '--keep-days', dest='keep_days', type=int, help='Number of days of data to keep', required=True)
         parser.add_argument('-o', '--out-dir', dest='out_dir', help='Out dir', required=True)
+        parser.add_argument('-c', '--compression', dest='compression', choices=sorted(archive.COMPRESSIONS), default='gzip', help='Compression')
+        parser.add_argument('-L', '--level', dest='level', type=int, help='Compression level (default: 6 for gzip, 3 for zstd)')
+        parser.add_argument('-j', '--num-threads', dest='num_threads', type=int, default=min(4, os.cpu_count()), help='Number of compression threads')
+        parser.add_argument('-s', '--chunk-size-mb', dest='chunk_size_mb', type=int, default=16, help='Uncompressed chunk size [MB]')
+        parser.add_argument('-b', '--batch-size', dest='batch_size', type=int, default=10000, help='Number of records deleted in one transaction')
+        parser.add_argument('-p', '--batch-pause', dest='batch_pause_s', type=float, default=.1, help='Pause between deleted batches [s]')
 
     def handle(self, *args, **kwargs):
         # Parse arguments
         keep_days = kwargs['keep_days']
         out_dir = kwargs['out_dir']
+        compression = kwargs['compression']
+        level = kwargs['level']
+        num_threads = kwargs['num_threads']
+        chunk_size = kwargs['chunk_size_mb'] << 20
+        batch_size = kwargs['batch_size']
+        batch_pause_s = kwargs['batch_pause_s']
 
         if keep_days <= 0:
             raise ValueError('keep-days must be positive')
+        if level is None:
+            level = archive.COMPRESSIONS[compression]['default_level']
 
         # Current and oldest date to keep
         current_date = datetime.now().date()
         last_date = current_date - timedelta(days=keep_days)
 
+        is_partitioned = partitions.is_partitioned()
+        if is_partitioned:
+            last_date = partitions.get_partition_start_day(last_date)
+
         # Earliest record
         earliest_record = (
             VehicleLocation
@@ -44,25 +65,52 @@ class Command(BaseCommand):
         if earliest_record is None:
             return
 
+        stop_inds = columnar.get_stop_inds()
+
         this_date = earliest_record.date.astimezone(settings.LOCAL_TIMEZONE).date()
         while this_date < last_date:
-            next_date = this_date + timedelta(days=1)
-            next_date_dt = settings.LOCAL_TIMEZONE.localize(datetime.combine(next_date, datetime.min.time()))
-            next_date_utc_dt = next_date_dt.astimezone(pytz.utc)
-
-            # Archive records
-            query = 'copy (select * from {} where date < \'{}\' order by date) to stdout'.format(LOCATION_TABLE, next_date_utc_dt.strftime('%Y-%m-%d %H:%M+00:00'))
-            out_filename = '{}/loc-{}.dump.gz'.format(out_dir, this_date.strftime('%Y%m%d'))
-
-            cursor = connection.cursor()
-            cursor.copy_expert(query, gzip.open(out_filename, 'w'))
-
-            # Make sure that the file has been created
-            if not os.path.isfile(out_filename):
-                raise RuntimeError(f'Dump for {this_date} failed; {out_filename} hasn\'t been created')
-
-            # Delete records
-            VehicleLocation.objects.filter(date__lt=next_date_dt).order_by().delete()
-
-            this_date = next_date
-
+            _, manifest_filename = archive.get_archive_filenames(out_dir, this_date, compression)
+            _, end = archive.get_day_range(this_date)
+
+            # Dump, unless there's a valid dump of all records of this day
+            manifest = archive.read_manifest(manifest_filename)
+            num_rows = archive.count_day_rows(this_date)
+            is_dumped = False
+            if num_rows and (manifest is None or num_rows > manifest['rows'] or not archive.is_dump_valid(manifest, out_dir)):
+                manifest = archive.dump_day(this_date, out_dir, compression, level, num_threads, chunk_size)
+                print('{}: dumped {} records to {}'.format(this_date, manifest['rows'], manifest['filename']))
+
+                # Verify
+                num_rows = archive.count_day_rows(this_date)
+                if num_rows != manifest['rows']:
+                    raise RuntimeError(f'Dump for {this_date} has {manifest["rows"]} records, the db has {num_rows}; not deleting')
+                if not archive.is_dump_valid(manifest, out_dir):
+                    raise RuntimeError(f'Dump for {this_date} doesn\'t match its manifest; not deleting')
+                is_dumped = True
+
+            # Columnar copy for analyses, and index for plotting from the dump; also after interrupted runs, as plots
+            # read the day from the dump only when it has an index
+            if num_rows and (is_dumped or not os.path.exists(columnar.get_columnar_filename(out_dir, this_date))):
+                columnar.convert_day(out_dir, this_date, stop_inds)
+            if num_rows and (is_dumped or archive.get_index(out_dir, this_date) is None):
+                archive.build_index(out_dir, this_date)
+
+            # Delete records; partitions are dropped only when all their days have been dumped
+            day_partition = None
+            if is_partitioned:
+                day_partition = next((p for p in partitions.get_partitions() if (p[1] is None or p[1] < end) and end <= p[2]), None)
+
+            if num_rows and (day_partition is None or day_partition[1] is None):
+                num_deleted = archive.delete_day(this_date, batch_size, batch_pause_s)
+                print(f'{this_date}: deleted {num_deleted} records')
+            if day_partition is not None and day_partition[2] <= end:
+                partitions.drop_partition(day_partition[0])
+                print(f'{this_date}: dropped partition {day_partition[0]}')
+
+            # Trajectories and rollups; plots read archived days from the dump
+            if archive.get_index(out_dir, this_date) is not None:
+                num_deleted = trajectories.delete_trajectories(this_date) + rollups.delete_rollups(this_date)
+                if num_deleted:
+                    print(f'{this_date}: deleted {num_deleted} trajectories and rollups')
+
+            this_date += timedelta(days=1)
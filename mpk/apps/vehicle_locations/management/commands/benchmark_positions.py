@@ -0,0 +1,67 @@
+"""
+Measures the time of calculating vehicle positions on synthetic routes of different lengths,
+with and without the spatial index over stops, and with the shape engine. Nothing is read from or written to the db.
+"""
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management import BaseCommand
+
+from stops.models import Stop
+from vehicle_locations import engine, shape_engine
+from vehicle_locations.geometry import RouteGeometry, RouteShape
+
+
+def create_route(num_stops, rng):
+    """ Returns a list of stops of a winding route with stops every ~400m """
+    angles = np.cumsum(rng.uniform(-.3, .3, num_stops))
+    dists_m = rng.uniform(250, 550, num_stops)
+    lat = settings.MIN_LAT + .01 + np.cumsum(dists_m * np.sin(angles)) / settings.ONE_DEG_Y_KM / 1000.
+    lng = settings.MIN_LONG + .01 + np.cumsum(dists_m * np.cos(angles)) / settings.ONE_DEG_X_KM / 1000.
+
+    return [Stop(route_index=ind, latitude=lat[ind], longitude=lng[ind], radius_m=int(rng.integers(10, 40))) for ind in range(num_stops)]
+
+
+def create_locations(stops, num_locs, rng):
+    """ Returns an array of locations of vehicles along the route """
+    lat, lng = np.array([stop.latitude for stop in stops]), np.array([stop.longitude for stop in stops])
+    segment_ind, ratio = rng.integers(0, len(stops) - 1, num_locs), rng.uniform(0, 1, num_locs)
+
+    return np.column_stack([
+        lat[segment_ind] + (lat[segment_ind + 1] - lat[segment_ind]) * ratio + rng.normal(0, 30, num_locs) / settings.ONE_DEG_Y_KM / 1000.,
+        lng[segment_ind] + (lng[segment_ind + 1] - lng[segment_ind]) * ratio + rng.normal(0, 30, num_locs) / settings.ONE_DEG_X_KM / 1000.,
+    ])
+
+
+class Command(BaseCommand):
+
+    def add_arguments(self, parser):
+        parser.add_argument('-s', '--num-stops', dest='num_stops', type=int, nargs='+', default=[25, 50, 100, 200, 400, 800], help='Numbers of stops')
+        parser.add_argument('-n', '--num-vehicles', dest='num_vehicles', type=int, default=200, help='Number of vehicles per poll')
+        parser.add_argument('-r', '--repeat', dest='repeat', type=int, default=20, help='Number of repetitions')
+
+    def handle(self, *args, **kwargs):
+        num_stops_l = kwargs['num_stops']
+        num_vehicles = kwargs['num_vehicles']
+        repeat = kwargs['repeat']
+
+        rng = np.random.default_rng(0)
+
+        print('{:>6} {:>12} {:>12} {:>12}'.format('stops', 'full [us]', 'grid [us]', 'shape [us]'))
+        for num_stops in num_stops_l:
+            stops = create_route(num_stops, rng)
+            locs = create_locations(stops, num_vehicles, rng)
+
+            times = []
+            for positions_engine, geometry in [
+                (engine, RouteGeometry(stops, use_grid=False)),
+                (engine, RouteGeometry(stops, use_grid=True)),
+                (shape_engine, RouteShape(stops)),
+            ]:
+                start_time = time.perf_counter()
+                for _ in range(repeat):
+                    positions_engine.calculate_positions(geometry, locs)
+                times.append((time.perf_counter() - start_time) / repeat / num_vehicles * 1e6)
+
+            print('{:>6} {:>12.2f} {:>12.2f} {:>12.2f}'.format(num_stops, *times))
@@ -0,0 +1,42 @@
+"""
+Rebuilds compact trajectories and rollups (see vehicle_locations.trajectories and vehicle_locations.rollups) of local days
+from vehicle locations in the db, e.g. for days from before they were collected.
+"""
+from datetime import datetime, timedelta
+
+from django.core.management import BaseCommand
+
+from mpk.script.create_plot.lib import segment_cache
+from routes.models import Route
+from vehicle_locations.rollups import build_rollups
+from vehicle_locations.trajectories import build_trajectories
+
+
+class Command(BaseCommand):
+
+    def add_arguments(self, parser):
+        parser.add_argument('-f', '--date-from', dest='date_from', help='First day (YYYY-MM-DD)', required=True)
+        parser.add_argument('-t', '--date-to', dest='date_to', help='Last day (YYYY-MM-DD)', required=True)
+        parser.add_argument('-l', '--lines', dest='lines', nargs='+', help='Lines (default: all)')
+
+    def handle(self, *args, **kwargs):
+        # Parse arguments
+        date_from = datetime.strptime(kwargs['date_from'], '%Y-%m-%d').date()
+        date_to = datetime.strptime(kwargs['date_to'], '%Y-%m-%d').date()
+        lines_l = kwargs['lines']
+
+        if date_to < date_from:
+            raise ValueError('date-to earlier than date-from')
+
+        route_ids = None
+        if lines_l is not None:
+            route_ids = list(Route.objects.filter(line__in=lines_l).values_list('id', flat=True))
+
+        this_date = date_from
+        while this_date <= date_to:
+            build_trajectories(this_date, route_ids)
+            build_rollups(this_date, route_ids)
+            print(f'Built trajectories and rollups of {this_date}')
+            this_date += timedelta(days=1)
+
+        segment_cache.invalidate_routes(route_ids if route_ids is not None else Route.objects.values_list('id', flat=True))
@@ -0,0 +1,101 @@
+"""
+Collects vehicle locations in a loop; a long-running replacement for calling get_locations from crontab.
+Routes, stops, last positions of vehicles and the HTTP session are kept between polls. Polls are scheduled at multiples of the interval
+(e.g. hh:mm:00, hh:mm:20, hh:mm:40), so the schedule doesn't drift; polls that couldn't be started on time are skipped.
+Routes are reloaded when a route is added, deleted or modified, or on SIGHUP (which also recalculates route geometry).
+SIGTERM and SIGINT stop the collector after the current poll finishes.
+"""
+import logging
+import math
+import signal
+import threading
+import time
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from routes.models import Route
+from vehicle_locations.geometry import clear_route_geometry_cache
+from vehicle_locations.state import VehicleStates
+
+from .get_locations import collect_locations, create_session, load_routes
+
+
+logger = logging.getLogger('get-locations')
+
+
+def get_routes_key():
+    """ Returns a value that changes whenever a route is added, deleted or modified """
+    return list(Route.objects.order_by('id').values_list('id', 'line', 'date_modified'))
+
+
+class Command(BaseCommand):
+
+    def add_arguments(self, parser):
+        parser.add_argument('-i', '--interval', dest='interval', type=float, default=settings.COLLECT_LOCATIONS_INTERVAL_S, help='Interval between polls in seconds')
+
+    def handle(self, *args, **kwargs):
+        # Parse arguments
+        interval = kwargs['interval']
+
+        if interval <= 0:
+            raise ValueError('interval must be positive')
+
+        # Signals
+        stop_event, reload_event = threading.Event(), threading.Event()
+
+        def stop(signum, frame):
+            logger.info(f'Received signal {signum}, stopping..')
+            stop_event.set()
+
+        def reload(signum, frame):
+            reload_event.set()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, reload)
+
+        logger.info(f'Collector started; interval {interval}s')
+
+        routes_d, routes_key = None, None
+        states = VehicleStates()
+        next_poll = math.ceil(time.time() / interval) * interval
+        with create_session() as session:
+            while True:
+                # Wait for the next poll
+                if stop_event.wait(max(next_poll - time.time(), 0.)):
+                    break
+
+                try:
+                    # Reload routes if needed
+                    current_routes_key = get_routes_key()
+                    if reload_event.is_set() or current_routes_key != routes_key:
+                        if reload_event.is_set():
+                            clear_route_geometry_cache()
+                        elif routes_key is not None:
+                            clear_route_geometry_cache({r[0] for r in routes_key} - {r[0] for r in current_routes_key})
+                        reload_event.clear()
+
+                        routes_d, routes_key = load_routes(), current_routes_key
+                        logger.info('Loaded {} routes'.format(len(routes_d)))
+
+                    # Poll
+                    collect_locations(session, routes_d, states, interval)
+                    states.remove_old(timezone.now())
+
+                except Exception as exc:
+                    logger.exception(exc)
+
+                    # The connection might be broken; a new one will be opened for the next poll
+                    connection.close()
+
+                # Schedule the next poll
+                now = time.time()
+                num_skipped = max(math.floor((now - next_poll) / interval), 0)
+                if num_skipped:
+                    logger.warning(f'Poll took {now - next_poll:.2f}s; skipping {num_skipped} poll(s)')
+                next_poll += (num_skipped + 1) * interval
+
+        logger.info('Collector stopped')
@@ -0,0 +1,68 @@
+"""
+Converts dumps of archive_old_locations to the columnar format (see vehicle_locations.columnar), in parallel.
+Days whose columnar file is newer than the dump are skipped, unless --overwrite is given.
+Missing or out of date indexes for reading dumps by create_plot (see vehicle_locations.archive) are built too,
+e.g. of dumps of the previous archiver.
+"""
+import glob
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+from django.core.management import BaseCommand
+from django.db import connections
+
+from vehicle_locations import archive, columnar
+
+
+def _is_converted(out_dir, day):
+    filename, _ = archive.find_dump(out_dir, day)
+    columnar_filename = columnar.get_columnar_filename(out_dir, day)
+    return os.path.isfile(columnar_filename) and os.path.getmtime(columnar_filename) >= os.path.getmtime(filename)
+
+
+class Command(BaseCommand):
+
+    def add_arguments(self, parser):
+        parser.add_argument('-o', '--out-dir', dest='out_dir', help='Directory of the dumps', required=True)
+        parser.add_argument('-f', '--date-from', dest='date_from', help='First day (YYYY-MM-DD)')
+        parser.add_argument('-t', '--date-to', dest='date_to', help='Last day (YYYY-MM-DD)')
+        parser.add_argument('-j', '--num-processes', dest='num_processes', type=int, default=os.cpu_count(), help='Number of processes')
+        parser.add_argument('--overwrite', dest='overwrite', action='store_true', help='Convert days that have already been converted')
+
+    def handle(self, *args, **kwargs):
+        # Parse arguments
+        out_dir = kwargs['out_dir']
+        date_from = kwargs['date_from'] and datetime.strptime(kwargs['date_from'], '%Y-%m-%d').date()
+        date_to = kwargs['date_to'] and datetime.strptime(kwargs['date_to'], '%Y-%m-%d').date()
+        num_processes = kwargs['num_processes']
+        overwrite = kwargs['overwrite']
+
+        # Days with a dump
+        days = set()
+        for filename in glob.glob(f'{out_dir}/loc-*.*'):
+            match = re.fullmatch(r'loc-(\d{8})\.(?:dump\.gz|manifest\.json)', os.path.basename(filename))
+            if match is not None:
+                days.add(datetime.strptime(match.group(1), '%Y%m%d').date())
+
+        days = sorted(day for day in days if (date_from is None or date_from <= day) and (date_to is None or day <= date_to))
+        convert_days = [day for day in days if overwrite or not _is_converted(out_dir, day)]
+        index_days = [day for day in days if overwrite or archive.get_index(out_dir, day) is None]
+        if not convert_days and not index_days:
+            return
+
+        # Workers don't use the db; the connection mustn't be shared with them
+        stop_inds = columnar.get_stop_inds()
+        connections.close_all()
+
+        with ProcessPoolExecutor(max_workers=num_processes) as executor:
+            futures = {executor.submit(archive.build_index, out_dir, day): (day, 'index') for day in index_days}
+            futures.update({executor.submit(columnar.convert_day, out_dir, day, stop_inds): (day, 'convert') for day in convert_days})
+            for future in as_completed(futures):
+                day, task = futures[future]
+                if task == 'index':
+                    future.result()
+                    print(f'{day}: indexed')
+                else:
+                    print('{}: converted {} records'.format(day, future.result()))
@@ -0,0 +1,14 @@
+"""
+Creates partitions of the vehicle locations table for the next LOCATION_PARTITIONS_AHEAD_DAYS days
+(see vehicle_locations.partitions); does nothing if the table isn't partitioned.
+"""
+from django.core.management import BaseCommand
+
+from vehicle_locations import partitions
+
+
+class Command(BaseCommand):
+
+    def handle(self, *args, **kwargs):
+        for name in partitions.create_future_partitions():
+            print(f'Created partition {name}')
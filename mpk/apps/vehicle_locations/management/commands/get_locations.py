@@ -1,23 +1,32 @@
 import logging
-import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
-import numpy as np
 import pytz
 import requests
 import urllib3
 from django.conf import settings
 from django.core.management import BaseCommand
-from django.db import IntegrityError
+from django.db import connection, transaction
+from django.utils import timezone
+from requests.adapters import HTTPAdapter
 
-from lib import distance
 from routes.models import Route
-from vehicle_locations import const
+from vehicle_locations import capture, engine, shape_engine
+from vehicle_locations.geometry import get_route_geometry
+from vehicle_locations.metrics import TickMetrics, save_tick_metrics
 from vehicle_locations.models import VehicleLocation
+from vehicle_locations.state import VehicleStates
+from vehicle_locations.rollups import update_rollups
+from vehicle_locations.trajectories import append_trajectories
 
 
 LOCATIONS_URL = 'https://mpk.wroc.pl/bus_position'
 
+LOCATION_TABLE = VehicleLocation._meta.db_table
+SAVE_BATCH_SIZE = 1000
+
 
 logger = logging.getLogger('get-locations')
 
@@ -26,210 +35,360 @@ logger = logging.getLogger('get-locations')
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
-def round_or_none(val, num_d):
-    return None if val is None else round(val, num_d)
-
-
-def _is_at_stop(stop, dist):
-    return dist <= stop.radius_m + settings.STOP_ADD_RADIUS_M
-
+def save_locations(locations, update=False):
+    """ Saves locations in the db in bulk
 
-def calculate_position_between_stops(stop_a, stop_b, dist_a, dist_b):
-    std_stops_dist = distance.distance(stop_a, stop_b)
-    this_total_dist = dist_a + dist_b
-
-    if this_total_dist > std_stops_dist * settings.MAX_ALLOWED_DETOUR_RATIO:
-        # We are too far from the planned route
+    Locations with (route, vehicle_id, date) already in the db are skipped, or, if update is set, overwrite the existing ones.
+    Returns a list of skipped locations; when skipping, all locations have to be from a single poll.
+    """
+    fields = [field for field in VehicleLocation._meta.concrete_fields if not field.primary_key]
+    if update:
+        on_conflict = 'do update set {}'.format(', '.join(
+            '{0} = excluded.{0}'.format(connection.ops.quote_name(field.column))
+            for field in fields if field.name not in ('route', 'vehicle_id', 'date', 'date_added')
+        ))
+    else:
+        on_conflict = 'do nothing returning route_id, vehicle_id'
+    query_base = 'insert into {} ({}) values {{}} on conflict (route_id, vehicle_id, date) {}'.format(
+        LOCATION_TABLE,
+        ', '.join(connection.ops.quote_name(field.column) for field in fields),
+        on_conflict,
+    )
+    row_placeholder = '({})'.format(', '.join(['%s'] * len(fields)))
+
+    skipped = []
+    for batch_start in range(0, len(locations), SAVE_BATCH_SIZE):
+        batch = locations[batch_start:batch_start+SAVE_BATCH_SIZE]
+
+        query = query_base.format(', '.join([row_placeholder] * len(batch)))
+        params = [field.get_db_prep_save(field.pre_save(loc, True), connection) for loc in batch for field in fields]
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+            if update:
+                continue
+            saved_keys = set(cursor.fetchall())
+
+        skipped.extend(loc for loc in batch if (loc.route_id, loc.vehicle_id) not in saved_keys)
+
+    return skipped
+
+
+def calculate_position_status(positions, ind, stops):
+    """ Returns position ind from the engine.calculate_positions result as a dict of VehicleLocation fields """
+    if not positions['is_processed'][ind]:
         return {
             'is_processed': False,
-            'unprocessed_reason': const.UNPROC_REASON_TOO_FAR,
+            'unprocessed_reason': int(positions['unprocessed_reason'][ind]),
         }
 
-    else:
-        dist_limited = dist_a - stop_a.radius_m - settings.STOP_ADD_RADIUS_M
-        total_dist_limited = dist_a + dist_b - stop_a.radius_m - stop_b.radius_m - 2 * settings.STOP_ADD_RADIUS_M
-        to_next_stop_ratio = dist_limited / total_dist_limited
-
+    current_stop = stops[positions['stop_ind'][ind]]
+    if positions['is_at_stop'][ind]:
         return {
             'is_processed': True,
-            'is_at_stop': False,
-            'current_stop': stop_a,
-            'to_next_stop_ratio': to_next_stop_ratio,
+            'is_at_stop': True,
+            'current_stop': current_stop,
+            'route_position': float(current_stop.route_index),
         }
 
+    to_next_stop_ratio = round(float(positions['to_next_stop_ratio'][ind]), 3)
+    return {
+        'is_processed': True,
+        'is_at_stop': False,
+        'current_stop': current_stop,
+        'to_next_stop_ratio': to_next_stop_ratio,
+        'route_position': current_stop.route_index + to_next_stop_ratio,
+    }
+
+
+def calculate_locations(els, routes_d, date_created, states=None):
+    """ Calculates positions of elements els; returns a list of (unsaved) VehicleLocation objects
+
+    If states (VehicleStates) are given, last known positions of vehicles are used and updated.
+    """
+    # Check if locations are valid and group them by line
+    els_d = {}
+    for el in els:
+        lat, lng = el['x'], el['y']
+
+        # Example of incorrect coordinates: {'name': 'd', 'type': 'bus', 'y': 2634.2861, 'x': 6429.7183, 'k': 14429515}
+        if not settings.MIN_LAT <= lat <= settings.MAX_LAT or not settings.MIN_LONG <= lng <= settings.MAX_LONG:
+            logger.error(f'Invalid location: {el}')
+            continue
+
+        els_d.setdefault(el['name'], []).append(el)
+
+    positions_engine = shape_engine if settings.POSITION_ENGINE == 'shape' else engine
+
+    locations = []
+    for line, line_els in els_d.items():
+        route, geometry = routes_d[line]
+        stops = geometry.stops
+
+        # Calculate positions of all vehicles of this route
+        vehicle_ids = [el['k'] for el in line_els]
+        last_positions, directions = (None, None) if states is None else states.get(route.id, vehicle_ids, date_created)
+        positions = positions_engine.calculate_positions(geometry, [(el['x'], el['y']) for el in line_els], last_positions, directions)
+        if states is not None:
+            states.update(route.id, vehicle_ids, positions['route_position'], date_created)
+
+        for ind, el in enumerate(line_els):
+            vehicle_id, lat, lng = el['k'], el['x'], el['y']
+
+            if ind in positions['at_stop_inds']:
+                logger.warning('Vehicle at multiple stops: {}   vehicle ({} {} {} {})   stops {}   nearest {}'.format(
+                    date_created,
+                    line, vehicle_id, lat, lng,
+                    [stops[stop_ind] for stop_ind in positions['at_stop_inds'][ind]],
+                    stops[positions['stop_ind'][ind]],
+                ))
+
+            proc_status = calculate_position_status(positions, ind, stops)
+            logger.debug(proc_status)
+
+            locations.append(VehicleLocation(
+                route=route,
+                vehicle_id=vehicle_id,
+                date=date_created,
+                latitude=lat,
+                longitude=lng,
+                is_processed=proc_status['is_processed'],
+                unprocessed_reason=proc_status.get('unprocessed_reason'),
+                is_at_stop=proc_status.get('is_at_stop'),
+                current_stop=proc_status.get('current_stop'),
+                to_next_stop_ratio=proc_status.get('to_next_stop_ratio'),
+                route_position=proc_status.get('route_position'),
+            ))
+
+    return locations
+
+
+def process_vehicles(els, routes_d, date_created, states=None, metrics=None, num_duplicate_ids=0):
+    """ Calculates positions of elements els and saves them in the db in a single transaction; metrics (TickMetrics)
+    are updated if given
+    """
+    if metrics is None:
+        metrics = TickMetrics()
+
+    with metrics.stage('positions'):
+        locations = calculate_locations(els, routes_d, date_created, states)
 
-def process_vehicle(el, routes_d, date_created):
-    """ Calculates position of element el and saves in the db """
-    line, vehicle_id = el['name'], el['k']
-    lat, lng = el['x'], el['y']
-    logger.debug(f'Processing {lat}, {lng}')
-
-    loc = (lat, lng)
-    route, stops = routes_d[line]
-
-    # Check if location is valid
-    # Example of incorrect coordinates: {'name': 'd', 'type': 'bus', 'y': 2634.2861, 'x': 6429.7183, 'k': 14429515}
-    if not settings.MIN_LAT <= lat <= settings.MAX_LAT or not settings.MIN_LONG <= lng <= settings.MAX_LONG:
-        logger.error(f'Invalid location: {el}')
-        return
-
-    # Calculate distance
-    stop_dist = [distance.distance(loc, stop) for stop in stops]
-    logger.debug(stop_dist)
-
-    # Find location
-    is_at_stop_l = [_is_at_stop(stops[ind], stop_dist[ind]) for ind in range(len(stops))]
-    num_true = is_at_stop_l.count(True)
-
-    if num_true > 1:
-        # Vehicle at multiple stops; choosing nearest stop
-        curr_stops_ind_l = [ind for ind, is_at_stop in enumerate(is_at_stop_l) if is_at_stop]
-        curr_stops_dist_l = [stop_dist[ind] for ind in curr_stops_ind_l]
-        _, nearest_stop_ind = min(zip(curr_stops_dist_l, curr_stops_ind_l))
-        nearest_stop = stops[nearest_stop_ind]
-
-        logger.warning('Vehicle at multiple stops: {}   vehicle ({} {} {} {})   stops {}   nearest {}'.format(
-            date_created,
-            line, vehicle_id, lat, lng,
-            [stops[ind] for ind in curr_stops_ind_l],
-            nearest_stop,
-        ))
+    # Save
+    with metrics.stage('save'), transaction.atomic():
+        skipped = save_locations(locations)
+        skipped_ids = set(map(id, skipped))
+        saved = [loc for loc in locations if id(loc) not in skipped_ids]
+        append_trajectories(saved)
+        update_rollups(saved)
+    for loc in skipped:
+        logger.error(f'Duplicate key: (route_id, vehicle_id, date)=({loc.route_id}, {loc.vehicle_id}, {loc.date}) already exists')
+
+    metrics.add_locations(locations, num_duplicate_ids, len(skipped))
+
+
+def load_routes():
+    """ Returns a dict of line: (route, route-geometry)
+
+    Routes whose geometry can't be created (e.g. with fewer than two stops) are skipped, so that they don't stop
+    collecting other lines.
+    """
+    routes_d = {}
+    for route in Route.objects.all():
+        try:
+            routes_d[route.line] = (route, get_route_geometry(route))
+        except ValueError as exc:
+            logger.warning(f'Skipping line {route.line}: {exc}')
 
-        proc_status = {
-            'is_processed': True,
-            'is_at_stop': True,
-            'current_stop': nearest_stop,
-        }
+    return routes_d
 
-    elif num_true == 1:
-        # Vehicle at a stop
-        current_stop_ind = next((ind for ind in range(len(is_at_stop_l)) if is_at_stop_l[ind]))
-        current_stop = stops[current_stop_ind]
 
-        proc_status = {
-            'is_processed': True,
-            'is_at_stop': True,
-            'current_stop': current_stop,
-        }
+def create_session():
+    """ Returns a requests session that can be used by all fetching threads """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=settings.GET_LOCATIONS_NUM_SHARDS)
+    session.mount('https://', adapter)
 
-    else:
-        # Not at stop
-        min_ind = np.argmin(stop_dist)
-        stop1 = stops[min_ind]
-
-        if min_ind == 0 or min_ind == len(stops) - 1:
-            # We are between final and next to final stop or beyond final stop
-            if min_ind == 0:
-                ind_final, ind_other = 0, 1
-            else:
-                ind_final, ind_other = len(stops) - 1, len(stops) - 2
-
-            ind_a, ind_b = min(ind_final, ind_other), max(ind_final, ind_other)
-            dist_loc_next, dist_stop_next = distance.distance(loc, stops[ind_other]), distance.distance(stops[ind_final], stops[ind_other])
-            if dist_stop_next < dist_loc_next:
-                proc_status = {
-                    'is_processed': False,
-                    'unprocessed_reason': const.UNPROC_REASON_BEYOND_FINAL_STOP,
-                }
-
-            else:
-                proc_status = calculate_position_between_stops(stops[ind_a], stops[ind_b], stop_dist[ind_a], stop_dist[ind_b])
-
-        else:
-            # We are between stops (stop_a=min_ind-1 and min_ind) or (min_ind and stop_b=min_ind+1)
-            stop_a, stop_b = stops[min_ind-1], stops[min_ind+1]
-
-            dist_stop_a, dist_stop_b = distance.distance(stop1, stop_a), distance.distance(stop1, stop_b)
-            dist_loc_a, dist_loc_b = distance.distance(loc, stop_a), distance.distance(loc, stop_b)
-
-            diff_a, diff_b = dist_loc_a - dist_stop_a, dist_loc_b - dist_stop_b
-            logger.debug('DIST ({:.0f} {:.0f} {:.0f}) ({:.0f} {:.0f} {:.0f})'.format(dist_loc_a, dist_stop_a, diff_a, dist_loc_b, dist_stop_b, diff_b))
-            if diff_a < diff_b:
-                # We are closer to stop a
-                min_ind -= 1
-
-            proc_status = calculate_position_between_stops(stops[min_ind], stops[min_ind+1], stop_dist[min_ind], stop_dist[min_ind+1])
-
-    logger.debug(proc_status)
-    # Save
+    return session
+
+
+def split_lines(lines_l, num_shards):
+    """ Splits lines into at most num_shards non-empty shards """
+    return [shard for shard in (lines_l[ind::num_shards] for ind in range(num_shards)) if shard]
+
+
+def fetch_locations(session, lines_l, deadline, metrics=None):
+    """ Gets locations of vehicles of lines lines_l
+
+    Failed requests are retried up to GET_LOCATIONS_NUM_RETRIES times, as long as they can finish before deadline (epoch).
+    Returns a tuple (data, date-created) or None if the request failed; metrics (TickMetrics) are updated if given.
+    """
+    if metrics is None:
+        metrics = TickMetrics()
+
+    http_times = []
     try:
-        loc = VehicleLocation.objects.create(
-            route=route,
-            vehicle_id=vehicle_id,
-            date=date_created,
-            latitude=lat,
-            longitude=lng,
-            is_processed=proc_status['is_processed'],
-            unprocessed_reason=proc_status.get('unprocessed_reason'),
-            is_at_stop=proc_status.get('is_at_stop'),
-            current_stop=proc_status.get('current_stop'),
-            to_next_stop_ratio=round_or_none(proc_status.get('to_next_stop_ratio'), 3),
-        )
-        logger.debug(loc)
-        logger.debug('')
-
-    except IntegrityError as exc:
-        # Duplicate key
-        match = re.search('Key \(route_id, vehicle_id, date\)=.* already exists', str(exc))
-        if not match:
-            raise
-
-        logger.error('Duplicate key: {}'.format(match.string[match.start():match.end()]))
+        ret = _fetch_locations(session, lines_l, deadline, metrics, http_times)
+    finally:
+        # Shards are fetched concurrently; the slowest shard, with all its attempts, is recorded
+        metrics.add_stage_s('http', sum(http_times), reduce=max)
+    if ret is None:
+        metrics.add_shard(is_failed=True)
+    else:
+        metrics.add_shard(is_failed=False, feed_lag_s=(timezone.now() - ret[1]).total_seconds())
 
+    return ret
 
-class Command(BaseCommand):
 
-    def handle(self, *args, **kwargs):
-        # Routes
-        routes = Route.objects.all()
-        lines_l = [r.line for r in routes]
-        if not lines_l:
-            raise RuntimeError('No routes')
-        routes_d = {r.line: (r, list(r.stop_set.all())) for r in routes}
-
-        # Send request
-        locations_data = {'busList[][]': lines_l}
+def _fetch_locations(session, lines_l, deadline, metrics, http_times):
+    """ See fetch_locations; durations of requests are appended to http_times """
+    locations_data = {'busList[][]': lines_l}
+    shard_str = ','.join(lines_l)
+
+    for attempt in range(settings.GET_LOCATIONS_NUM_RETRIES + 1):
+        if attempt:
+            # Back off, doubling the pause after each retry
+            time.sleep(max(min(settings.GET_LOCATIONS_RETRY_BACKOFF_S * 2 ** (attempt - 1), deadline - time.time()), 0))
+
+        timeout = min(settings.GET_LOCATIONS_TIMEOUT_S, deadline - time.time())
+        if timeout <= 0:
+            logger.error(f'No time left for request, giving up..  lines {shard_str}')
+            return None
+
+        if attempt:
+            logger.info(f'Retrying request ({attempt}/{settings.GET_LOCATIONS_NUM_RETRIES})..  lines {shard_str}')
+
+        # Send request and get data; malformed responses are retried too
         try:
-            resp = requests.post(
-                LOCATIONS_URL,
-                data=locations_data,
-                verify=False,
-                timeout=settings.GET_LOCATIONS_TIMEOUT_S,
-            )
+            start_time = time.perf_counter()
+            try:
+                resp = session.post(
+                    LOCATIONS_URL,
+                    data=locations_data,
+                    verify=False,
+                    timeout=timeout,
+                )
+            finally:
+                http_times.append(time.perf_counter() - start_time)
             resp.raise_for_status()
 
+            # Check if response is empty
+            if not len(resp.content):
+                logger.error(f'Response empty..  lines {shard_str}')
+                continue
+
+            with metrics.stage('parse'):
+                data = resp.json()
+                date_created = datetime.strptime(resp.headers['Date'], '%a, %d %b %Y %H:%M:%S GMT').replace(tzinfo=pytz.utc)
+
         except requests.exceptions.Timeout:
-            logger.error('Request timed out, exiting..')
-            return
+            logger.error(f'Request timed out..  lines {shard_str}')
+            continue
 
         except Exception as exc:
-            msg = 'Error getting data, exiting..  {}.{}: {}'.format(type(exc).__module__, type(exc).__qualname__, str(exc))
+            msg = 'Error getting data..  lines {}  {}.{}: {}'.format(shard_str, type(exc).__module__, type(exc).__qualname__, str(exc))
             logger.error(msg)
-            return
+            continue
+
+        # Keep raw data
+        try:
+            capture.append_capture(date_created, resp.content)
+        except Exception as exc:
+            logger.exception(exc)
+
+        return data, date_created
+
+    return None
+
+
+def remove_duplicate_vehicles(data):
+    """ Returns a list of locations with all records of duplicate vehicle ids removed """
+    # There might be duplicate vehicle ids in the data,
+    # e.g. {'name': '3', 'type': 'tram', 'y': 16.98013, 'x': 51.12673, 'k': 14339663} and {'name': '3', 'type': 'tram', 'y': 17.03928, 'x': 51.107746, 'k': 14339663}
+    # In that case, remove all duplicate records
+    # (a) Convert data to a dict of vehicle-id: list-of-locations
+    data_d = {}
+    for d in data:
+        data_d.setdefault(d['k'], []).append(d)
+    # (b) Remove duplicates
+    for vehicle_id in list(data_d.keys()):
+        if len(data_d[vehicle_id]) != 1:
+            logger.error(f'Duplicate vehicle id {vehicle_id}: {data_d[vehicle_id]}')
+            del data_d[vehicle_id]
 
-        # Check if response is empty
-        if not len(resp.content):
-            logger.error('Response empty, exiting..')
-            return
+    return [el[0] for el in data_d.values()]
 
+
+def collect_locations(session, routes_d, states=None, interval=None):
+    """ Gets current locations of vehicles of all routes and saves them in the db
+
+    Lines are split into shards that are fetched concurrently; each shard is saved with the date from its response.
+    A failed shard only loses data of its lines. Shards are saved after all of them have been fetched, in a single
+    transaction, so that locations of the poll become visible at once (see mpk.live) and the transaction isn't kept
+    open while waiting for responses.
+    If states (VehicleStates) aren't given, they are read from the db. Metrics of the poll are saved at the end;
+    interval is the interval between polls (default: COLLECT_LOCATIONS_INTERVAL_S).
+    """
+    if not routes_d:
+        raise RuntimeError('No routes')
+
+    if states is None:
+        states = VehicleStates.from_db(routes_d, timezone.now())
+
+    metrics = TickMetrics()
+    deadline = time.time() + settings.GET_LOCATIONS_BUDGET_S
+    shards = split_lines(list(routes_d.keys()), settings.GET_LOCATIONS_NUM_SHARDS)
+
+    try:
         # Get data
-        data = resp.json()
-        date_created = datetime.strptime(resp.headers['Date'], '%a, %d %b %Y %H:%M:%S GMT').replace(tzinfo=pytz.utc)
-
-        # There might be duplicate vehicle ids in the data,
-        # e.g. {'name': '3', 'type': 'tram', 'y': 16.98013, 'x': 51.12673, 'k': 14339663} and {'name': '3', 'type': 'tram', 'y': 17.03928, 'x': 51.107746, 'k': 14339663}
-        # In that case, remove all duplicate records
-        # (a) Convert data to a dict of vehicle-id: list-of-locations
-        data_d = {}
-        for d in data:
-            data_d.setdefault(d['k'], []).append(d)
-        # (b) Remove duplicates
-        for vehicle_id in list(data_d.keys()):
-            if len(data_d[vehicle_id]) != 1:
-                logger.error(f'Duplicate vehicle id {vehicle_id}: {data_d[vehicle_id]}')
-                del data_d[vehicle_id]
-
-        # Save data
-        for el in data_d.values():
-            process_vehicle(el[0], routes_d, date_created)
+        results = []
+        with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+            futures = {executor.submit(fetch_locations, session, shard, deadline, metrics): shard for shard in shards}
+
+            for future in as_completed(futures):
+                # Errors of a shard don't stop processing of the other ones
+                try:
+                    ret = future.result()
+                    if ret is not None:
+                        results.append((futures[future], *ret))
+
+                except Exception as exc:
+                    logger.error('Getting lines {} failed'.format(','.join(futures[future])))
+                    logger.exception(exc)
+
+        # Save data; process_vehicles rolls back only its shard
+        with transaction.atomic():
+            for shard, data, date_created in results:
+                try:
+                    with metrics.stage('dedup'):
+                        els = remove_duplicate_vehicles(data)
+                    process_vehicles(els, routes_d, date_created, states, metrics, num_duplicate_ids=len(data) - len(els))
+
+                except Exception as exc:
+                    logger.error('Processing lines {} failed'.format(','.join(shard)))
+                    logger.exception(exc)
+
+    finally:
+        save_metrics(metrics, settings.COLLECT_LOCATIONS_INTERVAL_S if interval is None else interval)
+
+
+def save_metrics(metrics, interval):
+    """ Finishes and saves metrics of a poll; metrics errors don't stop collecting """
+    metrics.finish()
+    if metrics.total_s > settings.INGEST_SLOW_TICK_RATIO * interval:
+        logger.warning('Slow poll: {:.2f}s of {}s  ({})'.format(
+            metrics.total_s, interval,
+            '  '.join('{} {:.2f}s'.format(name, duration) for name, duration in metrics.stage_s.items()),
+        ))
+
+    try:
+        save_tick_metrics(metrics)
+    except Exception as exc:
+        logger.exception(exc)
+
+
+class Command(BaseCommand):
+
+    def handle(self, *args, **kwargs):
+        routes_d = load_routes()
 
+        with create_session() as session:
+            collect_locations(session, routes_d)
@@ -0,0 +1,100 @@
+"""
+Reports statistics of polls of the locations feed (see vehicle_locations.metrics) over a time window:
+percentiles of durations of polls and their stages and of the feed lag, and totals of vehicles, unprocessed vehicles,
+duplicates and failed shards.
+"""
+import json
+from collections import Counter
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.utils import timezone
+
+from vehicle_locations import const
+from vehicle_locations.metrics import STAGES
+from vehicle_locations.models import IngestTick
+
+
+PERCENTILES = [50, 90, 99]
+
+
+def format_percentiles(values):
+    values = np.array([val for val in values if val is not None], dtype=float)
+    if not len(values):
+        return '-'
+
+    return '  '.join(
+        ['p{} {:7.3f}'.format(percentile, val) for percentile, val in zip(PERCENTILES, np.percentile(values, PERCENTILES))] +
+        ['max {:7.3f}'.format(values.max())]
+    )
+
+
+class Command(BaseCommand):
+
+    def add_arguments(self, parser):
+        parser.add_argument('-H', '--hours', dest='hours', type=float, default=24, help='Report polls from this many last hours')
+        parser.add_argument('-l', '--lines', dest='lines', action='store_true', help='Report vehicles per line')
+        parser.add_argument('-d', '--delete-older-than-days', dest='delete_days', type=int, help='Delete older metrics instead of reporting')
+
+    def handle(self, *args, **kwargs):
+        # Parse arguments
+        hours = kwargs['hours']
+        list_lines = kwargs['lines']
+        delete_days = kwargs['delete_days']
+
+        # Delete old metrics
+        if delete_days is not None:
+            if delete_days <= 0:
+                raise ValueError('delete-older-than-days must be positive')
+            num_deleted, _ = IngestTick.objects.filter(date__lt=timezone.now() - timedelta(days=delete_days)).delete()
+            print(f'Deleted {num_deleted} polls')
+            return
+
+        ticks = list(IngestTick.objects.filter(date__gte=timezone.now() - timedelta(hours=hours)).order_by('date'))
+        if not ticks:
+            print('No polls')
+            return
+
+        # Durations
+        interval = settings.COLLECT_LOCATIONS_INTERVAL_S
+        print('Polls: {}  ({} to {})'.format(len(ticks), ticks[0].date, ticks[-1].date))
+        print('Slow polls (>{:.0f}% of {}s): {}   overruns: {}'.format(
+            100 * settings.INGEST_SLOW_TICK_RATIO, interval,
+            sum(tick.total_s > settings.INGEST_SLOW_TICK_RATIO * interval for tick in ticks),
+            sum(tick.total_s > interval for tick in ticks),
+        ))
+        print('')
+        print('{:<14} {}'.format('total [s]', format_percentiles(tick.total_s for tick in ticks)))
+        for stage in STAGES:
+            print('{:<14} {}'.format(f'{stage} [s]', format_percentiles(getattr(tick, f'{stage}_s') for tick in ticks)))
+        print('{:<14} {}'.format('feed lag [s]', format_percentiles(tick.feed_lag_s for tick in ticks)))
+        print('{:<14} {}'.format('vehicles', format_percentiles(tick.num_vehicles for tick in ticks)))
+
+        # Outcomes
+        num_vehicles = sum(tick.num_vehicles for tick in ticks)
+        unprocessed_counts = Counter()
+        for tick in ticks:
+            unprocessed_counts.update({int(reason): count for reason, count in json.loads(tick.unprocessed_counts).items()})
+
+        print('')
+        print(f'Vehicles: {num_vehicles}')
+        for reason, name in const.UNPROC_REASON_CHOICES:
+            print('    {}: {}  ({:.2f}%)'.format(name, unprocessed_counts[reason], 100 * unprocessed_counts[reason] / max(num_vehicles, 1)))
+        print('Duplicate vehicle ids: {}   duplicate locations: {}'.format(
+            sum(tick.num_duplicate_ids for tick in ticks),
+            sum(tick.num_duplicate_locations for tick in ticks),
+        ))
+        print('Failed shards: {} of {}'.format(sum(tick.num_failed_shards for tick in ticks), sum(tick.num_shards for tick in ticks)))
+
+        # Lines
+        if list_lines:
+            vehicles_per_line = Counter()
+            for tick in ticks:
+                vehicles_per_line.update(json.loads(tick.vehicles_per_line))
+
+            print('')
+            print('Mean vehicles per poll:')
+            for line, count in sorted(vehicles_per_line.items(), key=lambda item: -item[1]):
+                print('    {:>5} {:7.2f}'.format(line, count / len(ticks)))
@@ -0,0 +1,106 @@
+"""
+Recalculates positions of vehicles from the raw feed capture log (see vehicle_locations.capture), using the current
+routes and stops, and overwrites the corresponding vehicle locations in the db.
+Days are processed in parallel; each day is saved in a single transaction, together with its rebuilt trajectories
+and rollups.
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.db import connection, transaction
+
+from mpk.script.create_plot.lib import segment_cache
+from vehicle_locations import capture
+from vehicle_locations.geometry import clear_route_geometry_cache
+from vehicle_locations.rollups import build_rollups
+from vehicle_locations.state import VehicleStates
+from vehicle_locations.trajectories import build_trajectories, get_local_day
+
+from .get_locations import calculate_locations, load_routes, remove_duplicate_vehicles, save_locations
+
+
+REPROCESS_BATCH_SIZE = 20000
+
+
+def reprocess_file(filename, lines_l):
+    """ Recalculates locations from capture file filename; returns the number of saved locations """
+    # Stops might have been modified without modifying their route
+    clear_route_geometry_cache()
+
+    routes_d = load_routes()
+    if lines_l is not None:
+        routes_d = {line: route_data for line, route_data in routes_d.items() if line in lines_l}
+
+    num_saved = 0
+    try:
+        with transaction.atomic():
+            locations, states, days = [], VehicleStates(), set()
+            for date_created, data in capture.read_capture_file(filename):
+                days.add(get_local_day(date_created))
+                els = [el for el in remove_duplicate_vehicles(data) if el['name'] in routes_d]
+                locations.extend(calculate_locations(els, routes_d, date_created, states))
+
+                if len(locations) >= REPROCESS_BATCH_SIZE:
+                    save_locations(locations, update=True)
+                    num_saved += len(locations)
+                    locations = []
+
+            save_locations(locations, update=True)
+            num_saved += len(locations)
+
+            route_ids = [route.id for route, _ in routes_d.values()]
+            for day in days:
+                build_trajectories(day, route_ids)
+                build_rollups(day, route_ids)
+
+        # Cached plots of these days are out of date
+        segment_cache.invalidate_routes(route_ids)
+
+    finally:
+        connection.close()
+
+    return num_saved
+
+
+class Command(BaseCommand):
+
+    def add_arguments(self, parser):
+        parser.add_argument('-f', '--date-from', dest='date_from', help='First day (YYYY-MM-DD)', required=True)
+        parser.add_argument('-t', '--date-to', dest='date_to', help='Last day (YYYY-MM-DD)', required=True)
+        parser.add_argument('-l', '--lines', dest='lines', nargs='+', help='Lines (default: all)')
+        parser.add_argument('-c', '--capture-dir', dest='capture_dir', help='Capture dir (default: FEED_CAPTURE_DIR)')
+        parser.add_argument('-p', '--num-processes', dest='num_processes', type=int, default=os.cpu_count(), help='Number of processes')
+
+    def handle(self, *args, **kwargs):
+        # Parse arguments
+        date_from = datetime.strptime(kwargs['date_from'], '%Y-%m-%d').date()
+        date_to = datetime.strptime(kwargs['date_to'], '%Y-%m-%d').date()
+        lines_l = kwargs['lines']
+        capture_dir = kwargs['capture_dir'] or settings.FEED_CAPTURE_DIR
+        num_processes = kwargs['num_processes']
+
+        if date_to < date_from:
+            raise ValueError('date-to earlier than date-from')
+        if capture_dir is None:
+            raise ValueError('Capture dir not set')
+
+        # Capture files
+        filenames = []
+        this_date = date_from
+        while this_date <= date_to:
+            filename = capture.get_capture_filename(this_date, capture_dir)
+            if os.path.isfile(filename):
+                filenames.append(filename)
+            else:
+                print(f'No capture file for {this_date}: {filename}')
+            this_date += timedelta(days=1)
+
+        # Process; workers are forked, so they mustn't share the db connection
+        connection.close()
+        with ProcessPoolExecutor(max_workers=num_processes, mp_context=multiprocessing.get_context('fork')) as executor:
+            for filename, num_saved in zip(filenames, executor.map(reprocess_file, filenames, [lines_l] * len(filenames))):
+                print(f'{filename}: saved {num_saved} locations')
@@ -0,0 +1,150 @@
+"""
+Metrics of polls of the locations feed.
+Each poll (tick) records durations of its stages, numbers of vehicles per line and per unprocessed reason, numbers of
+duplicates and the feed lag (local time of receiving a response minus its Date header, which has a resolution of 1s).
+Ticks are saved in the IngestTick table and, if INGEST_METRICS_TEXTFILE is set, written to a Prometheus textfile
+(for node_exporter's textfile collector). See the ingest_stats command.
+"""
+import json
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import const
+from .models import IngestTick
+
+
+STAGES = ['http', 'parse', 'dedup', 'positions', 'save']
+
+
+class TickMetrics:
+    """ Metrics of a single poll; shards processed in different threads update it concurrently """
+
+    def __init__(self):
+        self.date = timezone.now()
+        self._start_time = time.perf_counter()
+        self._lock = threading.Lock()
+
+        self.total_s = None
+        self.stage_s = dict.fromkeys(STAGES, 0.)
+        self.num_shards, self.num_failed_shards = 0, 0
+        self.num_duplicate_ids, self.num_duplicate_locations = 0, 0
+        self.feed_lag_s = None
+        self.unprocessed_counts = Counter()
+        self.vehicles_per_line = Counter()
+
+    @contextmanager
+    def stage(self, name, reduce=sum):
+        """ Measures the duration of stage name; durations of the stage in different shards are combined with reduce """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_s(name, time.perf_counter() - start_time, reduce)
+
+    def add_stage_s(self, name, duration, reduce=sum):
+        """ Adds duration of stage name (see stage) """
+        with self._lock:
+            self.stage_s[name] = reduce([self.stage_s[name], duration])
+
+    def add_shard(self, is_failed, feed_lag_s=None):
+        with self._lock:
+            self.num_shards += 1
+            self.num_failed_shards += is_failed
+            if feed_lag_s is not None:
+                self.feed_lag_s = feed_lag_s if self.feed_lag_s is None else max(self.feed_lag_s, feed_lag_s)
+
+    def add_locations(self, locations, num_duplicate_ids, num_duplicate_locations):
+        """ Adds counts of (calculated) VehicleLocation objects locations of a shard """
+        with self._lock:
+            self.num_duplicate_ids += num_duplicate_ids
+            self.num_duplicate_locations += num_duplicate_locations
+            for loc in locations:
+                self.vehicles_per_line[loc.route.line] += 1
+                if not loc.is_processed:
+                    self.unprocessed_counts[loc.unprocessed_reason] += 1
+
+    def finish(self):
+        self.total_s = time.perf_counter() - self._start_time
+
+    @property
+    def num_vehicles(self):
+        return sum(self.vehicles_per_line.values())
+
+
+def save_tick_metrics(metrics):
+    """ Saves metrics of a finished poll in the db and the Prometheus textfile """
+    IngestTick.objects.create(
+        date=metrics.date,
+        total_s=metrics.total_s,
+        http_s=metrics.stage_s['http'],
+        parse_s=metrics.stage_s['parse'],
+        dedup_s=metrics.stage_s['dedup'],
+        positions_s=metrics.stage_s['positions'],
+        save_s=metrics.stage_s['save'],
+        num_shards=metrics.num_shards,
+        num_failed_shards=metrics.num_failed_shards,
+        num_vehicles=metrics.num_vehicles,
+        num_duplicate_ids=metrics.num_duplicate_ids,
+        num_duplicate_locations=metrics.num_duplicate_locations,
+        feed_lag_s=metrics.feed_lag_s,
+        unprocessed_counts=json.dumps(metrics.unprocessed_counts),
+        vehicles_per_line=json.dumps(metrics.vehicles_per_line),
+    )
+
+    if settings.INGEST_METRICS_TEXTFILE is not None:
+        write_textfile(metrics, settings.INGEST_METRICS_TEXTFILE)
+
+
+def write_textfile(metrics, filename):
+    """ Writes metrics of the last poll to Prometheus textfile filename """
+    reason_names = {reason: name.lower().replace(' ', '_') for reason, name in const.UNPROC_REASON_CHOICES}
+
+    lines = [
+        '# HELP mpk_ingest_last_tick_timestamp_seconds Start of the last poll',
+        '# TYPE mpk_ingest_last_tick_timestamp_seconds gauge',
+        'mpk_ingest_last_tick_timestamp_seconds {:.3f}'.format(metrics.date.timestamp()),
+        '# HELP mpk_ingest_tick_seconds Duration of the last poll',
+        '# TYPE mpk_ingest_tick_seconds gauge',
+        'mpk_ingest_tick_seconds {:.6f}'.format(metrics.total_s),
+        '# HELP mpk_ingest_stage_seconds Duration of stages of the last poll',
+        '# TYPE mpk_ingest_stage_seconds gauge',
+    ]
+    lines.extend('mpk_ingest_stage_seconds{{stage="{}"}} {:.6f}'.format(name, metrics.stage_s[name]) for name in STAGES)
+    lines.extend([
+        '# HELP mpk_ingest_failed_shards Number of shards of the last poll that couldn\'t be fetched',
+        '# TYPE mpk_ingest_failed_shards gauge',
+        f'mpk_ingest_failed_shards {metrics.num_failed_shards}',
+        '# HELP mpk_ingest_duplicates Number of records dropped as duplicates in the last poll',
+        '# TYPE mpk_ingest_duplicates gauge',
+        f'mpk_ingest_duplicates{{kind="vehicle_id"}} {metrics.num_duplicate_ids}',
+        f'mpk_ingest_duplicates{{kind="location"}} {metrics.num_duplicate_locations}',
+        '# HELP mpk_ingest_vehicles Number of vehicles of each line in the last poll',
+        '# TYPE mpk_ingest_vehicles gauge',
+    ])
+    lines.extend(f'mpk_ingest_vehicles{{line="{line}"}} {count}' for line, count in sorted(metrics.vehicles_per_line.items()))
+    lines.extend([
+        '# HELP mpk_ingest_unprocessed Number of unprocessed vehicles of each reason in the last poll',
+        '# TYPE mpk_ingest_unprocessed gauge',
+    ])
+    lines.extend(
+        'mpk_ingest_unprocessed{{reason="{}"}} {}'.format(name, metrics.unprocessed_counts[reason])
+        for reason, name in reason_names.items()
+    )
+    if metrics.feed_lag_s is not None:
+        lines.extend([
+            '# HELP mpk_ingest_feed_lag_seconds Local time of receiving the last response minus its Date header',
+            '# TYPE mpk_ingest_feed_lag_seconds gauge',
+            'mpk_ingest_feed_lag_seconds {:.3f}'.format(metrics.feed_lag_s),
+        ])
+
+    # The collector mustn't see a partially written file
+    tmp_filename = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp_filename, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_filename, filename)
@@ -0,0 +1,34 @@
+# Generated by Django 2.2.17 on 2026-10-18 05:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vehicle_locations', '0005_fix_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestTick',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateTimeField(db_index=True)),
+                ('total_s', models.FloatField()),
+                ('http_s', models.FloatField()),
+                ('parse_s', models.FloatField()),
+                ('dedup_s', models.FloatField()),
+                ('positions_s', models.FloatField()),
+                ('save_s', models.FloatField()),
+                ('num_shards', models.SmallIntegerField()),
+                ('num_failed_shards', models.SmallIntegerField()),
+                ('num_vehicles', models.IntegerField()),
+                ('num_duplicate_ids', models.IntegerField()),
+                ('num_duplicate_locations', models.IntegerField()),
+                ('feed_lag_s', models.FloatField(blank=True, null=True)),
+                ('unprocessed_counts', models.TextField()),
+                ('vehicles_per_line', models.TextField()),
+            ],
+        ),
+    ]
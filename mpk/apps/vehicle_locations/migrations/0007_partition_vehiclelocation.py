@@ -0,0 +1,128 @@
+# Generated by Django 2.2.17 on 2026-10-18 06:10
+
+from datetime import datetime, timedelta
+
+import pytz
+from django.conf import settings
+from django.db import migrations
+
+
+TABLE = 'vehicle_locations_vehiclelocation'
+LEGACY_TABLE = f'{TABLE}_legacy'
+INDEX_NAME = 'vehicle_loc_route_i_ff2826_idx'
+
+# Daily partitions are created for this many days ahead; later ones are created by create_location_partitions
+# (helpers of vehicle_locations.partitions aren't used, so that changing them doesn't change this migration)
+PARTITIONS_AHEAD_DAYS = 7
+
+
+def _get_day_start(day):
+    """ Returns the start of local day day in UTC """
+    return settings.LOCAL_TIMEZONE.localize(datetime.combine(day, datetime.min.time())).astimezone(pytz.utc)
+
+
+def _get_unique_name(schema_editor, table):
+    """ Returns the name of the unique constraint of table table
+
+    Names generated by Django are truncated to the length of PostgreSQL identifiers, so it's read from the db.
+    """
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('select conname from pg_constraint where conrelid = %s::regclass and contype = \'u\'', [table])
+        [(name,)] = cursor.fetchall()
+
+    return name
+
+
+def partition_vehicle_locations(apps, schema_editor):
+    """ Converts the table into a table partitioned by date; the existing table becomes its first (legacy) partition
+
+    Requires PostgreSQL 11 or later (indexes of partitioned tables). Constraint and index names of the partitioned table
+    are the ones created by the previous migrations.
+    The partitioned table has no primary key (it would have to include date); ids are still taken from the sequence,
+    and indexed, as Django deletes related rows by id. The legacy partition gets its own index of ids, as its primary key
+    can't be attached to a non-unique index.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    # The legacy partition ends after today, or after the latest location if there are later ones
+    first_day = datetime.now(settings.LOCAL_TIMEZONE).date() + timedelta(days=1)
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'select max(date) from {TABLE}')
+        [(latest_date,)] = cursor.fetchall()
+    if latest_date is not None:
+        first_day = max(first_day, latest_date.astimezone(settings.LOCAL_TIMEZONE).date() + timedelta(days=1))
+
+    unique_name = _get_unique_name(schema_editor, TABLE)
+
+    # Free the names for the partitioned table
+    schema_editor.execute(f'alter table {TABLE} rename to {LEGACY_TABLE}')
+    schema_editor.execute(f'alter table {LEGACY_TABLE} rename constraint {unique_name} to {LEGACY_TABLE}_uniq')
+    schema_editor.execute(f'alter index {INDEX_NAME} rename to {LEGACY_TABLE}_route_id_date_idx')
+
+    # Partitioned table; dropping the legacy partition mustn't drop the id sequence
+    schema_editor.execute(f'create table {TABLE} (like {LEGACY_TABLE} including defaults) partition by range (date)')
+    schema_editor.execute(f'alter sequence {TABLE}_id_seq owned by {TABLE}.id')
+    schema_editor.execute(f'alter table {TABLE} add constraint {unique_name} unique (route_id, vehicle_id, date)')
+    schema_editor.execute(f'create index {INDEX_NAME} on {TABLE} (route_id, date)')
+    schema_editor.execute(f'create index {TABLE}_id_idx on {TABLE} (id)')
+    schema_editor.execute(
+        f'alter table {TABLE} add constraint {TABLE}_route_id_fk foreign key (route_id) references routes_route (id) '
+        'deferrable initially deferred'
+    )
+    schema_editor.execute(
+        f'alter table {TABLE} add constraint {TABLE}_current_stop_id_fk foreign key (current_stop_id) references stops_stop (id) '
+        'deferrable initially deferred'
+    )
+
+    # Existing data
+    schema_editor.execute(
+        f'alter table {TABLE} attach partition {LEGACY_TABLE} for values from (minvalue) to (\'{_get_day_start(first_day).isoformat()}\')'
+    )
+
+    # Daily partitions ahead
+    for ind in range(PARTITIONS_AHEAD_DAYS):
+        day = first_day + timedelta(days=ind)
+        schema_editor.execute('create table {}_p{} partition of {} for values from (\'{}\') to (\'{}\')'.format(
+            TABLE, day.strftime('%Y%m%d'), TABLE, _get_day_start(day).isoformat(), _get_day_start(day + timedelta(days=1)).isoformat(),
+        ))
+
+
+def unpartition_vehicle_locations(apps, schema_editor):
+    """ Moves locations of all partitions back into the legacy partition, which becomes the table again """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    unique_name = _get_unique_name(schema_editor, TABLE)
+
+    schema_editor.execute(f'alter table {TABLE} detach partition {LEGACY_TABLE}')
+    schema_editor.execute(f'insert into {LEGACY_TABLE} select * from {TABLE}')
+    # Deferred foreign key checks of the inserted rows would prevent altering the table
+    schema_editor.execute('set constraints all immediate')
+    schema_editor.execute(f'alter sequence {TABLE}_id_seq owned by {LEGACY_TABLE}.id')
+    schema_editor.execute(f'drop table {TABLE}')
+
+    # Constraints and indexes cloned from the partitioned table
+    schema_editor.execute(f'alter table {LEGACY_TABLE} drop constraint if exists {TABLE}_route_id_fk')
+    schema_editor.execute(f'alter table {LEGACY_TABLE} drop constraint if exists {TABLE}_current_stop_id_fk')
+    schema_editor.execute(f'drop index if exists {LEGACY_TABLE}_id_idx')
+
+    schema_editor.execute(f'alter table {LEGACY_TABLE} rename to {TABLE}')
+    schema_editor.execute(f'alter table {TABLE} rename constraint {LEGACY_TABLE}_uniq to {unique_name}')
+
+    # The index of the legacy partition might have been recreated by later migrations under another name
+    schema_editor.execute(f'drop index if exists {LEGACY_TABLE}_route_id_date_idx')
+    schema_editor.execute(f'create index {INDEX_NAME} on {TABLE} (route_id, date)')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('routes', '0003_route_shape'),
+        ('stops', '0005_delete_unneeded_fk_index'),
+        ('vehicle_locations', '0006_ingesttick'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_vehicle_locations, unpartition_vehicle_locations),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 2.2.17 on 2026-10-18 05:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('routes', '0003_route_shape'),
+        ('vehicle_locations', '0007_partition_vehiclelocation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VehicleTrajectory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('vehicle_id', models.IntegerField()),
+                ('hour', models.DateTimeField()),
+                ('epochs', models.BinaryField()),
+                ('positions', models.BinaryField()),
+                ('route', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='routes.Route')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='vehicletrajectory',
+            index=models.Index(fields=['route', 'hour'], name='vehicle_loc_route_i_86d36f_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='vehicletrajectory',
+            unique_together={('route', 'vehicle_id', 'hour')},
+        ),
+    ]
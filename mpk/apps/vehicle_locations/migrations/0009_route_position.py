@@ -0,0 +1,43 @@
+# Generated by Django 2.2.17 on 2026-10-18 06:00
+
+from django.db import migrations, models
+
+
+TABLE = 'vehicle_locations_vehiclelocation'
+INDEX_NAME = 'vehicle_loc_route_date_covering_idx'
+
+
+def create_covering_index(apps, schema_editor):
+    """ Plots read (vehicle_id, date, route_position) of a route and period; PostgreSQL can read them from the index only """
+    include = ' include (vehicle_id, route_position)' if schema_editor.connection.vendor == 'postgresql' else ''
+    schema_editor.execute(f'create index {INDEX_NAME} on {TABLE} (route_id, date){include}')
+
+
+def drop_covering_index(apps, schema_editor):
+    schema_editor.execute(f'drop index {INDEX_NAME}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vehicle_locations', '0008_vehicletrajectory'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vehiclelocation',
+            name='route_position',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.RunSQL(
+            f'update {TABLE} '
+            'set route_position = (select s.route_index from stops_stop s where s.id = current_stop_id) + case when is_at_stop then 0 else to_next_stop_ratio end '
+            'where is_processed',
+            migrations.RunSQL.noop,
+        ),
+        migrations.RunPython(create_covering_index, drop_covering_index),
+        migrations.RemoveIndex(
+            model_name='vehiclelocation',
+            name='vehicle_loc_route_i_ff2826_idx',
+        ),
+    ]
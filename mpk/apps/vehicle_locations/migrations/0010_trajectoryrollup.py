@@ -0,0 +1,41 @@
+# Generated by Django 2.2.17 on 2026-10-18 06:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('routes', '0003_route_shape'),
+        ('vehicle_locations', '0009_route_position'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrajectoryRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('level', models.IntegerField()),
+                ('vehicle_id', models.IntegerField()),
+                ('bucket', models.DateTimeField()),
+                ('first_date', models.DateTimeField(blank=True, null=True)),
+                ('first_position', models.FloatField(blank=True, null=True)),
+                ('last_date', models.DateTimeField(blank=True, null=True)),
+                ('last_position', models.FloatField(blank=True, null=True)),
+                ('num_locations', models.IntegerField()),
+                ('num_unprocessed', models.IntegerField()),
+                ('num_lead_unprocessed', models.IntegerField()),
+                ('num_trail_unprocessed', models.IntegerField()),
+                ('route', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='routes.Route')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='trajectoryrollup',
+            index=models.Index(fields=['route', 'level', 'bucket'], name='vehicle_loc_route_i_856923_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='trajectoryrollup',
+            unique_together={('route', 'level', 'vehicle_id', 'bucket')},
+        ),
+    ]
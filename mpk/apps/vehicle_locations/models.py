@@ -17,14 +17,14 @@ class VehicleLocation(models.Model):
     is_at_stop = models.BooleanField(null=True, blank=True)
     current_stop = models.ForeignKey(Stop, on_delete=models.CASCADE, null=True, blank=True, db_index=False)
     to_next_stop_ratio = models.FloatField(null=True, blank=True)
+    route_position = models.FloatField(null=True, blank=True)  # current_stop.route_index + to_next_stop_ratio; null if not processed
 
     class Meta:
         unique_together = [
             ['route', 'vehicle_id', 'date'],
         ]
-        indexes = [
-            models.Index(fields=['route', 'date']),
-        ]
+        # Index on (route, date) including vehicle_id and route_position is created in migration 0009
+        # (Django can't create covering indexes)
         ordering = [
             'route',
             'vehicle_id',
@@ -51,3 +51,94 @@ class VehicleLocation(models.Model):
         return ret
 
 
+class VehicleTrajectory(models.Model):
+    """ Compact copy of locations of a vehicle of a route from a single hour (see vehicle_locations.trajectories)
+
+    epochs and positions are packed little-endian arrays of int32 epoch seconds and float32 positions along the route
+    (stop index plus ratio to the next stop, NaN if not processed). Samples are in the order they were appended.
+    """
+    route = models.ForeignKey(Route, on_delete=models.CASCADE, db_index=False)
+    vehicle_id = models.IntegerField()
+    hour = models.DateTimeField()  # start of the hour
+    epochs = models.BinaryField()
+    positions = models.BinaryField()
+
+    class Meta:
+        unique_together = [
+            ['route', 'vehicle_id', 'hour'],
+        ]
+        indexes = [
+            models.Index(fields=['route', 'hour']),
+        ]
+
+    def __str__(self):
+        return 'VehicleTrajectory {} {} {}: {} samples'.format(
+            self.route_id,
+            self.vehicle_id,
+            self.hour,
+            len(self.epochs) // 4,
+        )
+
+
+class TrajectoryRollup(models.Model):
+    """ Summary of locations of a vehicle of a route in a bucket of level seconds (see vehicle_locations.rollups)
+
+    First and last processed locations of the bucket are kept; unprocessed locations are only counted, separately
+    before the first processed location (lead) and after the last one (trail). If no location in the bucket is
+    processed, first and last locations are null and all unprocessed locations are both lead and trail.
+    """
+    route = models.ForeignKey(Route, on_delete=models.CASCADE, db_index=False)
+    level = models.IntegerField()  # bucket length [s]
+    vehicle_id = models.IntegerField()
+    bucket = models.DateTimeField()  # start of the bucket
+    first_date = models.DateTimeField(null=True, blank=True)
+    first_position = models.FloatField(null=True, blank=True)
+    last_date = models.DateTimeField(null=True, blank=True)
+    last_position = models.FloatField(null=True, blank=True)
+    num_locations = models.IntegerField()
+    num_unprocessed = models.IntegerField()
+    num_lead_unprocessed = models.IntegerField()
+    num_trail_unprocessed = models.IntegerField()
+
+    class Meta:
+        unique_together = [
+            ['route', 'level', 'vehicle_id', 'bucket'],
+        ]
+        indexes = [
+            models.Index(fields=['route', 'level', 'bucket']),
+        ]
+
+    def __str__(self):
+        return 'TrajectoryRollup {} {}s {} {}: {} locations'.format(
+            self.route_id,
+            self.level,
+            self.vehicle_id,
+            self.bucket,
+            self.num_locations,
+        )
+
+
+class IngestTick(models.Model):
+    """ Metrics of a single poll of the locations feed (see vehicle_locations.metrics) """
+    date = models.DateTimeField(db_index=True)  # start of the poll
+    total_s = models.FloatField()
+    http_s = models.FloatField()  # the slowest shard
+    parse_s = models.FloatField()  # stages below are summed over shards
+    dedup_s = models.FloatField()
+    positions_s = models.FloatField()
+    save_s = models.FloatField()
+    num_shards = models.SmallIntegerField()
+    num_failed_shards = models.SmallIntegerField()
+    num_vehicles = models.IntegerField()
+    num_duplicate_ids = models.IntegerField()
+    num_duplicate_locations = models.IntegerField()
+    feed_lag_s = models.FloatField(null=True, blank=True)  # the largest lag of shards
+    unprocessed_counts = models.TextField()  # JSON dict of unprocessed-reason: count
+    vehicles_per_line = models.TextField()  # JSON dict of line: count
+
+    def __str__(self):
+        return 'IngestTick {}: {:.2f}s {} vehicles'.format(
+            self.date,
+            self.total_s,
+            self.num_vehicles,
+        )
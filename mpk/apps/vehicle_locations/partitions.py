@@ -0,0 +1,109 @@
+"""
+Time partitioning of the vehicle locations table (PostgreSQL 11 or later only).
+The table is partitioned by range of date into partitions of LOCATION_PARTITION_DAYS local days, named
+<table>_pYYYYMMDD after their first day; data from before partitioning are in partition <table>_legacy.
+Partitions have to exist before locations are inserted, so LOCATION_PARTITIONS_AHEAD_DAYS days are created in advance
+(see the create_location_partitions command). Old partitions are archived and dropped by archive_old_locations.
+With other databases, or if the table isn't partitioned, the functions below do nothing.
+"""
+import re
+from datetime import date, datetime, timedelta
+
+import pytz
+from django.conf import settings
+from django.db import connection
+
+from lib.pg import parse_timestamptz
+
+from .models import VehicleLocation
+
+
+LOCATION_TABLE = VehicleLocation._meta.db_table
+
+
+def is_partitioned(conn=connection):
+    if conn.vendor != 'postgresql':
+        return False
+
+    with conn.cursor() as cursor:
+        cursor.execute('select 1 from pg_partitioned_table where partrelid = %s::regclass', [LOCATION_TABLE])
+        return cursor.fetchone() is not None
+
+
+def get_day_start(day):
+    """ Returns the start of local day day in UTC """
+    return settings.LOCAL_TIMEZONE.localize(datetime.combine(day, datetime.min.time())).astimezone(pytz.utc)
+
+
+def get_partition_start_day(day):
+    """ Returns the first day of the partition containing local day day """
+    return day - timedelta(days=(day - date(2000, 1, 1)).days % settings.LOCATION_PARTITION_DAYS)
+
+
+def get_partitions(conn=connection):
+    """ Returns a list of (partition-name, first-date, end-date) sorted by first date
+
+    Dates are in UTC; first date of the legacy partition is None.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(
+            'select c.relname, pg_get_expr(c.relpartbound, c.oid) from pg_inherits i join pg_class c on c.oid = i.inhrelid '
+            'where i.inhparent = %s::regclass',
+            [LOCATION_TABLE],
+        )
+        rows = cursor.fetchall()
+
+    def parse_bound(val):
+        return None if val == 'MINVALUE' else parse_timestamptz(val.strip("'")).astimezone(pytz.utc)
+
+    partitions = []
+    for name, bound in rows:
+        match = re.fullmatch(r"FOR VALUES FROM \((.+)\) TO \((.+)\)", bound)
+        if match is None:
+            raise RuntimeError(f'Unexpected bound of partition {name}: {bound}')
+        partitions.append((name, *map(parse_bound, match.groups())))
+
+    return sorted(partitions, key=lambda partition: partition[1] or datetime.min.replace(tzinfo=pytz.utc))
+
+
+def create_partition(first_day, end_day, conn=connection):
+    """ Creates the partition of local days [first_day, end_day); returns its name """
+    name = '{}_p{}'.format(LOCATION_TABLE, first_day.strftime('%Y%m%d'))
+
+    # Bounds have to be literals
+    with conn.cursor() as cursor:
+        cursor.execute('create table {} partition of {} for values from (\'{}\') to (\'{}\')'.format(
+            conn.ops.quote_name(name), conn.ops.quote_name(LOCATION_TABLE),
+            get_day_start(first_day).isoformat(), get_day_start(end_day).isoformat(),
+        ))
+
+    return name
+
+
+def create_future_partitions(conn=connection):
+    """ Creates missing partitions up to LOCATION_PARTITIONS_AHEAD_DAYS days from today; returns names of created partitions """
+    if not is_partitioned(conn):
+        return []
+
+    today = datetime.now(settings.LOCAL_TIMEZONE).date()
+    last_day = today + timedelta(days=settings.LOCATION_PARTITIONS_AHEAD_DAYS)
+
+    # Partitions start after the last existing one; the first created partition might be shorter,
+    # so that the next ones are aligned to LOCATION_PARTITION_DAYS
+    partitions = get_partitions(conn)
+    this_day = partitions[-1][2].astimezone(settings.LOCAL_TIMEZONE).date() if partitions else today
+
+    created = []
+    while this_day <= last_day:
+        end_day = get_partition_start_day(this_day) + timedelta(days=settings.LOCATION_PARTITION_DAYS)
+        created.append(create_partition(this_day, end_day, conn))
+        this_day = end_day
+
+    return created
+
+
+def drop_partition(name, conn=connection):
+    """ Detaches partition name from the table and drops it """
+    with conn.cursor() as cursor:
+        cursor.execute('alter table {} detach partition {}'.format(conn.ops.quote_name(LOCATION_TABLE), conn.ops.quote_name(name)))
+        cursor.execute('drop table {}'.format(conn.ops.quote_name(name)))
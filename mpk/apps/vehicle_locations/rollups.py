@@ -0,0 +1,200 @@
+"""
+Multi-resolution summaries of vehicle trajectories (TrajectoryRollup) for plotting long periods.
+For each level of TRAJECTORY_ROLLUP_LEVELS_S, locations of a vehicle are grouped into buckets of level seconds,
+aligned to the epoch; a bucket keeps its first and last processed locations and the numbers of unprocessed locations,
+so that data gaps and invalid data can still be told apart (see create_plot).
+Rollups are updated after each poll, assuming locations are appended in order of date; rollups of past days can be
+rebuilt from VehicleLocation (see build_rollups). Rollups of archived days are deleted by archive_old_locations, as
+plots read these days from archives.
+"""
+from datetime import datetime, timedelta
+
+import pytz
+from django.conf import settings
+from django.db import connection, transaction
+
+from .models import TrajectoryRollup, VehicleLocation
+
+
+ROLLUP_TABLE = TrajectoryRollup._meta.db_table
+
+
+def summarize(points, level):
+    """ Returns a dict of (route-id, vehicle-id, bucket-epoch): summary of level-second buckets
+
+    points is an iterable of (route-id, vehicle-id, epoch, position) sorted by route, vehicle id and epoch; position
+    is None if the location isn't processed. Summary is a dict of TrajectoryRollup fields, with epochs instead of dates.
+    """
+    summaries = {}
+    for route_id, vehicle_id, epoch, position in points:
+        summary = summaries.get((route_id, vehicle_id, epoch // level * level))
+        if summary is None:
+            summary = summaries[route_id, vehicle_id, epoch // level * level] = {
+                'first_epoch': None, 'first_position': None, 'last_epoch': None, 'last_position': None,
+                'num_locations': 0, 'num_unprocessed': 0, 'num_lead_unprocessed': 0, 'num_trail_unprocessed': 0,
+            }
+
+        summary['num_locations'] += 1
+        if position is None:
+            summary['num_unprocessed'] += 1
+            summary['num_trail_unprocessed'] += 1
+            if summary['first_epoch'] is None:
+                summary['num_lead_unprocessed'] += 1
+        else:
+            if summary['first_epoch'] is None:
+                summary['first_epoch'], summary['first_position'] = epoch, position
+            summary['last_epoch'], summary['last_position'] = epoch, position
+            summary['num_trail_unprocessed'] = 0
+
+    return summaries
+
+
+def combine(a, b):
+    """ Returns the summary of a bucket with summaries a and b, with b's locations later than a's """
+    return {
+        'first_epoch': a['first_epoch'] if a['first_epoch'] is not None else b['first_epoch'],
+        'first_position': a['first_position'] if a['first_epoch'] is not None else b['first_position'],
+        'last_epoch': b['last_epoch'] if b['last_epoch'] is not None else a['last_epoch'],
+        'last_position': b['last_position'] if b['last_epoch'] is not None else a['last_position'],
+        'num_locations': a['num_locations'] + b['num_locations'],
+        'num_unprocessed': a['num_unprocessed'] + b['num_unprocessed'],
+        'num_lead_unprocessed': a['num_lead_unprocessed'] + (b['num_lead_unprocessed'] if a['first_epoch'] is None else 0),
+        'num_trail_unprocessed': b['num_trail_unprocessed'] + (a['num_trail_unprocessed'] if b['last_epoch'] is None else 0),
+    }
+
+
+def _to_date(epoch):
+    return None if epoch is None else datetime.fromtimestamp(epoch, pytz.utc)
+
+
+def _to_fields(level, key, summary):
+    route_id, vehicle_id, bucket = key
+    return {
+        'route_id': route_id,
+        'level': level,
+        'vehicle_id': vehicle_id,
+        'bucket': _to_date(bucket),
+        'first_date': _to_date(summary['first_epoch']),
+        'first_position': summary['first_position'],
+        'last_date': _to_date(summary['last_epoch']),
+        'last_position': summary['last_position'],
+        'num_locations': summary['num_locations'],
+        'num_unprocessed': summary['num_unprocessed'],
+        'num_lead_unprocessed': summary['num_lead_unprocessed'],
+        'num_trail_unprocessed': summary['num_trail_unprocessed'],
+    }
+
+
+def _from_rollup(rollup):
+    return {
+        'first_epoch': None if rollup.first_date is None else int(rollup.first_date.timestamp()),
+        'first_position': rollup.first_position,
+        'last_epoch': None if rollup.last_date is None else int(rollup.last_date.timestamp()),
+        'last_position': rollup.last_position,
+        'num_locations': rollup.num_locations,
+        'num_unprocessed': rollup.num_unprocessed,
+        'num_lead_unprocessed': rollup.num_lead_unprocessed,
+        'num_trail_unprocessed': rollup.num_trail_unprocessed,
+    }
+
+
+def _get_points(locations):
+    return sorted(
+        (loc.route_id, loc.vehicle_id, int(loc.date.timestamp()), loc.route_position)
+        for loc in locations
+    )
+
+
+def update_rollups(locations):
+    """ Adds saved VehicleLocation objects locations to rollups of all levels """
+    points = _get_points(locations)
+    if not points:
+        return
+
+    for level in settings.TRAJECTORY_ROLLUP_LEVELS_S:
+        summaries = summarize(points, level)
+
+        if connection.vendor == 'postgresql':
+            # Same as combine(existing, new)
+            rows = [_to_fields(level, key, summary) for key, summary in summaries.items()]
+            columns = list(rows[0])
+            query = (
+                'insert into {0} ({1}) values {2} '
+                'on conflict (route_id, level, vehicle_id, bucket) do update set '
+                'first_date = coalesce({0}.first_date, excluded.first_date), '
+                'first_position = case when {0}.first_date is null then excluded.first_position else {0}.first_position end, '
+                'last_date = coalesce(excluded.last_date, {0}.last_date), '
+                'last_position = case when excluded.last_date is null then {0}.last_position else excluded.last_position end, '
+                'num_locations = {0}.num_locations + excluded.num_locations, '
+                'num_unprocessed = {0}.num_unprocessed + excluded.num_unprocessed, '
+                'num_lead_unprocessed = {0}.num_lead_unprocessed + case when {0}.first_date is null then excluded.num_lead_unprocessed else 0 end, '
+                'num_trail_unprocessed = excluded.num_trail_unprocessed + case when excluded.last_date is null then {0}.num_trail_unprocessed else 0 end'
+            ).format(ROLLUP_TABLE, ', '.join(columns), ', '.join(['({})'.format(', '.join(['%s'] * len(columns)))] * len(rows)))
+            with connection.cursor() as cursor:
+                cursor.execute(query, [row[col] for row in rows for col in columns])
+            continue
+
+        # Other databases
+        with transaction.atomic():
+            for key, summary in summaries.items():
+                fields = _to_fields(level, key, summary)
+                rollup, is_created = TrajectoryRollup.objects.select_for_update().get_or_create(
+                    route_id=fields['route_id'], level=level, vehicle_id=fields['vehicle_id'], bucket=fields['bucket'],
+                    defaults=fields,
+                )
+                if not is_created:
+                    for field, val in _to_fields(level, key, combine(_from_rollup(rollup), summary)).items():
+                        setattr(rollup, field, val)
+                    rollup.save()
+
+
+def build_rollups(day, route_ids=None):
+    """ Replaces rollups of buckets starting on local day day (of routes route_ids or all routes) with ones built from VehicleLocation
+
+    Buckets are aligned to the local day, as long as levels divide an hour.
+    """
+    date_from = settings.LOCAL_TIMEZONE.localize(datetime.combine(day, datetime.min.time()))
+    date_to = settings.LOCAL_TIMEZONE.localize(datetime.combine(day + timedelta(days=1), datetime.min.time()))
+
+    rollups = TrajectoryRollup.objects.filter(bucket__gte=date_from, bucket__lt=date_to)
+    locations = VehicleLocation.objects.filter(date__gte=date_from, date__lt=date_to).order_by('route', 'vehicle_id', 'date')
+    if route_ids is not None:
+        rollups = rollups.filter(route__in=route_ids)
+        locations = locations.filter(route__in=route_ids)
+
+    points = [
+        (route_id, vehicle_id, int(date_.timestamp()), position)
+        for route_id, vehicle_id, date_, position in locations.values_list('route_id', 'vehicle_id', 'date', 'route_position').iterator()
+    ]
+
+    with transaction.atomic():
+        rollups.delete()
+        for level in settings.TRAJECTORY_ROLLUP_LEVELS_S:
+            TrajectoryRollup.objects.bulk_create([
+                TrajectoryRollup(**_to_fields(level, key, summary))
+                for key, summary in summarize(points, level).items()
+            ], batch_size=400)  # SQLite inserts at most 500 rows at once
+
+
+def delete_rollups(day):
+    """ Deletes rollups of buckets starting on local day day; used once locations of the day are archived """
+    date_from = settings.LOCAL_TIMEZONE.localize(datetime.combine(day, datetime.min.time()))
+    date_to = settings.LOCAL_TIMEZONE.localize(datetime.combine(day + timedelta(days=1), datetime.min.time()))
+    return TrajectoryRollup.objects.filter(bucket__gte=date_from, bucket__lt=date_to).delete()[0]
+
+
+def get_plot_level(date_from, date_to, width_p):
+    """ Returns the coarsest level with buckets not longer than a pixel of a plot width_p pixels wide, or None """
+    pixel_s = (date_to - date_from).total_seconds() / width_p
+    levels = [level for level in settings.TRAJECTORY_ROLLUP_LEVELS_S if level <= pixel_s]
+    return max(levels, default=None)
+
+
+def read_rollups(route, level, date_from, date_to):
+    """ Returns rollups of route of level level with buckets overlapping [date_from, date_to), sorted by vehicle id and bucket """
+    return (
+        TrajectoryRollup
+        .objects
+        .filter(route=route, level=level, bucket__gt=date_from - timedelta(seconds=level), bucket__lt=date_to)
+        .order_by('vehicle_id', 'bucket')
+    )
@@ -0,0 +1,92 @@
+"""
+Calculation of vehicle positions by projecting vehicles onto the route polyline (see geometry.RouteShape).
+Each vehicle is projected onto the nearest segment of the polyline; its stops are then found by binary search
+of its distance along the polyline in the positions of stops, so only the stops around the vehicle are compared with it.
+The results are the same as of engine.calculate_positions, except that a vehicle is too far from the route
+if it's farther than SHAPE_MAX_DIST_M from the polyline (instead of using MAX_ALLOWED_DETOUR_RATIO), and that only
+stops around the vehicle's position along the polyline are checked, so overlapping stops elsewhere on the route are ignored.
+"""
+import numpy as np
+from django.conf import settings
+
+from . import const
+from .geometry import distance, get_window, to_local_m
+
+
+def calculate_positions(shape, locs, last_positions=None, directions=None):
+    """ Calculates positions along the route of vehicles at locations locs
+
+    shape is a RouteShape of the route; other arguments and the result are the same as of engine.calculate_positions.
+    If last positions are known, vehicles are first projected onto the part of the polyline around them.
+    """
+    locs = np.asarray(locs, dtype=float).reshape(-1, 2)
+    lat, lng = locs[:, 0], locs[:, 1]
+    x, y = to_local_m(lat, lng)
+    num_locs, num_stops = len(locs), shape.num_stops
+
+    # Distances along and from the polyline
+    arc, shape_dist = np.empty(num_locs), np.empty(num_locs)
+    is_done = np.zeros(num_locs, dtype=bool)
+    if last_positions is not None:
+        inds = np.flatnonzero(~np.isnan(last_positions))
+        first_ind, last_ind = get_window(num_stops, last_positions[inds], directions[inds])
+        window_arc, window_dist = shape.project(x[inds], y[inds], arc_range=(shape.stop_arc[first_ind], shape.stop_arc[last_ind]))[:2]
+
+        is_valid = window_dist <= settings.SHAPE_MAX_DIST_M
+        arc[inds[is_valid]], shape_dist[inds[is_valid]] = window_arc[is_valid], window_dist[is_valid]
+        is_done[inds[is_valid]] = True
+
+    inds = np.flatnonzero(~is_done)
+    arc[inds], shape_dist[inds] = shape.project(x[inds], y[inds])[:2]
+
+    # Vehicles projected onto an end of the polyline can be beyond it; their distance along the polyline is then negative
+    # or greater than its length
+    first_len, last_len = np.sqrt(shape.segment_len2[0]), np.sqrt(shape.segment_len2[-1])
+    first_along = ((x - shape.x[0]) * shape.segment_dx[0] + (y - shape.y[0]) * shape.segment_dy[0]) / first_len
+    last_along = ((x - shape.x[-1]) * shape.segment_dx[-1] + (y - shape.y[-1]) * shape.segment_dy[-1]) / last_len
+    arc = np.where(arc <= 0., np.minimum(first_along, 0.), arc)
+    arc = np.where(arc >= shape.route_length, shape.route_length + np.maximum(last_along, 0.), arc)
+
+    # Stops segment_ind and segment_ind+1 are the ones before and after the vehicle
+    segment_ind = np.clip(np.searchsorted(shape.stop_arc, arc, side='right') - 1, 0, num_stops - 2)
+
+    # At stop; stops next to the segment are checked as well, because stops can overlap
+    candidates = segment_ind[:, np.newaxis] + np.arange(-1, 3)
+    is_candidate = (candidates >= 0) & (candidates < num_stops)
+    candidates[~is_candidate] = -1
+    safe_candidates = np.where(is_candidate, candidates, 0)
+    cand_dist = distance(lat[:, np.newaxis], lng[:, np.newaxis], shape.latitude[safe_candidates], shape.longitude[safe_candidates])
+    is_at_stop_m = is_candidate & (cand_dist <= shape.effective_radius_m[safe_candidates])
+    num_at_stop = is_at_stop_m.sum(axis=1)
+    is_at_stop = num_at_stop > 0
+    at_stop_ind = candidates[np.arange(num_locs), np.where(is_at_stop_m, cand_dist, np.inf).argmin(axis=1)]
+
+    # Position between stops, measured between the edges of stops
+    start = shape.stop_arc[segment_ind] + shape.effective_radius_m[segment_ind]
+    end = shape.stop_arc[segment_ind + 1] - shape.effective_radius_m[segment_ind + 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        to_next_stop_ratio = np.where(end > start, np.clip((arc - start) / (end - start), 0., 1.), 0.)
+
+    ## Combine
+    is_beyond_final_stop = ~is_at_stop & ((arc < shape.stop_arc[0]) | (arc > shape.stop_arc[-1]))
+    is_too_far = ~is_at_stop & ~is_beyond_final_stop & (shape_dist > settings.SHAPE_MAX_DIST_M)
+    is_processed = ~is_beyond_final_stop & ~is_too_far
+
+    unprocessed_reason = np.zeros(num_locs, dtype=int)
+    unprocessed_reason[is_too_far] = const.UNPROC_REASON_TOO_FAR
+    unprocessed_reason[is_beyond_final_stop] = const.UNPROC_REASON_BEYOND_FINAL_STOP
+
+    stop_ind = np.where(is_at_stop, at_stop_ind, segment_ind)
+    stop_ind[~is_processed] = -1
+    to_next_stop_ratio[is_at_stop | ~is_processed] = np.nan
+
+    return {
+        'is_processed': is_processed,
+        'unprocessed_reason': unprocessed_reason,
+        'is_at_stop': is_at_stop,
+        'stop_ind': stop_ind,
+        'to_next_stop_ratio': to_next_stop_ratio,
+        'route_position': np.where(is_at_stop, stop_ind, stop_ind + to_next_stop_ratio),
+        'num_at_stop': num_at_stop,
+        'at_stop_inds': {ind: candidates[ind, is_at_stop_m[ind]] for ind in np.flatnonzero(num_at_stop > 1)},
+    }
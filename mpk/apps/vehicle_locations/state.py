@@ -0,0 +1,72 @@
+"""
+Last known positions of vehicles, used by the position engine to check stops around these positions first.
+The collector keeps states in memory between polls; get_locations reads them from recently saved locations.
+"""
+import math
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+
+from .models import VehicleLocation
+
+
+class VehicleStates:
+
+    def __init__(self):
+        self.states = {}  # (route-id, vehicle-id): (route-position, direction, date)
+
+    def get(self, route_id, vehicle_ids, date_created):
+        """ Returns arrays of last positions (nan if unknown or too old) and directions of vehicles vehicle_ids """
+        max_age = timedelta(seconds=settings.VEHICLE_STATE_MAX_AGE_S)
+
+        last_positions, directions = np.full(len(vehicle_ids), np.nan), np.zeros(len(vehicle_ids), dtype=int)
+        for ind, vehicle_id in enumerate(vehicle_ids):
+            state = self.states.get((route_id, vehicle_id))
+            if state is not None and timedelta(0) < date_created - state[2] <= max_age:
+                last_positions[ind], directions[ind] = state[0], state[1]
+
+        return last_positions, directions
+
+    def update(self, route_id, vehicle_ids, route_positions, date_created):
+        """ Sets positions of vehicles vehicle_ids; unprocessed positions (nan) are ignored """
+        for vehicle_id, position in zip(vehicle_ids, route_positions):
+            if math.isnan(position):
+                continue
+
+            key = (route_id, vehicle_id)
+            direction = 0
+            if key in self.states:
+                prev_position, prev_direction, prev_date = self.states[key]
+                if prev_date >= date_created:
+                    continue
+                direction = prev_direction if position == prev_position else int(np.sign(position - prev_position))
+
+            self.states[key] = (float(position), direction, date_created)
+
+    def remove_old(self, date_created):
+        """ Removes states that are too old to be used at date_created """
+        min_date = date_created - timedelta(seconds=settings.VEHICLE_STATE_MAX_AGE_S)
+        self.states = {key: state for key, state in self.states.items() if state[2] >= min_date}
+
+    @classmethod
+    def from_db(cls, routes_d, date_created):
+        """ Returns states of vehicles of routes routes_d from locations saved within VEHICLE_STATE_MAX_AGE_S before date_created """
+        states = cls()
+
+        locations = (
+            VehicleLocation
+            .objects
+            .filter(
+                route__in=[route for route, _ in routes_d.values()],
+                date__gte=date_created - timedelta(seconds=settings.VEHICLE_STATE_MAX_AGE_S),
+                date__lt=date_created,
+                route_position__isnull=False,
+            )
+            .order_by('date')
+            .values_list('route_id', 'vehicle_id', 'date', 'route_position')
+        )
+        for route_id, vehicle_id, date_, route_position in locations:
+            states.update(route_id, [vehicle_id], [route_position], date_)
+
+        return states
@@ -1,12 +1,62 @@
+import gzip
+import os
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from unittest import mock
+
+import numpy as np
+import pytz
 from django.conf import settings
 from django.forms import model_to_dict
 from django.test import TestCase
 
+from lib import distance
 from routes.models import Route
 from stops.models import Stop
-from vehicle_locations import const
-from vehicle_locations.management.commands.get_locations import process_vehicle
-from vehicle_locations.models import VehicleLocation
+from vehicle_locations import archive, capture, const, engine, shape_engine
+from vehicle_locations.geometry import RouteGeometry, RouteShape
+from vehicle_locations.management.commands import get_locations
+from vehicle_locations.management.commands.get_locations import process_vehicles, save_locations
+from vehicle_locations.models import TrajectoryRollup, VehicleLocation
+from vehicle_locations.rollups import build_rollups
+from vehicle_locations.state import VehicleStates
+from vehicle_locations.trajectories import build_trajectories, read_trajectories
+
+
+def calculate_position_reference(loc, stops):
+    """ Position of a single vehicle, as calculated before the vectorized engine; returns (stop-ind, ratio) or unprocessed-reason """
+    def between_stops(ind_a, ind_b):
+        stop_a, stop_b, dist_a, dist_b = stops[ind_a], stops[ind_b], stop_dist[ind_a], stop_dist[ind_b]
+        if dist_a + dist_b > distance.distance(stop_a, stop_b) * settings.MAX_ALLOWED_DETOUR_RATIO:
+            return const.UNPROC_REASON_TOO_FAR
+
+        dist_limited = dist_a - stop_a.radius_m - settings.STOP_ADD_RADIUS_M
+        total_dist_limited = dist_a + dist_b - stop_a.radius_m - stop_b.radius_m - 2 * settings.STOP_ADD_RADIUS_M
+        return ind_a, dist_limited / total_dist_limited
+
+    stop_dist = [distance.distance(loc, stop) for stop in stops]
+    is_at_stop_l = [stop_dist[ind] <= stops[ind].radius_m + settings.STOP_ADD_RADIUS_M for ind in range(len(stops))]
+
+    if any(is_at_stop_l):
+        _, nearest_stop_ind = min((stop_dist[ind], ind) for ind in range(len(stops)) if is_at_stop_l[ind])
+        return nearest_stop_ind, None
+
+    min_ind = int(np.argmin(stop_dist))
+    if min_ind == 0 or min_ind == len(stops) - 1:
+        ind_final, ind_other = (0, 1) if min_ind == 0 else (len(stops) - 1, len(stops) - 2)
+        if distance.distance(stops[ind_final], stops[ind_other]) < distance.distance(loc, stops[ind_other]):
+            return const.UNPROC_REASON_BEYOND_FINAL_STOP
+
+        return between_stops(min(ind_final, ind_other), max(ind_final, ind_other))
+
+    stop_a, stop_b = stops[min_ind-1], stops[min_ind+1]
+    diff_a = distance.distance(loc, stop_a) - distance.distance(stops[min_ind], stop_a)
+    diff_b = distance.distance(loc, stop_b) - distance.distance(stops[min_ind], stop_b)
+    if diff_a < diff_b:
+        min_ind -= 1
+
+    return between_stops(min_ind, min_ind + 1)
 
 
 class ProcessVehicleTests(TestCase):
@@ -50,17 +100,11 @@ class ProcessVehicleTests(TestCase):
         lines_l = [r.line for r in routes]
         if not lines_l:
             raise RuntimeError('No routes')
-        routes_d = {r.line: (r, list(r.stop_set.all())) for r in routes}
+        routes_d = {r.line: (r, RouteGeometry(list(r.stop_set.all()))) for r in routes}
 
         # Process vehicles
-        for v in vehicle_data:
-            el = {
-                'name': 'L. 1',
-                'x': v['loc'][0],
-                'y': v['loc'][1],
-                'k': v['id'],
-            }
-            process_vehicle(el, routes_d, '2001-02-03 04:05:06+00:00')
+        els = [{'name': 'L. 1', 'x': v['loc'][0], 'y': v['loc'][1], 'k': v['id']} for v in vehicle_data]
+        process_vehicles(els, routes_d, datetime(2001, 2, 3, 4, 5, 6, tzinfo=pytz.utc))
 
         # Check
         # 0
@@ -69,6 +113,7 @@ class ProcessVehicleTests(TestCase):
         self.assertFalse(v.is_at_stop)
         self.assertEqual(v.current_stop, Stop.objects.get(route_index=0))
         self.assertTrue(0 < v.to_next_stop_ratio < 1)
+        self.assertEqual(v.route_position, v.to_next_stop_ratio)
 
         # 1
         v = VehicleLocation.objects.get(vehicle_id=1)
@@ -80,6 +125,7 @@ class ProcessVehicleTests(TestCase):
         self.assertTrue(v.is_processed)
         self.assertTrue(v.is_at_stop)
         self.assertEqual(v.current_stop, Stop.objects.get(route_index=2))
+        self.assertEqual(v.route_position, 2.)
 
         # 3
         v = VehicleLocation.objects.get(vehicle_id=3)
@@ -98,3 +144,306 @@ class ProcessVehicleTests(TestCase):
         self.assertFalse(v.is_processed)
         self.assertEqual(v.unprocessed_reason, const.UNPROC_REASON_BEYOND_FINAL_STOP)
 
+    def test_save_locations_skips_duplicates(self):
+        route = Route.objects.get(line='L. 1')
+        date_created = '2001-02-03 04:05:06+00:00'
+
+        def location(vehicle_id):
+            return VehicleLocation(route=route, vehicle_id=vehicle_id, date=date_created, latitude=51., longitude=17., is_processed=False)
+
+        self.assertEqual(save_locations([location(0), location(1)]), [])
+
+        skipped = save_locations([location(1), location(2)])
+        self.assertEqual([loc.vehicle_id for loc in skipped], [1])
+        self.assertEqual(sorted(VehicleLocation.objects.values_list('vehicle_id', flat=True)), [0, 1, 2])
+
+    def test_load_routes(self):
+        route = Route.objects.get(line='L. 1')
+        date_modified = route.date_modified
+
+        # Routes without enough stops are skipped
+        other_route = Route.objects.create(line='L. 2')
+        Stop.objects.create(route=other_route, route_index=0, name='Stop', display_name='Stop', latitude=51., longitude=17., radius_m=10)
+        with self.assertLogs('get-locations', 'WARNING'):
+            self.assertEqual(list(get_locations.load_routes()), ['L. 1'])
+
+        # Editing a stop modifies its route
+        stop = route.stop_set.get(route_index=0)
+        stop.radius_m += 1
+        stop.save()
+        route.refresh_from_db()
+        self.assertGreater(route.date_modified, date_modified)
+
+    def test_collect_locations(self):
+        route = Route.objects.get(line='L. 1')
+        geometry = RouteGeometry(list(route.stop_set.all()))
+        date_created = datetime(2001, 2, 3, 4, 5, 0, tzinfo=pytz.utc)
+        events = []
+
+        # A shard of each line, with a vehicle of its own; the second one is received later
+        def fetch_locations(session, lines_l, deadline, metrics=None):
+            if lines_l != ['L. 1']:
+                time.sleep(.2)
+            events.append('fetch')
+            return [{'name': 'L. 1', 'x': 51., 'y': 17.000714, 'k': 7 if lines_l == ['L. 1'] else 8}], date_created
+
+        def process_vehicles(*args, **kwargs):
+            events.append('save')
+            process_vehicles_orig(*args, **kwargs)
+
+        # Saving the second vehicle fails after its location has been inserted
+        def update_rollups(locations):
+            if locations[0].vehicle_id == 8:
+                raise RuntimeError('Rollups failed')
+            update_rollups_orig(locations)
+
+        process_vehicles_orig, update_rollups_orig = get_locations.process_vehicles, get_locations.update_rollups
+        with self.settings(GET_LOCATIONS_NUM_SHARDS=2), \
+                mock.patch.object(get_locations, 'fetch_locations', fetch_locations), \
+                mock.patch.object(get_locations, 'process_vehicles', process_vehicles), \
+                mock.patch.object(get_locations, 'update_rollups', update_rollups), \
+                self.assertLogs('get-locations', 'ERROR'):
+            get_locations.collect_locations(None, {'L. 1': (route, geometry), 'L. 2': (route, geometry)})
+
+        # Shards are saved after all of them have been fetched; the failed one is rolled back
+        self.assertEqual(events, ['fetch', 'fetch', 'save', 'save'])
+        self.assertEqual(list(VehicleLocation.objects.values_list('vehicle_id', flat=True)), [7])
+
+    def test_trajectories(self):
+        route = Route.objects.get(line='L. 1')
+        routes_d = {route.line: (route, RouteGeometry(list(route.stop_set.all())))}
+        date_from = datetime(2001, 2, 3, 4, 5, 0, tzinfo=pytz.utc)
+
+        # Two polls, the second one with the vehicle beyond the final stop
+        for ind, lng in enumerate([17.000714, 17.004859]):
+            els = [{'name': route.line, 'x': 51., 'y': lng, 'k': 7}]
+            process_vehicles(els, routes_d, date_from + timedelta(seconds=20 * ind))
+
+        expected = [
+            (loc.vehicle_id, int(loc.date.timestamp()), loc.current_stop.route_index + loc.to_next_stop_ratio if loc.is_processed else None)
+            for loc in VehicleLocation.objects.order_by('date')
+        ]
+
+        # Appended by the ingestion and rebuilt from locations
+        for _ in range(2):
+            [(vehicle_id, epochs, positions)] = read_trajectories(route, date_from, date_from + timedelta(hours=1))
+            self.assertEqual(
+                [(vehicle_id, epoch, None if np.isnan(position) else position) for epoch, position in zip(epochs, positions)],
+                [(v, e, None if p is None else np.float32(p)) for v, e, p in expected],
+            )
+
+            build_trajectories(date_from.date())
+
+    def test_rollups(self):
+        route = Route.objects.get(line='L. 1')
+        routes_d = {route.line: (route, RouteGeometry(list(route.stop_set.all())))}
+        date_from = datetime(2001, 2, 3, 4, 5, 0, tzinfo=pytz.utc)
+
+        # Polls with the vehicle between stops, beyond the final stop or too far from the route
+        for ind, lng in enumerate([17.000714, 17.004859, 17.001, 17.2, 17.2, 17.0012, 17.2, 17.002, 17.2, 17.0025]):
+            els = [{'name': route.line, 'x': 51., 'y': lng, 'k': 7}]
+            process_vehicles(els, routes_d, date_from + timedelta(seconds=20 * ind))
+
+        def get_rollups():
+            return list(TrajectoryRollup.objects.order_by('level', 'bucket').values())
+
+        # Updated by the ingestion and rebuilt from locations
+        rollups = get_rollups()
+        self.assertEqual({rollup['level'] for rollup in rollups}, set(settings.TRAJECTORY_ROLLUP_LEVELS_S))
+        self.assertEqual(sum(rollup['num_locations'] for rollup in rollups), 10 * len(settings.TRAJECTORY_ROLLUP_LEVELS_S))
+
+        build_rollups(date_from.date())
+        self.assertEqual([{k: v for k, v in rollup.items() if k != 'id'} for rollup in get_rollups()], [{k: v for k, v in rollup.items() if k != 'id'} for rollup in rollups])
+
+
+class CalculatePositionsTests(TestCase):
+
+    def test_same_as_reference(self):
+        rng = np.random.default_rng(0)
+
+        # Winding route with irregular stop distances and radii; some stops overlap
+        num_stops = 40
+        angles = np.cumsum(rng.uniform(-.8, .8, num_stops))
+        dists_m = rng.uniform(50, 700, num_stops)
+        lat = 51.1 + np.cumsum(dists_m * np.sin(angles)) / settings.ONE_DEG_Y_KM / 1000.
+        lng = 17. + np.cumsum(dists_m * np.cos(angles)) / settings.ONE_DEG_X_KM / 1000.
+        stops = [
+            Stop(route_index=ind, latitude=lat[ind], longitude=lng[ind], radius_m=int(rng.integers(5, 60)))
+            for ind in range(num_stops)
+        ]
+
+        # Vehicles near the route, some of them exactly at stop centres
+        num_locs = 5000
+        segment_ind, ratio = rng.integers(-1, num_stops, num_locs), rng.uniform(0, 1, num_locs)
+        segment_ind_a, segment_ind_b = np.clip(segment_ind, 0, num_stops - 1), np.clip(segment_ind + 1, 0, num_stops - 1)
+        locs = np.column_stack([
+            lat[segment_ind_a] + (lat[segment_ind_b] - lat[segment_ind_a]) * ratio + rng.normal(0, 100, num_locs) / settings.ONE_DEG_Y_KM / 1000.,
+            lng[segment_ind_a] + (lng[segment_ind_b] - lng[segment_ind_a]) * ratio + rng.normal(0, 100, num_locs) / settings.ONE_DEG_X_KM / 1000.,
+        ])
+        locs[:num_stops] = np.column_stack([lat, lng])
+
+        for use_grid in False, True:
+            positions = engine.calculate_positions(RouteGeometry(stops, use_grid=use_grid), locs)
+
+            for ind, loc in enumerate(locs):
+                expected = calculate_position_reference(tuple(loc), stops)
+                if isinstance(expected, tuple):
+                    self.assertTrue(positions['is_processed'][ind])
+                    self.assertEqual(positions['stop_ind'][ind], expected[0])
+                    if expected[1] is None:
+                        self.assertTrue(positions['is_at_stop'][ind])
+                    else:
+                        self.assertFalse(positions['is_at_stop'][ind])
+                        self.assertEqual(positions['to_next_stop_ratio'][ind], expected[1])
+                else:
+                    self.assertFalse(positions['is_processed'][ind])
+                    self.assertEqual(positions['unprocessed_reason'][ind], expected)
+
+    def test_last_position_resolves_loop(self):
+        # Loop route; the first and the last stop are at the same place
+        num_stops = 12
+        angles = np.linspace(0, 2 * np.pi, num_stops)
+        lat = 51.1 + 1000. * np.sin(angles) / settings.ONE_DEG_Y_KM / 1000.
+        lng = 17. + 1000. * (1 - np.cos(angles)) / settings.ONE_DEG_X_KM / 1000.
+        stops = [Stop(route_index=ind, latitude=lat[ind], longitude=lng[ind], radius_m=30) for ind in range(num_stops)]
+        geometry = RouteGeometry(stops)
+
+        locs = [(lat[0], lng[0])] * 3
+        last_positions, directions = np.array([np.nan, .5, num_stops - 1.5]), np.array([0, -1, 1])
+        positions = engine.calculate_positions(geometry, locs, last_positions, directions)
+
+        self.assertTrue(positions['is_at_stop'].all())
+        self.assertEqual(positions['num_at_stop'][0], 2)
+        self.assertEqual(list(positions['stop_ind'][1:]), [0, num_stops - 1])
+        self.assertEqual(list(positions['route_position'][1:]), [0., num_stops - 1.])
+
+    def test_expired_state_falls_back(self):
+        # Loop route as above; the vehicle was last seen approaching the last stop
+        num_stops = 12
+        angles = np.linspace(0, 2 * np.pi, num_stops)
+        lat = 51.1 + 1000. * np.sin(angles) / settings.ONE_DEG_Y_KM / 1000.
+        lng = 17. + 1000. * (1 - np.cos(angles)) / settings.ONE_DEG_X_KM / 1000.
+        stops = [Stop(route_index=ind, latitude=lat[ind], longitude=lng[ind], radius_m=30) for ind in range(num_stops)]
+        geometry = RouteGeometry(stops)
+
+        date_ = datetime(2001, 2, 3, 10, 0, tzinfo=pytz.utc)
+        states = VehicleStates()
+        states.update(1, [7], [num_stops - 2.5], date_)
+        states.update(1, [7], [num_stops - 1.5], date_ + timedelta(seconds=20))
+
+        max_age = timedelta(seconds=settings.VEHICLE_STATE_MAX_AGE_S)
+        for date_created, expected_stop_ind in [
+            (date_ + timedelta(seconds=40), num_stops - 1),  # the last position is used
+            (date_ + timedelta(seconds=20), 0),  # not later than the last position
+            (date_ + timedelta(seconds=21) + max_age, 0),  # expired
+        ]:
+            last_positions, directions = states.get(1, [7], date_created)
+            positions = engine.calculate_positions(geometry, [(lat[0], lng[0])], last_positions, directions)
+            self.assertEqual(positions['stop_ind'][0], expected_stop_ind)
+            if expected_stop_ind == 0:
+                # The same as without last positions
+                self.assertTrue(np.isnan(last_positions[0]))
+                self.assertEqual(positions['num_at_stop'][0], 2)
+
+        states.remove_old(date_ + timedelta(seconds=21) + max_age)
+        self.assertEqual(states.states, {})
+
+    def test_shape_engine(self):
+        rng = np.random.default_rng(0)
+
+        # Route along a curve, with stops every ~300m
+        num_stops = 15
+        angles = np.cumsum(rng.uniform(-.4, .4, num_stops))
+        lat = 51.1 + np.cumsum(300. * np.sin(angles)) / settings.ONE_DEG_Y_KM / 1000.
+        lng = 17. + np.cumsum(300. * np.cos(angles)) / settings.ONE_DEG_X_KM / 1000.
+        stops = [Stop(route_index=ind, latitude=lat[ind], longitude=lng[ind], radius_m=20) for ind in range(num_stops)]
+
+        # Vehicles on the lines between stops; both engines should give the same positions
+        segment_ind, ratio = rng.integers(0, num_stops - 1, 500), rng.uniform(0, 1, 500)
+        locs = np.column_stack([
+            lat[segment_ind] + (lat[segment_ind + 1] - lat[segment_ind]) * ratio,
+            lng[segment_ind] + (lng[segment_ind + 1] - lng[segment_ind]) * ratio,
+        ])
+        expected = engine.calculate_positions(RouteGeometry(stops), locs)
+        positions = shape_engine.calculate_positions(RouteShape(stops), locs)
+
+        self.assertTrue(positions['is_processed'].all())
+        np.testing.assert_array_equal(positions['is_at_stop'], expected['is_at_stop'])
+        np.testing.assert_array_equal(positions['stop_ind'], expected['stop_ind'])
+        np.testing.assert_allclose(positions['route_position'], expected['route_position'], atol=1e-3)
+
+        # Vehicles away from the route and before the first stop
+        far_loc = (lat[5] + 200. / settings.ONE_DEG_Y_KM / 1000., lng[5])
+        before_loc = (2 * lat[0] - lat[1], 2 * lng[0] - lng[1])
+        positions = shape_engine.calculate_positions(RouteShape(stops), [far_loc, before_loc])
+        self.assertEqual(list(positions['unprocessed_reason']), [const.UNPROC_REASON_TOO_FAR, const.UNPROC_REASON_BEYOND_FINAL_STOP])
+
+
+class CaptureTests(TestCase):
+
+    def test_corrupt_members(self):
+        dates = [datetime(2001, 2, 3, 10, minute, tzinfo=pytz.utc) for minute in range(4)]
+        members = [gzip.compress('{}\t[{{"k": {}}}]\n'.format(int(date_.timestamp()), ind).encode()) for ind, date_ in enumerate(dates)]
+
+        with tempfile.TemporaryDirectory() as capture_dir:
+            # Writing of responses 1 and 3 was interrupted; appending resumed after response 1
+            filename = os.path.join(capture_dir, 'feed.log.gz')
+            with open(filename, 'wb') as f:
+                f.write(members[0] + members[1][:len(members[1]) // 2] + members[2] + members[3][:-5])
+
+            with self.assertLogs('get-locations', 'WARNING'):
+                responses = list(capture.read_capture_file(filename))
+            self.assertEqual(responses, [(dates[0], [{'k': 0}]), (dates[2], [{'k': 2}])])
+
+
+class ArchiveTests(TestCase):
+
+    def test_read_archived_locations(self):
+        day = date(2001, 2, 3)
+        start, _ = archive.get_day_range(day)
+        columns = ['vehicle_id', 'date', 'route_id', 'route_position']
+
+        # Locations of routes 1 and 2, every 10 minutes
+        rows = [
+            (ind % 3, start + timedelta(minutes=10 * ind), 1 + ind % 2, None if ind % 5 == 0 else ind / 10)
+            for ind in range(144)
+        ]
+        lines = [
+            '{}\t{}\t{}\t{}\n'.format(vehicle_id, date_.isoformat(' ').replace('+00:00', '+00'), route_id, '\\N' if position is None else position)
+            for vehicle_id, date_, route_id, position in rows
+        ]
+
+        date_from, date_to = start + timedelta(hours=5, minutes=5), start + timedelta(hours=9)
+        expected = [
+            (str(vehicle_id), date_, None if position is None else str(position))
+            for vehicle_id, date_, route_id, position in rows
+            if route_id == 2 and date_from <= date_ < date_to
+        ]
+
+        with tempfile.TemporaryDirectory() as out_dir:
+            # Chunked dump with a manifest
+            filename, manifest_filename = archive.get_archive_filenames(out_dir, day, 'gzip')
+            with open(filename, 'wb') as f:
+                writer = archive.ChunkedCompressedWriter(f, 'gzip', 6, 2, 1000)
+                for line in lines:
+                    writer.write(line.encode())
+                chunks = writer.close()
+            archive.write_manifest(manifest_filename, {'filename': os.path.basename(filename), 'compression': 'gzip', 'columns': columns, 'chunks': chunks})
+
+            # Dump without a manifest
+            other_day = day + timedelta(days=1)
+            other_filename, _ = archive.get_archive_filenames(out_dir, other_day, 'gzip')
+            with gzip.open(other_filename, 'wt') as f:
+                f.write('')
+
+            # Days without an index aren't read
+            self.assertEqual(list(archive.read_archived_locations(out_dir, 2, date_from, date_to)), [])
+            archive.build_index(out_dir, day)
+            archive.build_index(out_dir, other_day)
+
+            locations = list(archive.read_archived_locations(out_dir, 2, date_from, date_to))
+            self.assertEqual([(loc['vehicle_id'], loc['date'], loc['route_position']) for loc in locations], expected)
+
+            index = archive.get_index(out_dir, day)
+            self.assertGreater(len(index['chunks']), 1)
+            self.assertEqual(archive.get_index(out_dir, other_day)['routes'], {})
@@ -0,0 +1,136 @@
+"""
+Compact storage of vehicle locations for plotting (VehicleTrajectory).
+Each saved location is appended as (epoch, position) to the trajectory of its route, vehicle and hour,
+8 bytes per sample instead of a VehicleLocation row. Appending rewrites the value of the hour, which stays small
+enough to be stored inline rather than in TOAST. Trajectories of past days can be rebuilt from VehicleLocation
+(see build_trajectories); trajectories of archived days are deleted by archive_old_locations.
+"""
+import math
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytz
+from django.conf import settings
+from django.db import connection, transaction
+
+from .models import VehicleLocation, VehicleTrajectory
+
+
+TRAJECTORY_TABLE = VehicleTrajectory._meta.db_table
+
+EPOCH_DTYPE = np.dtype('<i4')
+POSITION_DTYPE = np.dtype('<f4')
+
+
+def get_local_day(date_):
+    return date_.astimezone(settings.LOCAL_TIMEZONE).date()
+
+
+def get_hour(date_):
+    """ Returns the start of the hour of date_ in UTC """
+    return datetime.fromtimestamp(int(date_.timestamp()) // 3600 * 3600, pytz.utc)
+
+
+def get_local_day_range(day):
+    date_from = settings.LOCAL_TIMEZONE.localize(datetime.combine(day, datetime.min.time()))
+    date_to = settings.LOCAL_TIMEZONE.localize(datetime.combine(day + timedelta(days=1), datetime.min.time()))
+    return date_from, date_to
+
+
+def pack_locations(locations):
+    """ Returns a dict of (route-id, vehicle-id, hour): (epochs-bytes, positions-bytes) of VehicleLocation objects """
+    samples = {}
+    for loc in locations:
+        position = math.nan if loc.route_position is None else loc.route_position
+        samples.setdefault((loc.route_id, loc.vehicle_id, get_hour(loc.date)), []).append((int(loc.date.timestamp()), position))
+
+    return {
+        key: (np.array([s[0] for s in key_samples], dtype=EPOCH_DTYPE).tobytes(), np.array([s[1] for s in key_samples], dtype=POSITION_DTYPE).tobytes())
+        for key, key_samples in samples.items()
+    }
+
+
+def append_trajectories(locations):
+    """ Appends saved VehicleLocation objects locations to their trajectories """
+    packed = pack_locations(locations)
+    if not packed:
+        return
+
+    if connection.vendor == 'postgresql':
+        query = (
+            'insert into {0} (route_id, vehicle_id, hour, epochs, positions) values {1} '
+            'on conflict (route_id, vehicle_id, hour) do update '
+            'set epochs = {0}.epochs || excluded.epochs, positions = {0}.positions || excluded.positions'
+        ).format(TRAJECTORY_TABLE, ', '.join(['(%s, %s, %s, %s, %s)'] * len(packed)))
+        params = [val for key, (epochs, positions) in packed.items() for val in (*key, epochs, positions)]
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+        return
+
+    # Other databases can't concatenate binary values
+    with transaction.atomic():
+        for (route_id, vehicle_id, hour), (epochs, positions) in packed.items():
+            trajectory, is_created = VehicleTrajectory.objects.select_for_update().get_or_create(
+                route_id=route_id, vehicle_id=vehicle_id, hour=hour,
+                defaults={'epochs': epochs, 'positions': positions},
+            )
+            if not is_created:
+                trajectory.epochs = bytes(trajectory.epochs) + epochs
+                trajectory.positions = bytes(trajectory.positions) + positions
+                trajectory.save(update_fields=['epochs', 'positions'])
+
+
+def build_trajectories(day, route_ids=None):
+    """ Replaces trajectories of local day day (of routes route_ids or all routes) with ones built from VehicleLocation """
+    date_from, date_to = get_local_day_range(day)
+
+    trajectories = VehicleTrajectory.objects.filter(hour__gte=date_from, hour__lt=date_to)
+    locations = VehicleLocation.objects.filter(date__gte=date_from, date__lt=date_to).order_by('route', 'vehicle_id', 'date')
+    if route_ids is not None:
+        trajectories = trajectories.filter(route__in=route_ids)
+        locations = locations.filter(route__in=route_ids)
+
+    with transaction.atomic():
+        trajectories.delete()
+        VehicleTrajectory.objects.bulk_create([
+            VehicleTrajectory(route_id=route_id, vehicle_id=vehicle_id, hour=hour, epochs=epochs, positions=positions)
+            for (route_id, vehicle_id, hour), (epochs, positions) in pack_locations(locations.iterator()).items()
+        ], batch_size=1000)
+
+
+def delete_trajectories(day):
+    """ Deletes trajectories of local day day; used once locations of the day are archived """
+    date_from, date_to = get_local_day_range(day)
+    return VehicleTrajectory.objects.filter(hour__gte=date_from, hour__lt=date_to).delete()[0]
+
+
+def read_trajectories(route, date_from, date_to):
+    """ Returns a list of (vehicle-id, epochs, positions) of route between date_from and date_to, sorted by vehicle id
+
+    epochs and positions are numpy arrays sorted by epoch; positions of unprocessed locations are NaN.
+    """
+    trajectories = (
+        VehicleTrajectory
+        .objects
+        .filter(route=route, hour__gte=get_hour(date_from), hour__lt=date_to)
+        .order_by('vehicle_id', 'hour')
+        .values_list('vehicle_id', 'epochs', 'positions')
+    )
+
+    data = {}
+    for vehicle_id, epochs, positions in trajectories:
+        data.setdefault(vehicle_id, []).append((np.frombuffer(epochs, dtype=EPOCH_DTYPE), np.frombuffer(positions, dtype=POSITION_DTYPE)))
+
+    epoch_from, epoch_to = date_from.timestamp(), date_to.timestamp()
+    ret = []
+    for vehicle_id, vehicle_data in sorted(data.items()):
+        epochs = np.concatenate([d[0] for d in vehicle_data])
+        positions = np.concatenate([d[1] for d in vehicle_data])
+
+        order = np.argsort(epochs, kind='stable')
+        epochs, positions = epochs[order], positions[order]
+        is_inside = (epochs >= epoch_from) & (epochs < epoch_to)
+        if is_inside.any():
+            ret.append((vehicle_id, epochs[is_inside], positions[is_inside].astype(float)))
+
+    return ret
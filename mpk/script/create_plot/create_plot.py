@@ -1,13 +1,27 @@
+import functools
+import logging
 import math
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 
+import numpy as np
 import pytz
+from django.conf import settings as django_settings
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.collections import LineCollection
 from matplotlib.figure import Figure
+from PIL import Image
 
 from routes.models import Route
+from vehicle_locations.archive import get_day_range, get_index, get_row_position, read_archived_locations
+from vehicle_locations.models import VehicleLocation
+from vehicle_locations.rollups import get_plot_level, read_rollups
+from vehicle_locations.trajectories import read_trajectories
 
-from .lib import settings
+from .lib import segment_cache, settings
+
+
+logger = logging.getLogger('default')
 
 
 # Some global settings
@@ -15,7 +29,12 @@ params = settings.Params()
 settings.set_mpl_settings()
 
 
+# Positions of plot data for browsers are multiples of 1/DATA_POSITION_SCALE of a stop (see get_plot_data)
+DATA_POSITION_SCALE = 100
+
+
 _MPL_EPOCH_PLUS_DAY = datetime(1, 1, 1, tzinfo=pytz.utc)
+_MPL_UNIX_EPOCH = (datetime(1970, 1, 1, tzinfo=pytz.utc) - _MPL_EPOCH_PLUS_DAY).total_seconds() / 86400. + 1.
 
 
 def _epoch_to_datetime(sec):
@@ -66,97 +85,546 @@ def _calculate_xticks_and_labels(date_from_local, date_to_local, params):
     return [], []
 
 
-def _process_vehicle_locations(locations, num_stops, params):
+def _points_to_arrays(points):
+    """ Returns arrays of vehicle ids, dates and positions of points, an iterable of (vehicle-id, date, position)
+
+    Positions of unprocessed locations (None) are NaN.
+    """
+    points = list(points)
+    vehicle_ids = np.fromiter((point[0] for point in points), dtype=np.int64, count=len(points))
+    dates = np.fromiter((point[1] for point in points), dtype=float, count=len(points))
+    positions = np.array([point[2] for point in points], dtype=float)
+
+    return vehicle_ids, dates, positions
+
+
+def _get_location_points(route, date_from, date_to):
+    """ Returns arrays of vehicle ids, dates and positions of locations of route, sorted by vehicle id and date
+
+    Dates are in matplotlib date format; position is NaN if the location isn't processed.
+    """
+    # Only columns of the covering index on (route, date) are read
+    locations = (
+        route
+        .vehiclelocation_set
+        .filter(date__gte=date_from, date__lt=date_to)
+        .order_by('vehicle_id', 'date')
+        .values_list('vehicle_id', 'date', 'route_position')
+    )
+
+    return _points_to_arrays(
+        (vehicle_id, _datetime_to_num(date_), position)
+        for vehicle_id, date_, position in locations.iterator()
+    )
+
+
+def _get_trajectory_points(route, date_from, date_to):
+    """ Same as _get_location_points, but reads compact trajectories """
+    vehicle_ids, dates, positions = [np.empty(0, dtype=np.int64)], [np.empty(0)], [np.empty(0)]
+    for vehicle_id, epochs, vehicle_positions in read_trajectories(route, date_from, date_to):
+        vehicle_ids.append(np.full(len(epochs), vehicle_id, dtype=np.int64))
+        dates.append(_MPL_UNIX_EPOCH + epochs / 86400.)
+        positions.append(vehicle_positions)
+
+    return np.concatenate(vehicle_ids), np.concatenate(dates), np.concatenate(positions)
+
+
+def _get_archived_points(route, stops, date_from, date_to, indexes):
+    """ Same as _get_location_points, but reads dumps of archive_old_locations of days with indexes indexes (a dict of
+    local-day: index, see _get_archived_days)
+    """
+    stop_inds = {stop.id: stop.route_index for stop in stops}
+    vehicle_ids, dates, positions = _points_to_arrays(
+        (int(row['vehicle_id']), _datetime_to_num(row['date']), get_row_position(row, stop_inds))
+        for row in read_archived_locations(django_settings.LOCATIONS_ARCHIVE_DIR, route.id, date_from, date_to, indexes)
+    )
+    inds = np.lexsort((dates, vehicle_ids))
+
+    return vehicle_ids[inds], dates[inds], positions[inds]
+
+
+def _get_rollup_points(route, level, date_from, date_to):
+    """ Same as _get_location_points, but reads rollups of level level
+
+    Each bucket gives its first and last processed locations, with its unprocessed locations before, between and after them.
+    """
+    points = []
+    for rollup in read_rollups(route, level, date_from, date_to).iterator():
+        vehicle_id, bucket = rollup.vehicle_id, _datetime_to_num(rollup.bucket)
+        if rollup.first_date is None:
+            points.extend([(vehicle_id, bucket, None)] * rollup.num_unprocessed)
+            continue
+
+        first, last = _datetime_to_num(rollup.first_date), _datetime_to_num(rollup.last_date)
+        num_between = rollup.num_unprocessed - rollup.num_lead_unprocessed - rollup.num_trail_unprocessed
+
+        points.extend([(vehicle_id, first, None)] * rollup.num_lead_unprocessed)
+        points.append((vehicle_id, first, rollup.first_position))
+        if last != first:
+            points.extend([(vehicle_id, last, None)] * num_between)
+            points.append((vehicle_id, last, rollup.last_position))
+        points.extend([(vehicle_id, last, None)] * rollup.num_trail_unprocessed)
+
+    return _points_to_arrays(points)
+
+
+def _get_data_type(prev_point, point, num_unprocessed_in_a_row, num_stops, params, max_diff_continuous_data):
+    """ Returns the type of the line between consecutive processed points of a vehicle: 'data', 'gap-data' or 'invalid-data'
+
+    Returns None if the vehicle id seems to have been reused, so the points shouldn't be connected.
+    """
+    diff = point[0] - prev_point[0]
+    if diff <= max_diff_continuous_data:
+        return 'data'
+
+    # Data gap or invalid data
+    num_exp_pts = round(diff * 24 * 3600 / params.sampling_interval_s) - 1  # Expected number of points
+    if num_unprocessed_in_a_row > num_exp_pts / 2:
+        # Invalid data
+        return 'invalid-data'
+
+    ## Heuristics for not plotting data gap when reusing vehicle id
+    # Case 1: gap longer than params.max_length_data_gap hours
+    if diff > params.max_length_data_gap_h / 24:
+        return None
+
+    # Case 2: gap from almost the first stop to almost the last one
+    min_stop_ind, max_stop_ind = min(prev_point[1], point[1]), max(prev_point[1], point[1])
+    if min_stop_ind <= 2 and max_stop_ind >= num_stops-3:
+        return None
+
+    # Data gap
+    return 'gap-data'
+
+
+def _split_vehicle_data(data, vehicle_id):
+    """ Moves the current line of vehicle_id to a new key (vehicle_id as a string, with '_' appended until it's unique) """
+    new_vehicle_id = str(vehicle_id)
+    while new_vehicle_id in data:
+        new_vehicle_id = f'{new_vehicle_id}_'
+
+    data[new_vehicle_id] = data[vehicle_id]
+    data[vehicle_id] = [[]]
+
+
+def _process_vehicle_locations(vehicle_ids, dates, positions, num_stops, params, max_diff_continuous_data_s=None):
     """
-    Returns a dict with 'data', 'gap-data' and 'invalid-data' keys. Each value is a dict of vehicle_id: list-of-lines,
-    where line is a list of two-element tuples (date, stop-idx).
+    vehicle_ids, dates and positions are arrays of locations sorted by vehicle id and date (see _get_location_points);
+    positions of unprocessed locations are NaN.
+    Returns a dict with 'data', 'gap-data' and 'invalid-data' keys. Each value is a dict of vehicle_id: list-of-lines.
+    Data lines are arrays of rows (date, stop-idx), with a row (date, NaN) where a gap or invalid data line starts;
+    gap and invalid data lines are pairs of points (date, stop-idx).
     Dates are in matplotlib date format.
     These structures are ready to be used to create LineCollection objects
+    max_diff_continuous_data_s overrides params.max_diff_continuous_data_s.
+    """
+    if max_diff_continuous_data_s is None:
+        max_diff_continuous_data_s = params.max_diff_continuous_data_s
+    max_diff_continuous_data = max_diff_continuous_data_s / 24 / 3600
+
+    # Processed points, and numbers of unprocessed locations up to them
+    is_unprocessed = np.isnan(positions)
+    num_unprocessed = np.cumsum(is_unprocessed)
+    inds = np.flatnonzero(~is_unprocessed)
+    vehicle_ids, dates, positions, num_unprocessed = vehicle_ids[inds], dates[inds], positions[inds], num_unprocessed[inds]
+
+    ## Types of lines between consecutive processed points (see _get_data_type); type of point i is the one of line (i-1, i)
+    # 0: first point of a vehicle, 1: data, 2: gap-data, 3: invalid-data, 4: reused vehicle id
+    point_types = np.zeros(len(inds), dtype=np.int8)
+    diff = np.diff(dates)
+    num_unprocessed_in_a_row = np.diff(num_unprocessed)
+    num_exp_pts = np.round(diff * 24 * 3600 / params.sampling_interval_s) - 1  # Expected number of points
+    min_stop_ind, max_stop_ind = np.minimum(positions[1:], positions[:-1]), np.maximum(positions[1:], positions[:-1])
+    is_reused = (diff > params.max_length_data_gap_h / 24) | ((min_stop_ind <= 2) & (max_stop_ind >= num_stops-3))
+    point_types[1:] = np.select(
+        [np.diff(vehicle_ids) != 0, diff <= max_diff_continuous_data, num_unprocessed_in_a_row > num_exp_pts / 2, is_reused],
+        [0, 1, 3, 4],
+        2,
+    )
+
+    ## Gap and invalid data lines
+    dest_data = {2: {}, 3: {}}
+    line_inds = np.flatnonzero((point_types == 2) | (point_types == 3))
+    line_point_inds = np.column_stack([line_inds - 1, line_inds])
+    line_points = np.stack([dates[line_point_inds], positions[line_point_inds]], axis=-1).tolist()
+    for vehicle_id, point_type, line in zip(vehicle_ids[line_inds].tolist(), point_types[line_inds].tolist(), line_points):
+        dest_data[point_type].setdefault(vehicle_id, []).append(line)
+
+    ## Data lines; gap and invalid data lines are preceded by a point without position, halfway between the points
+    lines = np.column_stack([
+        np.insert(dates, line_inds, dates[line_inds] - diff[line_inds - 1] / 2),
+        np.insert(positions, line_inds, np.nan),
+    ])
+
+    # Lines start at the first points of vehicles and at reused vehicle ids; lines of a vehicle except the last one are
+    # named vehicle-id as string, with '_' appended until it's unique
+    starts = np.flatnonzero((point_types == 0) | (point_types == 4))
+    line_starts = (starts + np.searchsorted(line_inds, starts, side='right')).tolist()
+    line_ends = line_starts[1:] + [len(lines)]
+
+    data = {}
+    prev_vehicle_id = None
+    for vehicle_id, line_start, line_end in zip(vehicle_ids[starts].tolist(), line_starts, line_ends):
+        if vehicle_id != prev_vehicle_id:
+            data[vehicle_id] = None
+            prev_vehicle_id, num_lines = vehicle_id, 0
+        else:
+            data[str(vehicle_id) + '_' * num_lines] = data[vehicle_id]
+            num_lines += 1
+        data[vehicle_id] = [lines[line_start:line_end]]
+
+    return {
+        'data': data,
+        'gap-data': dest_data[2],
+        'invalid-data': dest_data[3],
+    }
+
+
+def _process_bucket(vehicle_ids, dates, positions, num_stops, params, max_diff_continuous_data_s=None):
+    """ Processes locations of a time bucket on their own, so that buckets can be cached and stitched (see _stitch_buckets)
+
+    Returns (data, ends), where data is as returned by _process_vehicle_locations and ends is a dict of
+    vehicle-id: (first-point, num-unprocessed-before, last-point, num-unprocessed-after) of processed points
+    (date, stop-idx); if no location of a vehicle is processed, its points are None and all its unprocessed locations
+    are counted both before and after.
     """
-    max_diff_continuous_data = params.max_diff_continuous_data_s / 24 / 3600
-    max_length_data_gap = params.max_length_data_gap_h / 24
+    data = _process_vehicle_locations(vehicle_ids, dates, positions, num_stops, params, max_diff_continuous_data_s)
+
+    ends = {}
+    bounds = [0, *(np.flatnonzero(np.diff(vehicle_ids)) + 1).tolist(), len(vehicle_ids)]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if start == end:
+            continue
 
-    data, gap_data, invalid_data = {}, {}, {}
-    prev_vehicle_id, prev_point, num_unprocessed_in_a_row = None, None, 0
-    for loc in locations:
-        date_ = _datetime_to_num(loc.date)
-        vehicle_id = loc.vehicle_id
+        vehicle_id = int(vehicle_ids[start])
+        inds = np.flatnonzero(~np.isnan(positions[start:end])) + start
+        if not len(inds):
+            ends[vehicle_id] = (None, end - start, None, end - start)
+            continue
+
+        first, last = inds[0], inds[-1]
+        ends[vehicle_id] = (
+            (float(dates[first]), float(positions[first])), int(first - start),
+            (float(dates[last]), float(positions[last])), int(end - last - 1),
+        )
 
-        if loc.is_processed:
-            stop_ind = loc.current_stop.route_index if loc.is_at_stop else loc.current_stop.route_index + loc.to_next_stop_ratio
-            point = (date_, stop_ind)
+    return data, ends
+
+
+def _stitch_buckets(buckets, num_stops, params, max_diff_continuous_data_s=None):
+    """ Returns the result of _process_vehicle_locations of all locations of consecutive buckets (see _process_bucket) """
+    if max_diff_continuous_data_s is None:
+        max_diff_continuous_data_s = params.max_diff_continuous_data_s
+    max_diff_continuous_data = max_diff_continuous_data_s / 24 / 3600
+
+    ret = {'data': {}, 'gap-data': {}, 'invalid-data': {}}
+    data = ret['data']  # Data lines are lists of parts until they're concatenated
+    prev_ends = {}  # vehicle-id: (last-processed-point, num-unprocessed-after)
+    for bucket_data, ends in buckets:
+        for vehicle_id, (first, num_before, last, num_after) in ends.items():
+            if first is None:
+                # Only unprocessed locations
+                if vehicle_id in prev_ends:
+                    prev_point, num_unprocessed_in_a_row = prev_ends[vehicle_id]
+                    prev_ends[vehicle_id] = (prev_point, num_unprocessed_in_a_row + num_before)
+                continue
 
-            if prev_vehicle_id != vehicle_id:
-                # First data point
+            # Connect the first point with the last one of the previous buckets, the same way as _process_vehicle_locations
+            if vehicle_id not in prev_ends:
                 data[vehicle_id] = [[]]
-                num_unprocessed_in_a_row = 0
+            else:
+                prev_point, num_unprocessed_in_a_row = prev_ends[vehicle_id]
+                data_type = _get_data_type(prev_point, first, num_unprocessed_in_a_row + num_before, num_stops, params, max_diff_continuous_data)
+                if data_type is None:
+                    _split_vehicle_data(data, vehicle_id)
+                elif data_type != 'data':
+                    diff = first[0] - prev_point[0]
+                    ret[data_type].setdefault(vehicle_id, []).append([prev_point, first])
+                    data[vehicle_id][0].append(np.array([[first[0] - diff / 2, np.nan]]))
+
+            # Lines of the vehicle in this bucket: lines split off in order, then the current one
+            keys = []
+            key = str(vehicle_id)
+            while key in bucket_data['data']:
+                keys.append(key)
+                key = f'{key}_'
+            keys.append(vehicle_id)
+
+            for ind, key in enumerate(keys):
+                if ind:
+                    _split_vehicle_data(data, vehicle_id)
+                data[vehicle_id][0].append(bucket_data['data'][key][0])
+
+            for data_type in ['gap-data', 'invalid-data']:
+                if vehicle_id in bucket_data[data_type]:
+                    ret[data_type].setdefault(vehicle_id, []).extend(bucket_data[data_type][vehicle_id])
+
+            prev_ends[vehicle_id] = (last, num_after)
+
+    for vehicle_id, lines in data.items():
+        data[vehicle_id] = [np.concatenate(lines[0])]
+
+    return ret
+
+
+def _get_archived_days(date_from, date_to):
+    """ Returns a dict of local-day: index of days between date_from and date_to that are read from dumps of
+    archive_old_locations; days are read from the dump if it has an index, which is written before records of the day
+    are deleted from the db (see vehicle_locations.archive.get_index)
+    """
+    if not django_settings.LOCATIONS_ARCHIVE_DIR:
+        return {}
+
+    archived_days = {}
+    day = date_from.astimezone(django_settings.LOCAL_TIMEZONE).date()
+    while get_day_range(day)[0] < date_to:
+        index = get_index(django_settings.LOCATIONS_ARCHIVE_DIR, day)
+        if index is not None:
+            archived_days[day] = index
+        day += timedelta(days=1)
+
+    return archived_days
+
+
+def _split_by_archived_days(date_from, date_to, archived_days):
+    """ Returns a list of (date-from, date-to, is-archived) of consecutive parts of the period that are, or aren't,
+    in archived days archived_days
+    """
+    parts = []
+    day = date_from.astimezone(django_settings.LOCAL_TIMEZONE).date()
+    while True:
+        day_start, day_end = get_day_range(day)
+        if day_start >= date_to:
+            return parts
+
+        part_from, part_to, is_archived = max(date_from, day_start), min(date_to, day_end), day in archived_days
+        if parts and parts[-1][2] == is_archived:
+            parts[-1] = (parts[-1][0], part_to, is_archived)
+        else:
+            parts.append((part_from, part_to, is_archived))
+        day += timedelta(days=1)
+
+
+def _get_local_days(date_from, date_to):
+    """ Returns local days of the period [date_from, date_to) """
+    first_day = date_from.astimezone(django_settings.LOCAL_TIMEZONE).date()
+    last_day = (date_to - timedelta(microseconds=1)).astimezone(django_settings.LOCAL_TIMEZONE).date()
+    return [first_day + timedelta(days=ind) for ind in range((last_day - first_day).days + 1)]
+
+
+def _get_db_points(route, date_from, date_to, level):
+    """ Returns arrays of locations (see _get_location_points) of route between date_from and date_to, from rollups of level level
+    if it isn't None, otherwise from PLOT_DATA_SOURCE
+    """
+    if level is not None:
+        return _get_rollup_points(route, level, date_from, date_to)
+    if django_settings.PLOT_DATA_SOURCE == 'trajectories':
+        return _get_trajectory_points(route, date_from, date_to)
+
+    return _get_location_points(route, date_from, date_to)
+
+
+def _read_archived_runs(route, stops, periods, archived_days):
+    """ Returns a list of (date-from, date-to, points) of archived locations of periods periods (a list of sorted
+    (date-from, date-to)); adjacent periods are read at once, so that archive chunks are decompressed once
+    """
+    runs = []
+    for period_from, period_to in periods:
+        if runs and runs[-1][1] == period_from:
+            runs[-1][1] = period_to
+        else:
+            runs.append([period_from, period_to])
+
+    return [(run_from, run_to, _get_archived_points(route, stops, run_from, run_to, archived_days)) for run_from, run_to in runs]
+
+
+def _select_points(points, date_from, date_to):
+    """ Returns locations of points (see _get_location_points) between date_from and date_to """
+    vehicle_ids, dates, positions = points
+    is_inside = (dates >= _datetime_to_num(date_from)) & (dates < _datetime_to_num(date_to))
+    return vehicle_ids[is_inside], dates[is_inside], positions[is_inside]
+
+
+def _get_vehicle_data(route, stops, date_from, date_to, level, max_diff_continuous_data_s=None):
+    """ Returns the result of _process_vehicle_locations of points of route between date_from and date_to
+
+    The period is split into buckets of PLOT_SEGMENT_BUCKET_S aligned to the epoch; buckets ending PLOT_SEGMENT_SETTLE_S
+    ago are complete and processed only once (see lib.segment_cache), partial buckets at both ends are processed
+    every time.
+    Locations of archived days (see _get_archived_days) are read from archives, all buckets at once; other ones are read
+    from the db, from rollups of level level if it isn't None. Buckets read from the db aren't cached if their day has
+    been archived meanwhile, as its records might have been partly deleted.
+    """
+    num_stops = len(stops)
+    bucket_s = django_settings.PLOT_SEGMENT_BUCKET_S
+    complete_epoch = time.time() - django_settings.PLOT_SEGMENT_SETTLE_S
+    source = django_settings.PLOT_DATA_SOURCE if level is None else f'rollups-{level}'
+    key_prefix = segment_cache.get_key_prefix(route, settings.Params.VERSION, source)
+    archived_days = _get_archived_days(date_from, date_to)
+
+    # Cached buckets
+    epoch_from, epoch_to = date_from.timestamp(), date_to.timestamp()
+    bounds = [epoch_from, *range(math.ceil(epoch_from / bucket_s) * bucket_s, math.ceil(epoch_to / bucket_s) * bucket_s, bucket_s), epoch_to]
+    buckets, missing = [], []  # missing: (bucket-ind, bucket-from, parts, is-complete)
+    for bucket_from, bucket_to in zip(bounds[:-1], bounds[1:]):
+        if bucket_from >= bucket_to:
+            continue
+
+        is_complete = bucket_from % bucket_s == 0 and bucket_to == bucket_from + bucket_s and bucket_to <= complete_epoch
+        bucket = segment_cache.get_bucket(key_prefix, bucket_from) if is_complete else None
+        if bucket is None:
+            parts = _split_by_archived_days(datetime.fromtimestamp(bucket_from, pytz.utc), datetime.fromtimestamp(bucket_to, pytz.utc), archived_days)
+            missing.append((len(buckets), bucket_from, parts, is_complete))
+        buckets.append(bucket)
 
+    # Other buckets
+    archived_runs = _read_archived_runs(
+        route, stops, [(part_from, part_to) for _, _, parts, _ in missing for part_from, part_to, is_archived in parts if is_archived], archived_days,
+    )
+    db_days = set()
+    for bucket_ind, bucket_from, parts, is_complete in missing:
+        part_points = []
+        for part_from, part_to, is_archived in parts:
+            if is_archived:
+                run_points = next(points for run_from, run_to, points in archived_runs if run_from <= part_from and part_to <= run_to)
+                part_points.append(_select_points(run_points, part_from, part_to))
             else:
-                # Not the first data point
-                diff = date_ - prev_point[0]
-                if diff > max_diff_continuous_data:
-                    # Data gap or invalid data
-                    num_exp_pts = round(diff * 24 * 3600 / params.sampling_interval_s) - 1  # Expected number of points
-                    if num_unprocessed_in_a_row > num_exp_pts / 2:
-                        # Invalid data
-                        dest_data = invalid_data
-                    else:
-                        # Data gap
-                        dest_data = gap_data
-
-                        ## Heuristics for not plotting data gap when reusing vehicle id
-                        # Case 1: gap longer than params.max_length_data_gap hours
-                        if diff > max_length_data_gap:
-                            dest_data = None
-
-                        # Case 2: gap from almost the first stop to almost the last one
-                        prev_stop_ind = prev_point[1]
-                        min_stop_ind, max_stop_ind = min(prev_stop_ind, stop_ind), max(prev_stop_ind, stop_ind)
-                        if min_stop_ind <= 2 and max_stop_ind >= num_stops-3:
-                            dest_data = None
-
-                    if dest_data is None:
-                        # Break this vehicle data in two and don't plot line between the two parts
-                        new_vehicle_id = str(vehicle_id)
-                        while new_vehicle_id in data:
-                            new_vehicle_id = f'{new_vehicle_id}_'
-
-                        data[new_vehicle_id] = data[vehicle_id]
-                        data[vehicle_id] = [[]]
-
-                    else:
-                        # Plot gap/invalid data line
-                        dest_data.setdefault(loc.vehicle_id, []).append([prev_point, point])
-                        data[vehicle_id][0].append((date_ - diff / 2, None))
-
-            # Add this point
-            data[vehicle_id][0].append(point)
-
-            # Set last processed point
-            prev_vehicle_id, prev_point, num_unprocessed_in_a_row = vehicle_id, point, 0
+                part_points.append(_get_db_points(route, part_from, part_to, level))
+                if is_complete:
+                    db_days.update(_get_local_days(part_from, part_to))
 
+        if len(part_points) == 1:
+            points = part_points[0]
         else:
-            # Unprocessed location
-            if prev_vehicle_id != vehicle_id:
-                # New vehicle id; ignore all unprocessed locations before the first processed
-                continue
+            vehicle_ids, dates, positions = [np.concatenate(arrays) for arrays in zip(*part_points)]
+            inds = np.lexsort((dates, vehicle_ids))
+            points = vehicle_ids[inds], dates[inds], positions[inds]
+        buckets[bucket_ind] = _process_bucket(*points, num_stops, params, max_diff_continuous_data_s)
+
+    # Cache complete buckets, unless their day was being archived
+    newly_archived_days = set()
+    if db_days and django_settings.LOCATIONS_ARCHIVE_DIR:
+        newly_archived_days = {day for day in db_days if get_index(django_settings.LOCATIONS_ARCHIVE_DIR, day) is not None}
+    for bucket_ind, bucket_from, parts, is_complete in missing:
+        is_archived_meanwhile = any(
+            not is_archived and newly_archived_days.intersection(_get_local_days(part_from, part_to))
+            for part_from, part_to, is_archived in parts
+        )
+        if is_complete and not is_archived_meanwhile:
+            segment_cache.set_bucket(key_prefix, bucket_from, buckets[bucket_ind])
 
-            num_unprocessed_in_a_row += 1
+    return _stitch_buckets(buckets, num_stops, params, max_diff_continuous_data_s)
 
-    return {
-        'data': data,
-        'gap-data': gap_data,
-        'invalid-data': invalid_data,
-    }
+
+def _get_ylim(num_stops, params):
+    full_range = (num_stops - 1) / (1. - 2 * params.stops_margin_n)
+    full_margin = full_range - num_stops + 1
+    return num_stops - 1 + full_margin / 2, 0 - full_margin / 2
 
 
-def create_plot(line_no, date_from_local, date_to_local, out_filename):
+def _create_figure(params):
+    """ Returns (figure, canvas-axes) of a plot """
+    figure_h = Figure(
+        figsize=params.window_size_i,
+        dpi=params.dpi,
+    )
+
+    canvas_h = figure_h.add_axes(
+        (params.canvas_left_edge_n, params.canvas_bottom_edge_n, params.canvas_width_n, params.canvas_height_n),
+        zorder=-20,
+    )
+
+    return figure_h, canvas_h
+
+
+@functools.lru_cache(maxsize=16)
+def _render_background(line_no, stop_names):
+    """ Returns the rendered region of the parts of plots of line line_no that don't depend on the period: the title,
+    the frame, and stops stop_names with their grid lines
+
+    Backgrounds of the most recently plotted lines are kept, so plots only draw the time axis and the data.
+    """
+    num_stops = len(stop_names)
+
+    figure_h, canvas_h = _create_figure(params)
+    FigureCanvasAgg(figure_h)
+
+    full_window_h = figure_h.add_axes(
+        [0., 0., 1., 1.],
+        zorder=-20,
+    )
+    full_window_h.set_axis_off()
+
+    # X axis
+    canvas_h.set_xticks([])
+
+    # Y axis
+    canvas_h.set_yticks(range(num_stops))
+    canvas_h.set_yticklabels(
+        stop_names,
+        fontsize=params.left_fontsize,
+        linespacing=1.,
+    )
+    canvas_h.set_ylim(_get_ylim(num_stops, params))
+    for stop_ind in range(num_stops):
+        canvas_h.axhline(
+            stop_ind,
+            color='k',
+            ls=':',
+            lw=0.5,
+        )
+
+    # Title
+    title_str = f'MPK Wrocław stringline plot: line {line_no.upper()}'
+    full_window_h.text(
+        .5,
+        params.title_top_margin_n,
+        title_str,
+        fontsize=params.title_fontsize,
+        va='top',
+        ha='center',
+    )
+
+    figure_h.canvas.draw()
+    return figure_h.canvas.copy_from_bbox(figure_h.bbox)
+
+
+def _rgb_to_int(rgb):
+    return (rgb[..., 0].astype(np.uint32) << 16) | (rgb[..., 1].astype(np.uint32) << 8) | rgb[..., 2]
+
+
+def _write_palette_png(filename, rgba, dpi):
+    """ Writes the RGBA array rgba of an opaque image as an 8-bit palette PNG, and returns the number of its colours,
+    or None if there are more than 256
+
+    The palette is exact if the image has at most 256 colours, otherwise colours are quantized (anti-aliased data lines
+    usually add more).
+    """
+    rgb = np.ascontiguousarray(rgba[..., :3])
+    image = Image.fromarray(rgb)
+
+    colours = image.getcolors(256)
+    if colours is None:
+        image = image.quantize(256, method=Image.FASTOCTREE)
+    else:
+        palette = np.array(sorted(colour for _, colour in colours), dtype=np.uint8)
+        inds = np.searchsorted(_rgb_to_int(palette), _rgb_to_int(rgb)).astype(np.uint8)
+        image = Image.frombytes('P', image.size, inds.tobytes())
+        image.putpalette(palette.tobytes())
+
+    image.save(filename, format='PNG', dpi=(dpi, dpi))
+
+    return None if colours is None else len(colours)
+
+
+def _get_plot_data(line_no, date_from_local, date_to_local):
+    """ Returns (route, stops, data, vehicle-directions) of the plot of line line_no, where data is as returned by
+    _process_vehicle_locations
+    """
     # Check params
     if date_from_local.tzinfo is None or date_to_local.tzinfo != date_from_local.tzinfo:
         raise ValueError('Dates have to be timezone-aware')
 
-    timezone_local = date_from_local.tzinfo
-
     ## Get data
     # Route
     try:
@@ -166,29 +634,59 @@ def create_plot(line_no, date_from_local, date_to_local, out_filename):
 
     # Stops
     stops = list(route.stop_set.all())
-    num_stops = len(stops)
 
-    # Vehicle locations
-    locations = (
-        route
-        .vehiclelocation_set
-        .select_related('current_stop')
-        .filter(date__gte=date_from_local, date__lt=date_to_local)
-        .order_by('vehicle_id', 'date')
-    )
+    # Vehicle locations; long periods are read from rollups
+    level = get_plot_level(date_from_local, date_to_local, params.canvas_width_p)
+    max_diff_continuous_data_s = None
+    if level is not None:
+        # Gaps shorter than a bucket aren't wider than a pixel, and locations of a bucket are at most a bucket apart
+        max_diff_continuous_data_s = params.max_diff_continuous_data_s + level
 
     ## Process data
     # Vehicle locations
-    data = _process_vehicle_locations(locations, num_stops, params)
-
-    # No locations
-    any_data_to_display = any([data['data'], data['gap-data'], data['invalid-data']])
+    data = _get_vehicle_data(route, stops, date_from_local, date_to_local, level, max_diff_continuous_data_s)
 
     # Vehicle directions
     vehicle_directions = {}
     for veh_id, d in data['data'].items():
         vehicle_directions[veh_id] = params.DIR_UP if d[0][-1][1] > d[0][0][1] else params.DIR_DOWN
 
+    return route, stops, data, vehicle_directions
+
+
+def _get_no_data_msg(route, line_no, date_to_local):
+    timezone_local = date_to_local.tzinfo
+    earliest_data = (
+        route
+        .vehiclelocation_set
+        .order_by('date')
+        .first()
+    )
+    latest_data = (
+        route
+        .vehiclelocation_set
+        .order_by('-date')
+        .first()
+    )
+
+    if not earliest_data:
+        return f'No data collected so far for line {line_no}'
+    elif date_to_local < earliest_data.date and not django_settings.LOCATIONS_ARCHIVE_DIR:
+        return 'The earliest data available for line {}\nis at {}'.format(line_no, earliest_data.date.astimezone(timezone_local).strftime('%Y-%m-%d %H:%M'))
+    elif latest_data.date < date_to_local:
+        return 'The latest data available for line {}\nis at {}'.format(line_no, latest_data.date.astimezone(timezone_local).strftime('%Y-%m-%d %H:%M'))
+    else:
+        return 'No data for this plot'
+
+
+def create_plot(line_no, date_from_local, date_to_local, out_filename):
+    ## Get data
+    route, stops, data, vehicle_directions = _get_plot_data(line_no, date_from_local, date_to_local)
+    num_stops = len(stops)
+
+    # No locations
+    any_data_to_display = any([data['data'], data['gap-data'], data['invalid-data']])
+
     # X axis
     xticks, xticklabels = _calculate_xticks_and_labels(date_from_local, date_to_local, params)
     if not xticks:
@@ -196,27 +694,15 @@ def create_plot(line_no, date_from_local, date_to_local, out_filename):
     xlim = (date_from_local, date_to_local)
 
     # Y axis
-    full_range = (num_stops - 1) / (1. - 2 * params.stops_margin_n)
-    full_margin = full_range - num_stops + 1
-    ylim = (num_stops - 1 + full_margin / 2, 0 - full_margin / 2)
+    ylim = _get_ylim(num_stops, params)
 
     ## Plot
-    # Figure
-    figure_h = Figure(
-        figsize=params.window_size_i,
-        dpi=params.dpi,
-    )
-
-    full_window_h = figure_h.add_axes(
-        [0., 0., 1., 1.],
-        zorder=-20,
-    )
-    full_window_h.set_axis_off()
-
-    canvas_h = figure_h.add_axes(
-        (params.canvas_left_edge_n, params.canvas_bottom_edge_n, params.canvas_width_n, params.canvas_height_n),
-        zorder=-20,
-    )
+    # Figure; the title, the frame and the stops are drawn from the background of the line
+    figure_h, canvas_h = _create_figure(params)
+    figure_h.patch.set_visible(False)
+    canvas_h.patch.set_visible(False)
+    for spine in canvas_h.spines.values():
+        spine.set_visible(False)
 
     # X axis
     canvas_h.set_xlim(xlim)
@@ -234,20 +720,8 @@ def create_plot(line_no, date_from_local, date_to_local, out_filename):
         )
 
     # Y axis
-    canvas_h.set_yticks(range(num_stops))
-    canvas_h.set_yticklabels(
-        [stop.display_name for stop in stops],
-        fontsize=params.left_fontsize,
-        linespacing=1.,
-    )
     canvas_h.set_ylim(ylim)
-    for stop_ind in range(len(stops)):
-        canvas_h.axhline(
-            stop_ind,
-            color='k',
-            ls=':',
-            lw=0.5,
-        )
+    canvas_h.yaxis.set_visible(False)
 
     # Plot data
     for data_type in ['data', 'gap-data', 'invalid-data']:
@@ -266,49 +740,120 @@ def create_plot(line_no, date_from_local, date_to_local, out_filename):
 
     # No data to display
     if not any_data_to_display:
-        earliest_data = (
-            route
-            .vehiclelocation_set
-            .order_by('date')
-            .first()
-        )
-        latest_data = (
-            route
-            .vehiclelocation_set
-            .order_by('-date')
-            .first()
-        )
-
-        if not earliest_data:
-            no_data_msg = f'No data collected so far for line {line_no}'
-        elif date_to_local < earliest_data.date:
-            no_data_msg = 'The earliest data available for line {}\nis at {}'.format(line_no, earliest_data.date.astimezone(timezone_local).strftime('%Y-%m-%d %H:%M'))
-        elif latest_data.date < date_to_local:
-            no_data_msg = 'The latest data available for line {}\nis at {}'.format(line_no, latest_data.date.astimezone(timezone_local).strftime('%Y-%m-%d %H:%M'))
-        else:
-            no_data_msg = 'No data for this plot'
-
         canvas_h.text(
             .5,
             .5,
-            no_data_msg,
+            _get_no_data_msg(route, line_no, date_to_local),
             fontsize=params.no_data_fontsize,
             ha='center',
             va='center',
             transform=canvas_h.transAxes,
         )
 
-    # Title
-    title_str = f'MPK Wrocław stringline plot: line {line_no.upper()}'
-    full_window_h.text(
-        .5,
-        params.title_top_margin_n,
-        title_str,
-        fontsize=params.title_fontsize,
-        va='top',
-        ha='center',
+    # Plot figure on top of the background
+    start_time = time.time()
+    renderer = FigureCanvasAgg(figure_h).get_renderer()
+    renderer.restore_region(_render_background(line_no, tuple(stop.display_name for stop in stops)))
+    figure_h.draw(renderer)
+
+    draw_time = time.time()
+    num_colours = _write_palette_png(out_filename, np.asarray(renderer.buffer_rgba()), params.dpi)
+    logger.info('Plot drawn in {:.3f}s, written in {:.3f}s ({} colours)'.format(
+        draw_time - start_time, time.time() - draw_time, '>256' if num_colours is None else num_colours,
+    ))
+
+
+def _encode_line(line, date_from_num):
+    """ Returns quantized coordinates of points of line (see get_plot_data), split where the position is NaN """
+    xy = np.column_stack([
+        np.round((line[:, 0] - date_from_num) * 86400.),
+        np.round(line[:, 1] * DATA_POSITION_SCALE),
+    ])
+
+    parts = []
+    for part in np.split(xy, np.flatnonzero(np.isnan(xy[:, 1]))):
+        part = part[~np.isnan(part[:, 1])].astype(np.int64)
+        if not len(part):
+            continue
+
+        # Differences of consecutive points; points at the same quantized coordinates are dropped
+        diffs = np.diff(part, axis=0, prepend=[[0, 0]])
+        diffs = diffs[np.r_[True, diffs[1:].any(axis=1)]]
+        parts.append(diffs.ravel().tolist())
+
+    return parts
+
+
+def get_xticks(date_from_local, date_to_local):
+    """ Returns [seconds-from-date_from_local, label] of x ticks of the plot between date_from_local and date_to_local """
+    xticks, xticklabels = _calculate_xticks_and_labels(date_from_local, date_to_local, params)
+    if not xticks:
+        raise RuntimeError('Can\'t calculate xticks for this interval')
+
+    return [[(xtick - date_from_local).total_seconds(), label] for xtick, label in zip(xticks, xticklabels)]
+
+
+def get_plot_data(line_no, date_from_local, date_to_local):
+    """ Returns the plot of line line_no as a JSON-serializable dict, for drawing it in the browser (see js.js)
+
+    Lines are lists of [direction, coordinates, vehicle-id]. Coordinates are quantized: dates to seconds from
+    date_from_local, positions to 1/DATA_POSITION_SCALE of a stop; they're x and y of the first point followed by
+    differences of consecutive points. Data lines are split where gap and invalid data lines start. Vehicle id is set
+    only for the current lines of vehicles, which new locations extend (see mpk.live).
+    watermark_s is the date of the latest location before date_to_local; locations up to it are included.
+    """
+    # Before the locations are read, so that locations collected meanwhile are sent by the live view again rather than missed
+    watermark = (
+        VehicleLocation
+        .objects
+        .filter(route__line=line_no, date__lt=date_to_local)
+        .order_by('-date')
+        .values_list('date', flat=True)
+        .first()
     )
 
-    # Plot figure
-    figure_h.savefig(out_filename, dpi=params.dpi)
+    route, stops, data, vehicle_directions = _get_plot_data(line_no, date_from_local, date_to_local)
+    any_data_to_display = any([data['data'], data['gap-data'], data['invalid-data']])
 
+    # Lines
+    date_from_num = _datetime_to_num(date_from_local)
+    lines = {}
+    for data_type in ['data', 'gap-data', 'invalid-data']:
+        lines[data_type] = []
+        for veh_id, d in data[data_type].items():
+            current_veh_id = veh_id if data_type == 'data' and isinstance(veh_id, int) else None
+            for line in d:
+                for coordinates in _encode_line(np.asarray(line, dtype=float), date_from_num):
+                    lines[data_type].append([vehicle_directions[veh_id], coordinates, current_veh_id])
+
+    # Sizes in pixels, fonts sizes in points
+    return {
+        'layout': {
+            'size': [params.window_width_p, params.window_height_p],
+            'canvas': [
+                params.canvas_left_edge_n * params.window_width_p,
+                (1. - params.canvas_top_edge_n) * params.window_height_p,
+                params.canvas_width_p,
+                params.canvas_height_p,
+            ],
+            'title_top': (1. - params.title_top_margin_n) * params.window_height_p,
+            'dpi': params.dpi,
+            'fontsizes': {
+                'title': params.title_fontsize,
+                'bottom': params.bottom_fontsize,
+                'left': params.left_fontsize,
+                'no_data': params.no_data_fontsize,
+            },
+        },
+        'title': f'MPK Wrocław stringline plot: line {line_no.upper()}',
+        'date_from_s': date_from_local.timestamp(),
+        'duration_s': (date_to_local - date_from_local).total_seconds(),
+        'watermark_s': None if watermark is None else watermark.timestamp(),
+        'max_diff_continuous_data_s': params.max_diff_continuous_data_s,
+        'position_scale': DATA_POSITION_SCALE,
+        'stops': [stop.display_name for stop in stops],
+        'ylim': _get_ylim(len(stops), params),
+        'xticks': get_xticks(date_from_local, date_to_local),
+        'lines': lines,
+        'no_data_msg': None if any_data_to_display else _get_no_data_msg(route, line_no, date_to_local),
+    }
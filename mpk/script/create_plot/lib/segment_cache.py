@@ -0,0 +1,47 @@
+"""
+Cache of processed vehicle locations of complete time buckets of routes (see create_plot._get_vehicle_data).
+Buckets are identified by the route, its modification date, the route generation, the version of the plot parameters,
+the data source and the start of the bucket. Changing locations of past buckets (e.g. reprocess_locations) has to
+invalidate the route with invalidate_routes; this changes its generation.
+"""
+import time
+
+from django.core.cache import caches
+
+
+def _get_cache():
+    return caches['plot-segments']
+
+
+def _get_generation_key(route_id):
+    return f'plot-segments-generation:{route_id}'
+
+
+def get_generation(route_id):
+    """ Returns the generation of the route, which changes when the route is invalidated """
+    cache = _get_cache()
+    generation = cache.get(_get_generation_key(route_id))
+    if generation is None:
+        # A missing generation (e.g. culled) invalidates all buckets of the route
+        generation = time.time_ns()
+        cache.set(_get_generation_key(route_id), generation, None)
+
+    return generation
+
+
+def get_key_prefix(route, version, source):
+    return 'plot-segments:{}:{}:{}:{}:{}'.format(route.id, route.date_modified.timestamp(), get_generation(route.id), version, source)
+
+
+def get_bucket(key_prefix, bucket_epoch):
+    """ Returns the cached bucket, or None """
+    return _get_cache().get(f'{key_prefix}:{bucket_epoch}')
+
+
+def set_bucket(key_prefix, bucket_epoch, bucket):
+    _get_cache().set(f'{key_prefix}:{bucket_epoch}', bucket)
+
+
+def invalidate_routes(route_ids):
+    for route_id in route_ids:
+        _get_cache().set(_get_generation_key(route_id), time.time_ns(), None)
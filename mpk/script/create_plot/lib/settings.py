@@ -7,6 +7,9 @@ class Params:
 
     DIR_UP, DIR_DOWN = 0, 1
 
+    # Has to be increased whenever plots or processed data change, to invalidate cached plots and buckets
+    VERSION = 2
+
     def __init__(self):
         # Window
         window_size_p = (1350, 955)
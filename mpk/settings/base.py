@@ -49,6 +49,7 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
 
+    'mpk.apps.mpk',
     'routes',
     'stops',
     'vehicle_locations',
@@ -95,6 +96,25 @@ WSGI_APPLICATION = 'wsgi.application'
 # DATABASES = ... (secrets env)
 
 
+# Caches
+# https://docs.djangoproject.com/en/2.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Processed vehicle locations of plots; shared by all processes, kept outside the source tree (env)
+    'plot-segments': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': None,
+        'TIMEOUT': 7 * 24 * 3600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
 
@@ -148,7 +168,22 @@ LOCAL_TIMEZONE = pytz.timezone('Europe/Warsaw')
 # Some settings
 MAX_PLOT_INTERVAL = timedelta(hours=72)
 
-# RUN_MOGRIFY = ... (env)
+# Rendered plots are cached in MEDIA_ROOT/PLOT_CACHE_DIR (see mpk.plot_cache)
+PLOT_CACHE_DIR = 'plot-cache'
+PLOT_CACHE_MAX_SIZE_MB = 500
+PLOT_CACHE_MAX_AGE_S = 24 * 3600
+
+# Processed vehicle locations of plots are cached in buckets of PLOT_SEGMENT_BUCKET_S (a multiple of an hour), once
+# the bucket ended PLOT_SEGMENT_SETTLE_S ago (see create_plot._get_vehicle_data)
+PLOT_SEGMENT_BUCKET_S = 3600
+PLOT_SEGMENT_SETTLE_S = 300
+
+# Plots are drawn in browsers from data of PlotDataView instead of being rendered as PNGs
+PLOT_CLIENT_RENDERING = False
+
+# RENDER_SERVICE_ADDRESS = ... (env); Unix socket of render_server, None renders plots and creates plot data in web workers
+# Plots not rendered, and plot data not created, within RENDER_SERVICE_TIMEOUT_S are aborted
+RENDER_SERVICE_TIMEOUT_S = 30
 
 
 # Routes and stops
@@ -159,6 +194,23 @@ ROUTE_STOPS_STEP = 100
 ## Location consts
 # GET_LOCATIONS_TIMEOUT_S = ... (env)
 
+# Interval between polls of the collect_locations command
+COLLECT_LOCATIONS_INTERVAL_S = 20
+
+# Lines are fetched concurrently in this many shards; failed requests are retried as long as they can finish
+# within GET_LOCATIONS_BUDGET_S from the start of the poll
+GET_LOCATIONS_NUM_SHARDS = 4
+GET_LOCATIONS_NUM_RETRIES = 2
+GET_LOCATIONS_BUDGET_S = 15
+# The first retry waits GET_LOCATIONS_RETRY_BACKOFF_S, each next one twice as long
+GET_LOCATIONS_RETRY_BACKOFF_S = .5
+
+# FEED_CAPTURE_DIR = ... (env); directory of raw feed captures, None disables capturing
+
+# INGEST_METRICS_TEXTFILE = ... (env); Prometheus textfile with metrics of the last poll, None disables writing it
+# Polls taking longer than this fraction of the interval are logged
+INGEST_SLOW_TICK_RATIO = .75
+
 # Valid latitude and longitude ranges
 MIN_LAT, MAX_LAT = 51., 51.2
 MIN_LONG, MAX_LONG = 16.8, 17.2
@@ -171,6 +223,36 @@ ONE_DEG_Y_KM = 111.194  # 2 * PI * EARTH_RADIUS / 360
 STOP_ADD_RADIUS_M = 15
 MAX_ALLOWED_DETOUR_RATIO = 1.5
 
+# Position engine: 'stops' (straight lines between stops, see vehicle_locations.engine) or 'shape' (projection onto
+# the route polyline, see vehicle_locations.shape_engine); with the shape engine, vehicles farther than SHAPE_MAX_DIST_M
+# from the polyline are too far from the route
+POSITION_ENGINE = 'stops'
+SHAPE_MAX_DIST_M = 50
+
+# Cell size of the spatial index over stops
+STOP_GRID_CELL_M = 250
+
+# Partitions of the vehicle locations table (PostgreSQL only) span LOCATION_PARTITION_DAYS local days;
+# partitions for LOCATION_PARTITIONS_AHEAD_DAYS days ahead are created by create_location_partitions
+LOCATION_PARTITION_DAYS = 1
+LOCATION_PARTITIONS_AHEAD_DAYS = 7
+
+# Plots are created from VehicleLocation ('locations') or VehicleTrajectory ('trajectories'); trajectories of days
+# before they were collected can be created with build_trajectories
+PLOT_DATA_SOURCE = 'locations'
+
+# Levels [s] of trajectory rollups (see vehicle_locations.rollups); levels have to divide an hour. Plots use the coarsest
+# level not longer than a pixel column
+TRAJECTORY_ROLLUP_LEVELS_S = [60, 180]
+
+# LOCATIONS_ARCHIVE_DIR = ... (env); directory of dumps of archive_old_locations, from which locations of days with
+# an index are plotted; None disables reading archives
+
+# Last known positions of vehicles are used if they aren't older than VEHICLE_STATE_MAX_AGE_S;
+# stops up to VEHICLE_STATE_WINDOW_STOPS stops from the last position are checked first
+VEHICLE_STATE_MAX_AGE_S = 120
+VEHICLE_STATE_WINDOW_STOPS = 2
+
 
 # Logging
 LOGGING = {
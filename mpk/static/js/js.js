@@ -1,3 +1,172 @@
+/* Stringline plots drawn from data of PlotDataView (see create_plot.get_plot_data) */
+var PLOT_LINE_COLOURS = ["#1f77b4", "#ff7f0e"];  // matplotlib's C0 and C1, by direction
+var PLOT_LINE_TYPES = ["data", "invalid-data", "gap-data"];  // in drawing order
+var PLOT_LINE_DASHES = {"data": [], "gap-data": [1, 3], "invalid-data": [3, 2]};  // in line widths
+var PLOT_FONT = "'Liberation Sans', Arial, sans-serif";
+var PLOT_DIR_UP = 0, PLOT_DIR_DOWN = 1;
+
+/* Replaces differences of consecutive points of lines with [epoch, position] */
+function decodePlotData(data) {
+	data.current_lines = {};
+	PLOT_LINE_TYPES.forEach(function(dataType) {
+		data.lines[dataType].forEach(function(line) {
+			var coordinates = line[1], t = data.date_from_s, position = 0, points = [];
+			for (var i = 0; i < coordinates.length; i += 2) {
+				t += coordinates[i];
+				position += coordinates[i+1];
+				points.push([t, position]);
+			}
+			line[1] = points;
+
+			// Last line of each vehicle is extended by extendPlot
+			if (line[2] !== null)
+				data.current_lines[line[2]] = line;
+		});
+	});
+}
+
+/* Adds new points of LiveView to current lines of vehicles, or to new lines after gaps, and slides the plot window */
+function extendPlot(data, update) {
+	data.date_from_s = update.date_from_s;
+	data.xticks = update.xticks;
+
+	update.points.forEach(function(point) {
+		var vehicleId = point[0], location = [point[1], point[2]];
+		var line = data.current_lines[vehicleId];
+		if (line !== undefined && location[0] - line[1][line[1].length-1][0] <= data.max_diff_continuous_data_s) {
+			line[1].push(location);
+		} else {
+			// Lines of vehicles already on the plot keep their direction
+			var isNewVehicle = line === undefined;
+			line = [isNewVehicle ? PLOT_DIR_DOWN : line[0], [location], vehicleId];
+			line.is_new_vehicle = isNewVehicle;
+			data.lines["data"].push(line);
+			data.current_lines[vehicleId] = line;
+		}
+
+		// Directions of new vehicles, the same way as create_plot
+		if (line.is_new_vehicle)
+			line[0] = location[1] > line[1][0][1] ? PLOT_DIR_UP : PLOT_DIR_DOWN;
+	});
+
+	// Lines that ended before the window
+	PLOT_LINE_TYPES.forEach(function(dataType) {
+		data.lines[dataType] = data.lines[dataType].filter(function(line) {
+			var isVisible = line[1][line[1].length-1][0] >= data.date_from_s;
+			if (!isVisible && line[2] !== null && data.current_lines[line[2]] === line)
+				delete data.current_lines[line[2]];
+			return isVisible;
+		});
+	});
+
+	if (update.points.length)
+		data.no_data_msg = null;
+}
+
+function drawPlot(canvas, data) {
+	var layout = data.layout;
+	var pt = layout.dpi / 72;  // pixels per point
+	var left = layout.canvas[0], top = layout.canvas[1], width = layout.canvas[2], height = layout.canvas[3];
+	var tickLength = 3.5 * pt, tickPad = 3.5 * pt;
+
+	function x(epoch) {
+		return left + (epoch - data.date_from_s) / data.duration_s * width;
+	}
+	function y(position) {
+		return top + (position - data.ylim[1]) / (data.ylim[0] - data.ylim[1]) * height;
+	}
+	function setFont(fontsize) {
+		ctx.font = (fontsize * pt) + "px " + PLOT_FONT;
+	}
+
+	canvas.width = layout.size[0];
+	canvas.height = layout.size[1];
+	var ctx = canvas.getContext("2d");
+	ctx.fillStyle = "white";
+	ctx.fillRect(0, 0, canvas.width, canvas.height);
+	ctx.fillStyle = ctx.strokeStyle = "black";
+
+	/* Title */
+	setFont(layout.fontsizes.title);
+	ctx.textAlign = "center";
+	ctx.textBaseline = "top";
+	ctx.fillText(data.title, canvas.width / 2, layout.title_top);
+
+	/* Grid */
+	ctx.lineWidth = .5 * pt;
+	ctx.setLineDash([.5 * pt, .83 * pt]);
+	ctx.beginPath();
+	data.stops.forEach(function(stop, ind) {
+		ctx.moveTo(left, y(ind));
+		ctx.lineTo(left + width, y(ind));
+	});
+	data.xticks.forEach(function(xtick) {
+		ctx.moveTo(x(data.date_from_s + xtick[0]), top);
+		ctx.lineTo(x(data.date_from_s + xtick[0]), top + height);
+	});
+	ctx.stroke();
+
+	/* Ticks and their labels */
+	ctx.lineWidth = .8 * pt;
+	ctx.setLineDash([]);
+	ctx.beginPath();
+	setFont(layout.fontsizes.left);
+	ctx.textAlign = "right";
+	ctx.textBaseline = "middle";
+	data.stops.forEach(function(stop, ind) {
+		ctx.moveTo(left - tickLength, y(ind));
+		ctx.lineTo(left, y(ind));
+		ctx.fillText(stop, left - tickLength - tickPad, y(ind));
+	});
+	setFont(layout.fontsizes.bottom);
+	ctx.textAlign = "center";
+	ctx.textBaseline = "top";
+	data.xticks.forEach(function(xtick) {
+		var tickX = x(data.date_from_s + xtick[0]);
+		ctx.moveTo(tickX, top + height);
+		ctx.lineTo(tickX, top + height + tickLength);
+		xtick[1].split("\n").forEach(function(label, ind) {
+			ctx.fillText(label, tickX, top + height + tickLength + tickPad + ind * 1.2 * layout.fontsizes.bottom * pt);
+		});
+	});
+	ctx.stroke();
+	ctx.strokeRect(left, top, width, height);
+
+	/* Lines (see decodePlotData) */
+	ctx.save();
+	ctx.beginPath();
+	ctx.rect(left, top, width, height);
+	ctx.clip();
+	ctx.lineWidth = 1.5 * pt;
+	PLOT_LINE_TYPES.forEach(function(dataType) {
+		ctx.setLineDash(PLOT_LINE_DASHES[dataType].map(function(dash) { return dash * ctx.lineWidth; }));
+		data.lines[dataType].forEach(function(line) {
+			ctx.strokeStyle = PLOT_LINE_COLOURS[line[0]];
+			ctx.beginPath();
+			line[1].forEach(function(point, ind) {
+				if (ind == 0)
+					ctx.moveTo(x(point[0]), y(point[1] / data.position_scale));
+				else
+					ctx.lineTo(x(point[0]), y(point[1] / data.position_scale));
+			});
+			ctx.stroke();
+		});
+	});
+	ctx.restore();
+
+	/* No data to display */
+	if (data.no_data_msg !== null) {
+		setFont(layout.fontsizes.no_data);
+		ctx.textAlign = "center";
+		ctx.textBaseline = "middle";
+		var lines = data.no_data_msg.split("\n");
+		lines.forEach(function(line, ind) {
+			ctx.fillText(line, left + width / 2, top + height / 2 + (ind - (lines.length - 1) / 2) * 1.2 * layout.fontsizes.no_data * pt);
+		});
+	}
+}
+
+
 
 $(document).ready(function() {
 
@@ -13,5 +182,39 @@ $(document).ready(function() {
 		div_result.html("Loading..");
 	});
 
+
+	/* Draw plots */
+	$("canvas.plot-canvas").each(function() {
+		var canvas = this;
+		$.getJSON($(canvas).data("url"))
+			.done(function(data) {
+				decodePlotData(data);
+				drawPlot(canvas, data);
+
+				/* Plots ending now are extended with new locations */
+				var liveUrl = $(canvas).data("live-url");
+				if (liveUrl) {
+					var since = data.watermark_s === null ? data.date_from_s : data.watermark_s;
+					var pollLive = function() {
+						$.getJSON(liveUrl + "&since=" + since)
+							.done(function(update) {
+								since = update.watermark_s;
+								extendPlot(data, update);
+								drawPlot(canvas, data);
+								setTimeout(pollLive, update.interval_s * 1000);
+							})
+							.fail(function() {
+								setTimeout(pollLive, 60 * 1000);
+							});
+					};
+					pollLive();
+				}
+			})
+			.fail(function(jqXHR) {
+				var error = jqXHR.responseJSON ? jqXHR.responseJSON.error : jqXHR.statusText;
+				$(canvas).replaceWith($('<span class="error text-danger"/>').text("Processing failed: " + error));
+			});
+	});
+
 });
 